@@ -2,7 +2,7 @@
 
 import type React from "react"
 
-import { useState, useEffect, useCallback } from "react"
+import { useState, useEffect, useCallback, useRef } from "react"
 import Image from "next/image"
 import { motion } from "framer-motion"
 import { useRouter } from "next/navigation"
@@ -36,6 +36,7 @@ function CheckoutPageContent() {
   const { cart, total, clearCart } = useCart()
   const { formatPrice } = useCurrency()
   const [isProcessing, setIsProcessing] = useState(false)
+  const paymentAttemptKey = useRef<string | null>(null)
   const [orderComplete, setOrderComplete] = useState(false)
   const [showMpesaModal, setShowMpesaModal] = useState(false)
   const [mpesaCheckoutId, setMpesaCheckoutId] = useState<string>("")
@@ -153,8 +154,10 @@ function CheckoutPageContent() {
         }
       }
 
-      // Process payment
+      // Process payment; a retry after a network error reuses the key
+      paymentAttemptKey.current ??= crypto.randomUUID()
       const paymentData = {
+        idempotencyKey: paymentAttemptKey.current,
         paymentMethod,
         amount: grandTotal,
         cardData: paymentMethod === "card" ? cardData : undefined,
@@ -173,6 +176,9 @@ function CheckoutPageContent() {
       }
 
       const result = await processPayment(paymentData)
+      if (!result.networkError) {
+        paymentAttemptKey.current = null
+      }
 
       if (result.success) {
         if (result.redirectUrl && paymentMethod === "paypal") {
@@ -15,7 +15,7 @@ import {
   ProductGridSkeleton,
 } from "@/components/product-grid-state"
 import type { Product } from "@/lib/products"
-import { fetchProducts } from "@/lib/products"
+import { fetchProducts, searchProducts } from "@/lib/products"
 
 const CATEGORIES = ["all", "clothing", "shoes", "bags", "accessories"]
 const PRICE_RANGES = [
@@ -45,12 +45,25 @@ export default function StorePage() {
     fallbackData: [],
   })
 
-  const products = data || []
+  // Search runs on the server once typing pauses.
+  const [query, setQuery] = useState("")
+  useEffect(() => {
+    const timer = setTimeout(() => setQuery(searchTerm.trim()), 300)
+    return () => clearTimeout(timer)
+  }, [searchTerm])
+
+  const category = selectedCategory === "all" ? undefined : selectedCategory
+  const {
+    data: searchResults,
+    error: searchError,
+    isLoading: isSearching,
+  } = useSWR(query ? ["graphql:search", query, category] : null, () =>
+    searchProducts(query, category)
+  )
+
+  const products = (query ? searchResults : data) || []
 
   const filteredProducts = products.filter((product: Product) => {
-    const matchesSearch = product.name
-      .toLowerCase()
-      .includes(searchTerm.toLowerCase())
     const matchesCategory =
       selectedCategory === "all" || product.category === selectedCategory
     const matchesFilter =
@@ -61,7 +74,7 @@ export default function StorePage() {
     const price =
       product.onSale && product.salePrice ? product.salePrice : product.price
     const matchesPrice = price >= range.min && price < range.max
-    return matchesSearch && matchesCategory && matchesFilter && matchesPrice
+    return matchesCategory && matchesFilter && matchesPrice
   })
 
   const title =
@@ -160,9 +173,9 @@ export default function StorePage() {
 
           {/* Product Grid */}
           <div className="flex-1">
-            {isLoading ? (
+            {isLoading || isSearching ? (
               <ProductGridSkeleton count={8} />
-            ) : error ? (
+            ) : error || searchError ? (
               <ProductGridEmpty
                 title="Unable to load products"
                 description="Please try again shortly."
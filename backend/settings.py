@@ -43,6 +43,30 @@ JWT_SECRET = config("JWT_SECRET", default=SECRET_KEY)
 JWT_ALGORITHM = config("JWT_ALGORITHM", default="HS256")
 JWT_ACCESS_TTL_MINUTES = config("JWT_ACCESS_TTL_MINUTES", default=15, cast=int)
 JWT_REFRESH_TTL_DAYS = config("JWT_REFRESH_TTL_DAYS", default=7, cast=int)
+# Verified access tokens kept per process, and how long user snapshots for
+# authenticated requests stay in the shared cache.
+JWT_VERIFIED_CACHE_SIZE = config("JWT_VERIFIED_CACHE_SIZE", default=1024, cast=int)
+AUTH_USER_CACHE_TTL = config("AUTH_USER_CACHE_TTL", default=60, cast=int)
+
+# GraphQL operation limits (see shop/graphql/cost.py)
+GRAPHQL_MAX_QUERY_DEPTH = config("GRAPHQL_MAX_QUERY_DEPTH", default=10, cast=int)
+GRAPHQL_MAX_QUERY_COST = config("GRAPHQL_MAX_QUERY_COST", default=2000, cast=int)
+GRAPHQL_COST_BUDGET = config("GRAPHQL_COST_BUDGET", default=20000, cast=int)
+GRAPHQL_COST_BUDGET_WINDOW = config("GRAPHQL_COST_BUDGET_WINDOW", default=60, cast=int)
+
+# Persisted queries (see shop/graphql/persisted.py)
+GRAPHQL_PERSISTED_QUERIES_ONLY = config(
+    "GRAPHQL_PERSISTED_QUERIES_ONLY", default=False, cast=bool
+)
+GRAPHQL_PERSISTED_QUERIES_MANIFEST = config(
+    "GRAPHQL_PERSISTED_QUERIES_MANIFEST", default=""
+)
+GRAPHQL_PERSISTED_QUERY_TTL = config(
+    "GRAPHQL_PERSISTED_QUERY_TTL", default=7 * 24 * 3600, cast=int
+)
+GRAPHQL_DOCUMENT_CACHE_SIZE = config(
+    "GRAPHQL_DOCUMENT_CACHE_SIZE", default=1000, cast=int
+)
 
 ALLOWED_HOSTS = config(
     "DJANGO_ALLOWED_HOSTS",
@@ -100,6 +124,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "backend.wsgi.application"
+ASGI_APPLICATION = "backend.asgi.application"
 
 
 # Database
@@ -256,9 +281,52 @@ else:
 
 SESSION_CACHE_ALIAS = "default"
 
-# Database connection pooling
+# Per-process LRU in front of the shared cache for the hottest GraphQL reads.
+# Entries live for a few seconds and are dropped early by tag invalidations,
+# which are fanned out to every worker over Redis pub/sub.
+QUERY_CACHE_LOCAL = config("QUERY_CACHE_LOCAL", default=True, cast=bool)
+QUERY_CACHE_LOCAL_MAX_BYTES = config(
+    "QUERY_CACHE_LOCAL_MAX_BYTES", default=32 * 1024 * 1024, cast=int
+)
+QUERY_CACHE_LOCAL_TTL = config("QUERY_CACHE_LOCAL_TTL", default=5, cast=int)
+
+# Exchange-rate tables are refreshed in the background this many seconds
+# before their TTL runs out, so request handlers never wait on the upstream API.
+EXCHANGE_RATE_TTL = config("EXCHANGE_RATE_TTL", default=3600, cast=int)
+EXCHANGE_RATE_REFRESH_MARGIN = config(
+    "EXCHANGE_RATE_REFRESH_MARGIN", default=300, cast=int
+)
+# Rate tables are fetched from exchangerate-api.com in the background; set to
+# False to serve the cached or fallback tables only.
+EXCHANGE_RATE_ONLINE = config("EXCHANGE_RATE_ONLINE", default=not IS_TESTING, cast=bool)
+
+# Profile locations missing from the bundled gazetteer are looked up on
+# Nominatim in the background; set to False to stay fully offline.
+GEOCODING_ONLINE = config("GEOCODING_ONLINE", default=not IS_TESTING, cast=bool)
+
+# Background jobs (payment callbacks, notifications) go to Redis for
+# ``manage.py run_jobs`` workers. Without Redis they are queued in process and
+# drained by a background thread, unless this is off (tests drain explicitly).
+JOBS_INLINE_WORKER = config("JOBS_INLINE_WORKER", default=not IS_TESTING, cast=bool)
+
+# Carts live in the database by default. With Redis configured, "redis" keeps
+# them in Redis hashes and writes changed carts back to the database in
+# batches, CART_FLUSH_DELAY seconds after the first change.
+CART_BACKEND = config("CART_BACKEND", default="database")
+CART_FLUSH_DELAY = config("CART_FLUSH_DELAY", default=5, cast=int)
+
+# With Redis configured, event counters are buffered there and written to the
+# database by a job queued COUNTER_FLUSH_INTERVAL seconds after the first
+# increment.
+COUNTER_FLUSH_INTERVAL = config("COUNTER_FLUSH_INTERVAL", default=300, cast=int)
+
+# Database connection pooling. Production runs under ASGI, where Django
+# recommends disabling persistent connections (each request's sync code runs
+# in its own thread); rely on the database pooler instead.
 if not IS_TESTING:
-    DATABASES["default"]["CONN_MAX_AGE"] = 600
+    DATABASES["default"]["CONN_MAX_AGE"] = config(
+        "DB_CONN_MAX_AGE", default=0, cast=int
+    )
     DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
     # Only add statement_timeout for non-pooled connections
     if "pooler" not in primary_db_url:
@@ -336,6 +404,15 @@ MPESA_ENVIRONMENT = os.getenv("MPESA_ENVIRONMENT", "sandbox")
 MPESA_SHORTCODE = os.getenv("MPESA_SHORTCODE", "174379")
 MPESA_PASSKEY = os.getenv("MPESA_PASSKEY")
 MPESA_CALLBACK_URL = os.getenv("MPESA_CALLBACK_URL")
+# STK status queries (polls and reconcile_mpesa) share this budget.
+MPESA_QUERY_RATE = os.getenv("MPESA_QUERY_RATE", "5/s")
+# Pushes whose callback never arrives are queried from Daraja by a job that
+# runs this many seconds after a push, and again while any are still pending.
+MPESA_RECONCILE_INTERVAL = config("MPESA_RECONCILE_INTERVAL", default=300, cast=int)
+
+# Responses to payment requests sent with an Idempotency-Key are replayed to
+# retries carrying the same key for this many seconds.
+IDEMPOTENCY_TTL = config("IDEMPOTENCY_TTL", default=24 * 3600, cast=int)
 
 # Django REST Framework Configuration
 REST_FRAMEWORK = {
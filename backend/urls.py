@@ -15,7 +15,7 @@ from shop import (
 )
 from shop.admin import admin_site
 from shop.error_handlers import handler400, handler403, handler404, handler500
-from shop.graphql.context import get_context
+from shop.graphql.context import get_async_context
 from shop.graphql.schema import schema
 from shop.graphql.view import CSRFExemptGraphQLView
 
@@ -69,6 +69,11 @@ api_patterns = [
     path("register/", api_views.api_register, name="api_register"),
     path("logout/", api_views.api_logout, name="api_logout"),
     path("products/", api_views.api_products, name="api_products"),
+    path(
+        "products/search/",
+        api_views.api_product_search,
+        name="api_product_search",
+    ),
     path(
         "products/<int:product_id>/",
         api_views.api_product_detail,
@@ -87,6 +92,7 @@ api_patterns = [
     path("categories/", api_views.api_categories, name="api_categories"),
     path("cart/", api_views.api_cart, name="api_cart"),
     path("cart/add/", api_views.api_cart_add, name="api_cart_add"),
+    path("cart/batch/", api_views.api_cart_batch, name="api_cart_batch"),
     path("cart/<int:item_id>/", api_views.api_cart_item, name="api_cart_item"),
     path("saved/", api_views.api_saved, name="api_saved"),
     path("saved/add/", api_views.api_saved_add, name="api_saved_add"),
@@ -125,7 +131,7 @@ urlpatterns = [
             CSRFExemptGraphQLView.as_view(
                 schema=schema,
                 graphql_ide="graphiql" if settings.GRAPHQL_GRAPHIQL else None,
-                get_context=get_context,
+                get_context=get_async_context,
             )
         ),
         name="graphql",
@@ -43,11 +43,11 @@ export function MpesaAuthModal({
       try {
         const statusResult = await checkMpesaPaymentStatus(checkoutRequestId)
 
-        if (statusResult.result_code === "0") {
+        if (statusResult.status === "success") {
           // Payment successful
           setStatus("success")
           setTimeout(() => onSuccess(), 1500)
-        } else if (statusResult.result_code !== "1032") {
+        } else if (statusResult.status !== "pending") {
           // Payment failed (not pending)
           setStatus("failed")
           setTimeout(
@@ -55,7 +55,7 @@ export function MpesaAuthModal({
             1500
           )
         }
-        // If result_code is "1032", payment is still pending, continue polling
+        // While the status is "pending", keep polling
       } catch {
         // Error checking payment status
       }
@@ -125,26 +125,62 @@ export async function updateCartItemQuantity(
   }
 }
 
+export interface CartOperation {
+  action: "add" | "update" | "remove" | "clear"
+  productId?: number
+  itemId?: number
+  quantity?: number
+  selectedSize?: string
+  selectedColor?: string
+}
+
 /**
- * Clears all items from the cart on the server.
- * Currently implemented by deleting items one-by-one because there is no
- * dedicated bulk-clear endpoint.
- * @returns {boolean} True if the operation was successful, false otherwise.
+ * Applies several cart changes in one request. Either all of them are
+ * applied or none is.
+ * @returns The updated cart, or null if the batch was rejected.
  */
-export async function clearCart(cart: CartItem[]): Promise<boolean> {
+export async function applyCartOperations(
+  operations: CartOperation[]
+): Promise<CartItem[] | null> {
   try {
-    // Perform all delete operations in parallel for efficiency
-    const deletePromises = cart
-      .filter(item => item.id)
-      .map(item => removeFromCart(item.id!))
-    const results = await Promise.all(deletePromises)
-    // Return true only if all deletions were successful
-    return results.every(res => res)
+    const data = await graphqlRequest<{
+      cartApply: { items: CartItem[] }
+    }>(
+      `
+      mutation ApplyCart($operations: [CartOperationInput!]!) {
+        cartApply(operations: $operations) {
+          items {
+            id
+            quantity
+            selectedSize
+            selectedColor
+            product {
+              id
+              name
+              price
+              images
+            }
+          }
+        }
+      }
+      `,
+      { operations }
+    )
+    return data.cartApply.items
   } catch {
-    return false
+    return null
   }
 }
 
+/**
+ * Clears all items from the cart on the server.
+ * @returns {boolean} True if the operation was successful, false otherwise.
+ */
+export async function clearCart(cart: CartItem[]): Promise<boolean> {
+  if (!cart.some(item => item.id)) return true
+  return (await applyCartOperations([{ action: "clear" }])) !== null
+}
+
 /**
  * Calculates the total price of the cart items.
  * This remains a synchronous utility function.
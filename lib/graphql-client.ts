@@ -17,7 +17,33 @@ const GRAPHQL_URL =
 
 type GraphQLResponse<T> = {
   data?: T
-  errors?: { message: string }[]
+  errors?: { message: string; extensions?: { code?: string } }[]
+}
+
+const queryHashes = new Map<string, string>()
+
+async function sha256(text: string): Promise<string | null> {
+  if (typeof crypto === "undefined" || !crypto.subtle) return null
+  const cached = queryHashes.get(text)
+  if (cached) return cached
+
+  const digest = await crypto.subtle.digest(
+    "SHA-256",
+    new TextEncoder().encode(text)
+  )
+  const hash = Array.from(new Uint8Array(digest))
+    .map(byte => byte.toString(16).padStart(2, "0"))
+    .join("")
+  queryHashes.set(text, hash)
+  return hash
+}
+
+function isPersistedQueryNotFound(payload: GraphQLResponse<unknown>) {
+  return Boolean(
+    payload.errors?.some(
+      err => err.extensions?.code === "PERSISTED_QUERY_NOT_FOUND"
+    )
+  )
 }
 
 async function parseGraphQLResponse<T>(
@@ -56,20 +82,37 @@ export async function graphqlRequest<T>(
   variables?: Record<string, any>
 ): Promise<T> {
   const accessToken = getAccessToken()
-
-  const response = await fetch(GRAPHQL_URL, {
-    method: "POST",
-    mode: "cors",
-    credentials: "include",
-    headers: buildHeaders(accessToken || undefined),
-    body: JSON.stringify({ query, variables }),
-    cache: "no-store",
-  })
-
-  const payload = await parseGraphQLResponse<T>(
+  const hash = await sha256(query)
+  const extensions = hash
+    ? { persistedQuery: { version: 1, sha256Hash: hash } }
+    : undefined
+
+  const send = (body: Record<string, unknown>) =>
+    fetch(GRAPHQL_URL, {
+      method: "POST",
+      mode: "cors",
+      credentials: "include",
+      headers: buildHeaders(accessToken || undefined),
+      body: JSON.stringify(body),
+      cache: "no-store",
+    })
+
+  // Automatic persisted queries: send only the hash, and the full text
+  // once if the server has not seen it yet.
+  let response = await send(
+    extensions ? { variables, extensions } : { query, variables }
+  )
+  let payload = await parseGraphQLResponse<T>(
     response,
     "Unexpected server response"
   )
+  if (extensions && isPersistedQueryNotFound(payload)) {
+    response = await send({ query, variables, extensions })
+    payload = await parseGraphQLResponse<T>(
+      response,
+      "Unexpected server response"
+    )
+  }
 
   if (!response.ok && (!payload.errors || payload.errors.length === 0)) {
     throw new Error(`GraphQL request failed with status ${response.status}`)
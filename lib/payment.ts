@@ -32,6 +32,9 @@ export interface PaymentData {
   amount: number
   cardData?: CardData
   phoneNumber?: string
+  // Reuse the key when retrying after a network error so the server can
+  // replay its first answer instead of charging twice.
+  idempotencyKey?: string
   orderData: {
     items: OrderItem[]
     shippingAddress: Address
@@ -47,6 +50,9 @@ export interface PaymentResult {
   redirectUrl?: string
   checkoutRequestId?: string
   merchantRequestId?: string
+  // True when no answer came back, so the payment may or may not have gone
+  // through.
+  networkError?: boolean
 }
 
 export const processPayment = async (
@@ -77,6 +83,7 @@ export const processPayment = async (
     return {
       success: false,
       error: errorMessage,
+      networkError: true,
     }
   }
 }
@@ -69,6 +69,32 @@ export async function fetchProductById(
   return data.product || null
 }
 
+/**
+ * Ranked server-side search over product names and descriptions.
+ * Typos are tolerated; results come back best match first.
+ */
+export async function searchProducts(
+  query: string,
+  category?: string,
+  limit = 100
+): Promise<Product[]> {
+  const data = await graphqlRequest<{
+    searchProducts: { items: Product[] }
+  }>(
+    `
+    query SearchProducts($query: String!, $limit: Int!, $filter: ProductFilterInput) {
+      searchProducts(query: $query, limit: $limit, filter: $filter) {
+        items {
+          ${PRODUCT_FIELDS}
+        }
+      }
+    }
+    `,
+    { query, limit, filter: category ? { category } : null }
+  )
+  return data.searchProducts.items || []
+}
+
 export function filterProductsByCategory(
   products: Product[],
   category: string
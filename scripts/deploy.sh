@@ -58,7 +58,7 @@ except Exception as e:
 # Start production server
 echo "🌟 Starting production server..."
 if [ "$USE_GUNICORN" = "true" ]; then
-    gunicorn --bind 0.0.0.0:8000 --workers 4 wsgi:application
+    gunicorn --bind 0.0.0.0:8000 --workers 4 -k uvicorn_worker.UvicornWorker backend.asgi:application
 else
     python unified_server.py
 fi
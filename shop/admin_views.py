@@ -3,11 +3,12 @@ from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.core.paginator import Paginator
-from django.db.models import Count, Sum
+from django.db.models import Count
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.http import require_http_methods
 
+from . import outbound, rollups
 from .models import Category, Order, Product, UserProfile
 
 
@@ -20,10 +21,9 @@ def is_admin(user):
 def admin_dashboard(request):
     """Admin dashboard with analytics"""
     # Get analytics data
-    total_orders = Order.objects.count()
-    total_revenue = (
-        Order.objects.aggregate(Sum("total_amount"))["total_amount__sum"] or 0
-    )
+    totals = rollups.totals()
+    total_orders = totals["orders"]
+    total_revenue = totals["revenue"]
     total_users = User.objects.count()
     total_products = Product.objects.count()
 
@@ -31,9 +31,7 @@ def admin_dashboard(request):
     recent_orders = Order.objects.select_related("user").order_by("-created_at")[:5]
 
     # Popular products
-    popular_products = Product.objects.annotate(
-        order_count=Count("orderitem")
-    ).order_by("-order_count")[:5]
+    popular_products = rollups.top_products()
 
     context = {
         "total_orders": total_orders,
@@ -102,7 +100,6 @@ def admin_product_create(request):
         images = data.get("images", [])
         if not images or len(images) == 0:
             try:
-                import requests
                 from decouple import config
 
                 access_key = config("UNSPLASH_ACCESS_KEY", default="")
@@ -114,7 +111,7 @@ def admin_product_create(request):
                         "orientation": "portrait",
                         "client_id": access_key,
                     }
-                    response = requests.get(search_url, params=params, timeout=10)
+                    response = outbound.get(search_url, params=params)
                     if response.status_code == 200:
                         results = response.json().get("results", [])
                         images = [img["urls"]["regular"] for img in results[:3]]
@@ -224,35 +221,15 @@ def admin_users(request):
 @staff_member_required
 def admin_analytics(request):
     """Admin analytics page"""
-    from datetime import datetime, timedelta
-
-    from django.db.models import Sum
-    from django.db.models.functions import TruncMonth
-
-    # Sales trends (last 6 months) - real data
-    six_months_ago = datetime.now() - timedelta(days=180)
-    sales_by_month = (
-        Order.objects.filter(created_at__gte=six_months_ago)
-        .annotate(month=TruncMonth("created_at"))
-        .values("month")
-        .annotate(sales=Sum("total_amount"), orders=Count("id"))
-        .order_by("-month")
-    )
-
-    sales_trends = [
-        {
-            "month": item["month"].strftime("%b"),
-            "sales": float(item["sales"] or 0),
-            "orders": item["orders"],
-        }
-        for item in sales_by_month
-    ]
+    # Sales trends (last 6 months), newest first
+    sales_trends = list(reversed(rollups.sales_by_month()))
 
-    # Category stats - real data
+    # Category stats
     category_stats = []
-    for category in Category.objects.all():
-        product_count = category.product_set.count()
-        order_count = sum(p.orderitem_set.count() for p in category.product_set.all())
+    order_counts = rollups.order_items_by_category()
+    for category in Category.objects.annotate(product_count=Count("product")):
+        product_count = category.product_count
+        order_count = order_counts.get(category.id, 0)
         category_stats.append(
             {
                 "name": category.name,
@@ -1,3 +1,5 @@
+from functools import partial
+
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -6,18 +8,18 @@ from django.http import JsonResponse
 from django.middleware.csrf import get_token
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.http import require_http_methods
-from django_ratelimit.decorators import ratelimit
 
+from . import carts, catalog, counters, exchange_rates, outbound, pricing, search
 from .forms import ProfileForm, RegistrationForm
 from .models import (
     Cart,
-    CartItem,
     Category,
     Order,
     Product,
     SavedItem,
     UserProfile,
 )
+from .ratelimit import ratelimit
 
 
 @require_http_methods(["GET"])
@@ -26,14 +28,15 @@ def api_health_check(request):
     from django.utils import timezone
 
     csrf_token = get_token(request)
-    return JsonResponse(
-        {
-            "status": "healthy",
-            "csrf_token": csrf_token,
-            "authenticated": request.user.is_authenticated,
-            "timestamp": timezone.now().isoformat(),
-        }
-    )
+    data = {
+        "status": "healthy",
+        "csrf_token": csrf_token,
+        "authenticated": request.user.is_authenticated,
+        "timestamp": timezone.now().isoformat(),
+    }
+    if request.user.is_staff:
+        data["outbound"] = outbound.metrics()
+    return JsonResponse(data)
 
 
 @require_http_methods(["GET"])
@@ -162,6 +165,7 @@ def api_register(request):
                 )
                 UserProfile.objects.create(user=user)
                 Cart.objects.create(user=user)
+                transaction.on_commit(partial(counters.incr, {"registrations": 1}))
             return JsonResponse(
                 {"success": True, "message": "User created successfully"}
             )
@@ -182,19 +186,9 @@ def api_logout(request):
     return JsonResponse({"success": True})
 
 
-@ratelimit(key="user_or_ip", rate="100/h", method="GET")
-@require_http_methods(["GET"])
-def api_products(request):
-    if getattr(request, "limited", False):
-        return JsonResponse({"error": "Rate limit exceeded"}, status=429)
-
-    target_currency = request.GET.get("currency", "USD")
-    products = (
-        Product.objects.select_related("category")
-        .prefetch_related("product_reviews")
-        .order_by("-created_at")
-    )
+def _product_list_data(products, target_currency):
     data = []
+    rates = {}
 
     for p in products:
         try:
@@ -202,7 +196,9 @@ def api_products(request):
             sale_price = float(p.sale_price) if p.sale_price else None
 
             if target_currency != p.currency:
-                rate = get_exchange_rate(p.currency, target_currency)
+                if p.currency not in rates:
+                    rates[p.currency] = get_exchange_rate(p.currency, target_currency)
+                rate = rates[p.currency]
                 price = price * rate
                 if sale_price:
                     sale_price = sale_price * rate
@@ -238,7 +234,115 @@ def api_products(request):
             logger = logging.getLogger("shop")
             logger.error(f"Error processing product {p.id}: {e}")
             continue
-    return JsonResponse({"products": data})
+    return data
+
+
+@ratelimit(key="user_or_ip", rate="100/h", method="GET")
+@require_http_methods(["GET"])
+def api_products(request):
+    if getattr(request, "limited", False):
+        return JsonResponse({"error": "Rate limit exceeded"}, status=429)
+
+    try:
+        target_currency = exchange_rates.normalize_currency(
+            request.GET.get("currency", "USD")
+        )
+        queryset = catalog.filter_products(
+            Product.objects.select_related("category"),
+            category=request.GET.get("category") or None,
+            in_stock=catalog.parse_bool(request.GET.get("in_stock")),
+            on_sale=catalog.parse_bool(request.GET.get("on_sale")),
+            is_new=catalog.parse_bool(request.GET.get("is_new")),
+            min_price=catalog.parse_price(request.GET.get("min_price")),
+            max_price=catalog.parse_price(request.GET.get("max_price")),
+        )
+        products, next_cursor = catalog.paginate_products(
+            queryset,
+            first=catalog.clamp_page_size(request.GET.get("limit")),
+            after=request.GET.get("cursor") or None,
+        )
+    except (
+        catalog.InvalidCursor,
+        catalog.InvalidFilter,
+        exchange_rates.UnsupportedCurrency,
+    ) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    data = _product_list_data(products, target_currency)
+    return JsonResponse(
+        {
+            "products": data,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        }
+    )
+
+
+@ratelimit(key="user_or_ip", rate="100/h", method="GET")
+@require_http_methods(["GET"])
+def api_product_search(request):
+    """
+    Ranked search over product names and descriptions.
+
+    ``q`` is required; the catalog filters of ``api_products`` apply, and
+    pages are selected with ``limit`` and ``offset``. ``facets`` counts the
+    matches per category and flag.
+    """
+    if getattr(request, "limited", False):
+        return JsonResponse({"error": "Rate limit exceeded"}, status=429)
+
+    try:
+        target_currency = exchange_rates.normalize_currency(
+            request.GET.get("currency", "USD")
+        )
+        offset = int(request.GET.get("offset") or 0)
+        results = search.search_products(
+            request.GET.get("q", ""),
+            category=request.GET.get("category") or None,
+            in_stock=catalog.parse_bool(request.GET.get("in_stock")),
+            on_sale=catalog.parse_bool(request.GET.get("on_sale")),
+            is_new=catalog.parse_bool(request.GET.get("is_new")),
+            min_price=catalog.parse_price(request.GET.get("min_price")),
+            max_price=catalog.parse_price(request.GET.get("max_price")),
+            limit=catalog.clamp_page_size(request.GET.get("limit")),
+            offset=offset,
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    return JsonResponse(
+        {
+            "products": _product_list_data(results.products, target_currency),
+            "total": results.total,
+            "facets": results.facets,
+            "next_offset": results.next_offset,
+            "has_more": results.next_offset is not None,
+        }
+    )
+
+
+def _cart_item_data(line):
+    return {
+        "id": line.id,
+        "product": {
+            "id": line.product.id,
+            "name": line.product.name,
+            "price": float(line.product.price),
+            "images": line.product.images,
+        },
+        "quantity": line.quantity,
+        "selected_size": line.selected_size,
+        "selected_color": line.selected_color,
+    }
+
+
+def _cart_totals(priced):
+    return {
+        "currency": priced.currency,
+        "item_count": priced.item_count,
+        "subtotal": float(priced.subtotal),
+        "discount": float(priced.discount),
+    }
 
 
 @require_http_methods(["GET"])
@@ -247,24 +351,14 @@ def api_cart(request):
     if not request.user.is_authenticated:
         return JsonResponse({"items": [], "authenticated": False})
 
-    cart, _ = Cart.objects.get_or_create(user=request.user)
-    items = cart.items.all().select_related("product")
-    data = [
+    priced = pricing.price_cart(request.user)
+    return JsonResponse(
         {
-            "id": item.id,
-            "product": {
-                "id": item.product.id,
-                "name": item.product.name,
-                "price": float(item.product.price),
-                "images": item.product.images,
-            },
-            "quantity": item.quantity,
-            "selected_size": item.selected_size,
-            "selected_color": item.selected_color,
+            "items": [_cart_item_data(entry.line) for entry in priced.lines],
+            "totals": _cart_totals(priced),
+            "authenticated": True,
         }
-        for item in items
-    ]
-    return JsonResponse({"items": data, "authenticated": True})
+    )
 
 
 @login_required
@@ -301,22 +395,10 @@ def api_cart_add(request):
     except (KeyError, ValueError) as e:
         return JsonResponse({"error": f"Invalid request: {str(e)}"}, status=400)
 
-    cart, _ = Cart.objects.get_or_create(user=request.user)
-
-    item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        selected_size=selected_size,
-        selected_color=selected_color,
-        defaults={"quantity": quantity},
-    )
-
-    if not created:
-        item.quantity = quantity
-        item.save()
+    item_id = carts.add(request.user, product, quantity, selected_size, selected_color)
 
     logger.info(f"User {request.user.username} added product {product.id} to cart")
-    return JsonResponse({"success": True, "item_id": item.id})
+    return JsonResponse({"success": True, "item_id": item_id})
 
 
 @login_required
@@ -325,32 +407,66 @@ def api_cart_item(request, item_id):
     """
     Update or delete a specific item in the user's cart.
     """
-    try:
-        # Security check: ensure the item belongs to the current user's cart.
-        item = CartItem.objects.get(id=item_id, cart__user=request.user)
-    except CartItem.DoesNotExist:
-        return JsonResponse({"error": "Cart item not found"}, status=404)
-
     if request.method == "PUT":
         import json
 
         try:
             data = json.loads(request.body)
             quantity = int(data.get("quantity"))
-            if quantity > 0:
-                item.quantity = quantity
-                item.save()
-                return JsonResponse({"success": True})
-            else:
-                # If quantity is 0 or less, treat it as a deletion
-                item.delete()
-                return JsonResponse({"success": True, "deleted": True})
-        except (json.JSONDecodeError, ValueError, KeyError):
+        except (json.JSONDecodeError, TypeError, ValueError):
             return JsonResponse({"error": "Invalid request"}, status=400)
+        # Only lines in the current user's cart can be found, so nobody can
+        # change someone else's cart. A quantity of 0 or less removes the line.
+        if not carts.update(request.user, item_id, quantity):
+            return JsonResponse({"error": "Cart item not found"}, status=404)
+        if quantity > 0:
+            return JsonResponse({"success": True})
+        return JsonResponse({"success": True, "deleted": True})
+
+    if not carts.remove(request.user, item_id):
+        return JsonResponse({"error": "Cart item not found"}, status=404)
+    return JsonResponse({"success": True})
+
+
+@login_required
+@require_http_methods(["POST"])
+def api_cart_batch(request):
+    """
+    Apply several cart operations in one request.
+
+    Body: ``{"operations": [{"action": "add", "product_id": 1, "quantity": 2,
+    "selected_size": "M"}, {"action": "update", "item_id": 7, "quantity": 3},
+    {"action": "remove", "item_id": 8}, {"action": "clear"}]}``. Either all
+    operations are applied or none is. Returns the new cart and its totals.
+    """
+    import json
 
-    elif request.method == "DELETE":
-        item.delete()
-        return JsonResponse({"success": True})
+    try:
+        data = json.loads(request.body)
+        operations = [
+            carts.CartOperation(
+                action=op["action"],
+                product_id=int(op["product_id"]) if "product_id" in op else None,
+                item_id=int(op["item_id"]) if "item_id" in op else None,
+                quantity=int(op.get("quantity", 1)),
+                selected_size=op.get("selected_size", ""),
+                selected_color=op.get("selected_color", ""),
+            )
+            for op in data["operations"]
+        ]
+        lines = carts.apply(request.user, operations)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    except (KeyError, TypeError, ValueError) as e:
+        return JsonResponse({"error": f"Invalid request: {str(e)}"}, status=400)
+
+    return JsonResponse(
+        {
+            "success": True,
+            "items": [_cart_item_data(line) for line in lines],
+            "totals": _cart_totals(pricing.price_lines(lines)),
+        }
+    )
 
 
 @require_http_methods(["GET"])
@@ -548,111 +664,27 @@ def api_orders(request):
     return JsonResponse({"orders": data})
 
 
-def get_mock_coordinates(city, country):
-    """Generate mock coordinates for demo purposes"""
-    # Mock coordinates for common cities
-    coordinates = {
-        ("Nairobi", "Kenya"): (-1.2921, 36.8219),
-        ("Lagos", "Nigeria"): (6.5244, 3.3792),
-        ("Cairo", "Egypt"): (30.0444, 31.2357),
-        ("New York", "USA"): (40.7128, -74.0060),
-        ("London", "UK"): (51.5074, -0.1278),
-        ("Paris", "France"): (48.8566, 2.3522),
-        ("Tokyo", "Japan"): (35.6762, 139.6503),
-        ("Sydney", "Australia"): (-33.8688, 151.2093),
-    }
-
-    key = (city, country)
-    if key in coordinates:
-        return coordinates[key]
-
-    # Generate random coordinates if city not found
-    import random
-
-    lat = random.uniform(-60, 60)
-    lng = random.uniform(-180, 180)
-    return (lat, lng)
-
-
-def get_coordinates(city, country):
-    """Get real coordinates using geocoding API"""
-    import requests
-
-    try:
-        # Use OpenStreetMap Nominatim API (free)
-        import urllib.parse
-
-        query = urllib.parse.quote(f"{city}, {country}")
-        url = (
-            f"https://nominatim.openstreetmap.org/search?"
-            f"q={query}&format=json&limit=1"
-        )
-
-        response = requests.get(
-            url, timeout=5, headers={"User-Agent": "Arnova-App/1.0"}
-        )
-        if response.status_code == 200:
-            data = response.json()
-            if data:
-                return (float(data[0]["lat"]), float(data[0]["lon"]))
-    except Exception:
-        pass
-
-    # Fallback to mock coordinates if API fails
-    return get_mock_coordinates(city, country)
-
-
 def get_exchange_rate(from_currency, to_currency):
-    """Get exchange rate from free API"""
-    import requests
-
-    if from_currency == to_currency:
-        return 1.0
-
-    try:
-        # Using exchangerate-api.com free tier
-        url = f"https://api.exchangerate-api.com/v4/latest/{from_currency}"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            return data["rates"].get(to_currency, 1.0)
-    except Exception:
-        pass
-
-    # Fallback rates if API fails
-    rates = {
-        ("USD", "KES"): 150.0,
-        ("KES", "USD"): 0.0067,
-        ("USD", "EUR"): 0.85,
-        ("EUR", "USD"): 1.18,
-    }
-    return rates.get((from_currency, to_currency), 1.0)
+    """Get exchange rate from the cached rate table snapshot"""
+    return exchange_rates.get_rate(from_currency, to_currency)
 
 
 @require_http_methods(["GET"])
 def api_exchange_rates(request):
     """Get current exchange rates"""
-    import requests
-
-    base_currency = request.GET.get("base", "USD")
     try:
-        url = f"https://api.exchangerate-api.com/v4/latest/{base_currency}"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            return JsonResponse(response.json())
-    except Exception:
-        pass
-
-    # Fallback rates
-    fallback_data = {
-        "base": base_currency,
-        "rates": {
-            "USD": 1.0 if base_currency == "USD" else 0.0067,
-            "KES": 150.0 if base_currency == "USD" else 1.0,
-            "EUR": 0.85 if base_currency == "USD" else 0.0057,
-        },
-    }
-    return JsonResponse(fallback_data)
+        base_currency = exchange_rates.normalize_currency(
+            request.GET.get("base", "USD")
+        )
+    except exchange_rates.UnsupportedCurrency as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse(
+        {
+            "base": base_currency,
+            "rates": exchange_rates.get_rate_table(base_currency),
+        }
+    )
+
 
 def api_placeholder_image(request, width, height):
     """Generate placeholder image"""
@@ -699,7 +731,7 @@ def api_product_review(request, product_id):
     """Submit a product review"""
     import json
 
-    from .models import Review
+    from .reviews import save_review
 
     try:
         data = json.loads(request.body)
@@ -710,11 +742,7 @@ def api_product_review(request, product_id):
         if not 1 <= rating <= 5:
             return JsonResponse({"error": "Rating must be between 1 and 5"}, status=400)
 
-        review, created = Review.objects.update_or_create(
-            product=product,
-            user=request.user,
-            defaults={"rating": rating, "comment": comment},
-        )
+        review, created = save_review(product, request.user, rating, comment)
 
         return JsonResponse(
             {
@@ -763,6 +791,7 @@ def api_product_reviews(request, product_id):
                 "reviews": data,
                 "average_rating": product.average_rating,
                 "review_count": product.review_count,
+                "rating_histogram": product.rating_histogram,
             }
         )
     except Product.DoesNotExist:
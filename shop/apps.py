@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "shop"
+
+    def ready(self):
+        # Job handlers register themselves on import.
+        from . import signals  # noqa: F401
+        from . import (  # noqa: F401
+            carts,
+            counters,
+            notification_views,
+            payment_views,
+            reconciliation,
+        )
@@ -3,11 +3,170 @@
 import hashlib
 import inspect
 import json
+import logging
+import math
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from functools import wraps
+from typing import Any, NamedTuple
 
+from django.conf import settings
 from django.core.cache import cache
 
+logger = logging.getLogger("shop")
+
 IGNORED_CACHE_ARGS = {"self", "cls", "info"}
+INVALIDATION_CHANNEL = "arnova:cache-invalidation"
+
+# Stampede protection for cache_query
+LOCK_LEASE_SECONDS = 10
+LOCK_WAIT_SECONDS = 2.0
+LOCK_POLL_SECONDS = 0.05
+STALE_GRACE_SECONDS = 60
+XFETCH_BETA = 1.0
+
+
+class LocalCache:
+    """Bounded in-process LRU that sits in front of the shared cache.
+
+    Entries carry their tags so invalidations (local or received over Redis
+    pub/sub) drop exactly the affected keys. ``generation`` lets a writer
+    detect that an invalidation raced with the value it is about to store.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._tag_index = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, _, _, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags=(), generation=None):
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, tags, value)
+            self._bytes += size
+            for tag in tags:
+                self._tag_index.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._tag_index.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tag_index.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, tags, _ = entry
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+
+
+local_cache = LocalCache(
+    max_bytes=getattr(settings, "QUERY_CACHE_LOCAL_MAX_BYTES", 32 * 1024 * 1024),
+    ttl=getattr(settings, "QUERY_CACHE_LOCAL_TTL", 5),
+)
+_subscriber_pid = None
+_subscriber_lock = threading.Lock()
+
+
+def _local_cache_enabled():
+    return getattr(settings, "QUERY_CACHE_LOCAL", False)
+
+
+def _uses_redis():
+    return "django_redis" in settings.CACHES["default"]["BACKEND"]
+
+
+def _listen_for_invalidations():
+    import redis
+
+    while True:
+        try:
+            client = redis.Redis.from_url(settings.REDIS_URL, health_check_interval=30)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Anything published while we were disconnected is lost.
+            local_cache.clear()
+            for message in pubsub.listen():
+                local_cache.invalidate_tags(json.loads(message["data"]))
+        except Exception as exc:
+            logger.warning("Cache invalidation subscriber failed: %s", exc)
+            local_cache.clear()
+            time.sleep(1)
+
+
+def _ensure_invalidation_subscriber():
+    """Start this process's pub/sub listener (again after a fork)."""
+    global _subscriber_pid
+    if _subscriber_pid == os.getpid() or not _uses_redis():
+        return
+    with _subscriber_lock:
+        if _subscriber_pid == os.getpid():
+            return
+        _subscriber_pid = os.getpid()
+        threading.Thread(
+            target=_listen_for_invalidations,
+            name="cache-invalidation",
+            daemon=True,
+        ).start()
+
+
+def _publish_invalidation(tags):
+    if not _uses_redis():
+        return
+    from django_redis import get_redis_connection
+
+    try:
+        get_redis_connection("default").publish(
+            INVALIDATION_CHANNEL, json.dumps(list(tags))
+        )
+    except Exception as exc:
+        logger.warning("Cache invalidation publish failed for %s: %s", tags, exc)
 
 
 def _normalize_cache_value(value):
@@ -53,34 +212,153 @@ def _build_cache_key(func, args, kwargs):
     return hashlib.md5(key_data.encode()).hexdigest()
 
 
-def cache_query(timeout=300):
-    """Cache GraphQL query results"""
+def _resolve_tags(tags, func, args, kwargs):
+    """Format tag templates such as ``"product:{id}"`` with the call's args."""
+    if not tags:
+        return []
+    bound_args = inspect.signature(func).bind_partial(*args, **kwargs)
+    bound_args.apply_defaults()
+    return sorted({tag.format(**bound_args.arguments) for tag in tags})
+
+
+def _tag_version_key(tag):
+    return f"cache_tag:{tag}"
+
+
+def _initial_tag_version():
+    # Seed from the clock so a counter that was evicted and recreated can
+    # never fall back to a version that older entries were stored under.
+    return time.time_ns() // 1000
+
+
+def get_tag_versions(tags):
+    """Return the current generation of each tag, creating missing ones."""
+    keys = {tag: _tag_version_key(tag) for tag in tags}
+    stored = cache.get_many(list(keys.values()))
+    versions = {}
+    for tag, key in keys.items():
+        version = stored.get(key)
+        if version is None:
+            version = _initial_tag_version()
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key, version)
+        versions[tag] = version
+    return versions
+
+
+def invalidate_tags(*tags):
+    """Invalidate every cached entry recorded under any of ``tags``.
+
+    Bumping a tag's generation orphans all keys built from the old one, so
+    this is O(number of tags) and never scans the keyspace.
+    """
+    for tag in tags:
+        key = _tag_version_key(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_tag_version(), timeout=None)
+    local_cache.invalidate_tags(tags)
+    _publish_invalidation(tags)
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    expires_at: float
+    # Seconds the last recomputation took; scales the early-refresh window.
+    delta: float
+
+
+def _should_refresh(entry):
+    """XFetch: refresh early with a probability that rises towards expiry.
+
+    Slow-to-build entries start refreshing earlier, so a hot key is usually
+    rebuilt by one request before it expires instead of by all of them after.
+    """
+    jitter = -math.log(1.0 - random.random())
+    return time.time() + entry.delta * XFETCH_BETA * jitter >= entry.expires_at
+
+
+def _recompute(cache_key, timeout, stale, compute):
+    """Rebuild ``cache_key`` under a short Redis lease (single flight).
+
+    Workers that lose the race serve ``stale`` when there is one, otherwise
+    they poll briefly for the winner's result before computing it themselves.
+    """
+    lock_key = f"{cache_key}:lock"
+    token = uuid.uuid4().hex
+    if not cache.add(lock_key, token, LOCK_LEASE_SECONDS):
+        if stale is not None:
+            return stale.value
+        deadline = time.monotonic() + LOCK_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_SECONDS)
+            entry = cache.get(cache_key)
+            if isinstance(entry, CacheEntry):
+                return entry.value
+        return _store(cache_key, timeout, compute)
+
+    try:
+        return _store(cache_key, timeout, compute)
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+def _store(cache_key, timeout, compute):
+    started = time.monotonic()
+    result = compute()
+    entry = CacheEntry(result, time.time() + timeout, time.monotonic() - started)
+    # Outlive the logical TTL so losers of the lock race have something stale
+    # to serve while the winner rebuilds.
+    cache.set(cache_key, entry, timeout + STALE_GRACE_SECONDS)
+    return result
+
+
+def cache_query(timeout=300, tags=(), local=False):
+    """Cache GraphQL query results
+
+    ``tags`` are format templates over the resolver's arguments, e.g.
+    ``["catalog", "product:{id}"]``; see ``invalidate_tags``. ``local=True``
+    also keeps results in the per-process LRU (when QUERY_CACHE_LOCAL is
+    enabled), so hot reads skip the Redis round trip entirely.
+    """
 
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             cache_key = _build_cache_key(func, args, kwargs)
+            resolved_tags = _resolve_tags(tags, func, args, kwargs)
+
+            use_local = local and _local_cache_enabled()
+            if use_local:
+                _ensure_invalidation_subscriber()
+                result = local_cache.get(cache_key)
+                if result is not None:
+                    return result
+                generation = local_cache.generation
+                local_key = cache_key
+
+            if resolved_tags:
+                versions = get_tag_versions(resolved_tags)
+                cache_key += ":" + ".".join(str(versions[tag]) for tag in resolved_tags)
 
             # Try to get from cache
-            result = cache.get(cache_key)
-            if result is not None:
-                return result
+            entry = cache.get(cache_key)
+            if isinstance(entry, CacheEntry) and not _should_refresh(entry):
+                result = entry.value
+            else:
+                # Execute function and cache result (one worker at a time)
+                if not isinstance(entry, CacheEntry):
+                    entry = None
+                result = _recompute(
+                    cache_key, timeout, entry, lambda: func(*args, **kwargs)
+                )
 
-            # Execute function and cache result
-            result = func(*args, **kwargs)
-            cache.set(cache_key, result, timeout)
+            if use_local:
+                local_cache.set(local_key, result, resolved_tags, generation)
             return result
 
         return wrapper
 
     return decorator
-
-
-def invalidate_cache(pattern):
-    """Invalidate cache keys matching pattern"""
-    from django_redis import get_redis_connection
-
-    conn = get_redis_connection("default")
-    keys = conn.keys(f"arnova:*{pattern}*")
-    if keys:
-        conn.delete(*keys)
@@ -0,0 +1,591 @@
+"""Shopping carts behind one interface for the REST and GraphQL APIs.
+
+``lines``, ``add``, ``update``, ``remove``, ``clear`` and ``apply`` (a batch
+of operations committed together) go to the store picked by ``CART_BACKEND``:
+
+* ``"database"`` (default) reads and writes ``Cart``/``CartItem`` directly.
+* ``"redis"`` keeps each cart in a Redis hash and applies every change with
+  one Lua script, so concurrent updates to a cart cannot interleave. Changed
+  carts are added to a dirty set, and a delayed ``carts.flush`` job writes
+  them to ``Cart``/``CartItem`` in batches (``manage.py flush_carts`` does
+  the same on demand). A cart missing from Redis is loaded from the
+  database on first use.
+
+Every change moves the cart's version, which keys its cached prices (see
+``pricing``). Line ids are unique within a cart and stable while the cart
+lives in its store; both APIs address lines by them.
+"""
+
+import json
+import logging
+from dataclasses import dataclass, field
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from . import jobs
+from .cache_utils import invalidate_tags
+from .models import Cart, CartItem, Product
+
+logger = logging.getLogger("shop")
+
+KEY_PREFIX = "arnova:cart"
+DIRTY_KEY = f"{KEY_PREFIX}:dirty"
+FLUSH_SCHEDULED_KEY = "carts:flush_scheduled"
+# Carts untouched for this long are dropped from Redis (they are persisted).
+CART_TTL = 30 * 24 * 3600
+FLUSH_BATCH = 500
+# Most operations one ``apply`` call accepts.
+MAX_OPERATIONS = 100
+ACTIONS = ("add", "update", "remove", "clear")
+
+
+class InvalidCartOperation(ValueError):
+    """Raised when a batch holds an operation that cannot be applied."""
+
+
+@dataclass
+class CartLine:
+    id: int
+    product_id: int
+    quantity: int
+    selected_size: str
+    selected_color: str
+    product: Product = field(default=None, repr=False)
+
+
+@dataclass
+class CartOperation:
+    """One change in an ``apply`` batch.
+
+    ``add`` sets the quantity of a product/size/colour line, ``update`` sets
+    the quantity of line ``item_id`` (removing it at 0 or less), ``remove``
+    drops line ``item_id`` and ``clear`` empties the cart.
+    """
+
+    action: str
+    product_id: int = None
+    item_id: int = None
+    quantity: int = 1
+    selected_size: str = ""
+    selected_color: str = ""
+
+
+class DatabaseCartStore:
+    def lines(self, user):
+        items = CartItem.objects.filter(cart__user=user).select_related("product")
+        return [
+            CartLine(
+                id=item.id,
+                product_id=item.product_id,
+                quantity=item.quantity,
+                selected_size=item.selected_size,
+                selected_color=item.selected_color,
+                product=item.product,
+            )
+            for item in items.order_by("id")
+        ]
+
+    def add(self, user, product, quantity, selected_size, selected_color):
+        cart, _ = Cart.objects.get_or_create(user=user)
+        item, created = CartItem.objects.get_or_create(
+            cart=cart,
+            product=product,
+            selected_size=selected_size,
+            selected_color=selected_color,
+            defaults={"quantity": quantity},
+        )
+        if not created and item.quantity != quantity:
+            item.quantity = quantity
+            item.save(update_fields=["quantity"])
+        return item.id
+
+    def update(self, user, line_id, quantity):
+        items = CartItem.objects.filter(id=line_id, cart__user=user)
+        if quantity > 0:
+            return items.update(quantity=quantity) > 0
+        return items.delete()[0] > 0
+
+    def clear(self, user):
+        CartItem.objects.filter(cart__user=user).delete()
+
+    def apply(self, user, changes):
+        with transaction.atomic():
+            # Locking the cart row serialises batches for the same user.
+            cart, _ = Cart.objects.select_for_update().get_or_create(user=user)
+            items = {item.id: item for item in cart.items.all()}
+            quantities = {item.id: item.quantity for item in items.values()}
+            by_key = {
+                (item.product_id, item.selected_size, item.selected_color): item
+                for item in items.values()
+            }
+            missing = [
+                change[1]
+                for change in changes
+                if change[0] == "set" and change[1] not in items
+            ]
+            if missing:
+                raise InvalidCartOperation(f"Cart item {missing[0]} not found")
+
+            for change in changes:
+                if change[0] == "add":
+                    _, product, quantity, size, color = change
+                    key = (product.pk, size, color)
+                    if key not in by_key:
+                        by_key[key] = CartItem(
+                            cart=cart,
+                            product=product,
+                            selected_size=size,
+                            selected_color=color,
+                        )
+                    by_key[key].quantity = quantity
+                elif change[0] == "set":
+                    _, line_id, quantity = change
+                    item = items[line_id]
+                    key = (item.product_id, item.selected_size, item.selected_color)
+                    if quantity > 0 and by_key.get(key) is item:
+                        item.quantity = quantity
+                    elif by_key.get(key) is item:
+                        del by_key[key]
+                else:
+                    by_key.clear()
+
+            stale = items.keys() - {item.pk for item in by_key.values()}
+            if stale:
+                CartItem.objects.filter(pk__in=stale).delete()
+            changed = [
+                item
+                for item in by_key.values()
+                if item.pk and item.quantity != quantities[item.pk]
+            ]
+            CartItem.objects.bulk_update(changed, ["quantity"])
+            CartItem.objects.bulk_create(
+                [item for item in by_key.values() if not item.pk]
+            )
+
+
+# KEYS[1]: the cart hash, KEYS[2]: the dirty set.
+# ARGV: line key, quantity, TTL, user id. Returns the line id.
+ADD_SCRIPT = """
+local id = redis.call("HGET", KEYS[1], "key:" .. ARGV[1])
+if not id then
+    id = redis.call("HINCRBY", KEYS[1], "seq", 1)
+    redis.call("HSET", KEYS[1], "key:" .. ARGV[1], id, "line:" .. id, ARGV[1])
+end
+redis.call("HSET", KEYS[1], "qty:" .. id, ARGV[2])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("SADD", KEYS[2], ARGV[4])
+return tonumber(id)
+"""
+
+# ARGV: line id, quantity (0 removes the line), TTL, user id.
+# Returns 1, or 0 when the cart has no such line.
+UPDATE_SCRIPT = """
+local line = redis.call("HGET", KEYS[1], "line:" .. ARGV[1])
+if not line then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call("HSET", KEYS[1], "qty:" .. ARGV[1], ARGV[2])
+else
+    redis.call(
+        "HDEL", KEYS[1], "qty:" .. ARGV[1], "line:" .. ARGV[1], "key:" .. line
+    )
+end
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("SADD", KEYS[2], ARGV[4])
+return 1
+"""
+
+# ARGV: TTL, user id. Empties the cart but keeps its line id sequence.
+CLEAR_SCRIPT = """
+local seq = redis.call("HGET", KEYS[1], "seq") or 0
+redis.call("DEL", KEYS[1])
+redis.call("HSET", KEYS[1], "seq", seq)
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+redis.call("SADD", KEYS[2], ARGV[2])
+return 1
+"""
+
+# ARGV: TTL, user id, then (action, argument, quantity) for each change:
+# "add" with a line key, "set" with a line id, or "clear". Applies nothing
+# and returns the line ids the cart lacks if any "set" names one.
+APPLY_SCRIPT = """
+local missing = {}
+for i = 3, #ARGV, 3 do
+    if ARGV[i] == "set" then
+        if redis.call("HEXISTS", KEYS[1], "line:" .. ARGV[i + 1]) == 0 then
+            table.insert(missing, tonumber(ARGV[i + 1]))
+        end
+    end
+end
+if #missing > 0 then
+    return missing
+end
+for i = 3, #ARGV, 3 do
+    local action, arg, qty = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    if action == "add" then
+        local id = redis.call("HGET", KEYS[1], "key:" .. arg)
+        if not id then
+            id = redis.call("HINCRBY", KEYS[1], "seq", 1)
+            redis.call("HSET", KEYS[1], "key:" .. arg, id, "line:" .. id, arg)
+        end
+        redis.call("HSET", KEYS[1], "qty:" .. id, qty)
+    elseif action == "set" then
+        local line = redis.call("HGET", KEYS[1], "line:" .. arg)
+        if line and qty > 0 then
+            redis.call("HSET", KEYS[1], "qty:" .. arg, qty)
+        elseif line then
+            redis.call("HDEL", KEYS[1], "qty:" .. arg, "line:" .. arg, "key:" .. line)
+        end
+    else
+        local seq = redis.call("HGET", KEYS[1], "seq") or 0
+        redis.call("DEL", KEYS[1])
+        redis.call("HSET", KEYS[1], "seq", seq)
+    end
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+redis.call("SADD", KEYS[2], ARGV[2])
+return missing
+"""
+
+# KEYS[1]: the cart hash. ARGV: TTL, last line id, then (id, line key,
+# quantity) for each line. Only loads a cart that is not already in Redis.
+LOAD_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+redis.call("HSET", KEYS[1], "seq", ARGV[2])
+for i = 3, #ARGV, 3 do
+    redis.call(
+        "HSET", KEYS[1],
+        "line:" .. ARGV[i], ARGV[i + 1],
+        "key:" .. ARGV[i + 1], ARGV[i],
+        "qty:" .. ARGV[i], ARGV[i + 2]
+    )
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return 1
+"""
+
+
+_scripts = {}
+
+
+def _line_key(product_id, selected_size, selected_color):
+    return json.dumps([product_id, selected_size, selected_color])
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _parse_cart(raw):
+    """``{line id: (product_id, size, color, quantity)}`` from a cart hash."""
+    fields = {_decode(name): _decode(value) for name, value in raw.items()}
+    lines = {}
+    for name, value in fields.items():
+        if name.startswith("line:"):
+            line_id = int(name[5:])
+            quantity = fields.get(f"qty:{line_id}")
+            if quantity is not None:
+                product_id, size, color = json.loads(value)
+                lines[line_id] = (product_id, size, color, int(quantity))
+    return lines
+
+
+class RedisCartStore:
+    def __init__(self):
+        from django_redis import get_redis_connection
+
+        self.conn = get_redis_connection("default")
+
+    def _key(self, user):
+        return f"{KEY_PREFIX}:{user.pk}"
+
+    def _script(self, source):
+        if source not in _scripts:
+            _scripts[source] = self.conn.register_script(source)
+        return _scripts[source]
+
+    def _run(self, script, user, *args):
+        self._ensure_loaded(user)
+        result = self._script(script)(keys=[self._key(user), DIRTY_KEY], args=args)
+        schedule_flush()
+        return result
+
+    def _ensure_loaded(self, user):
+        key = self._key(user)
+        if self.conn.exists(key):
+            return
+        items = list(
+            CartItem.objects.filter(cart__user=user).values_list(
+                "id", "product_id", "selected_size", "selected_color", "quantity"
+            )
+        )
+        args = [CART_TTL, max((item[0] for item in items), default=0)]
+        for line_id, product_id, size, color, quantity in items:
+            args += [line_id, _line_key(product_id, size, color), quantity]
+        self._script(LOAD_SCRIPT)(keys=[key], args=args)
+
+    def lines(self, user):
+        self._ensure_loaded(user)
+        parsed = _parse_cart(self.conn.hgetall(self._key(user)))
+        products = Product.objects.in_bulk({line[0] for line in parsed.values()})
+        return [
+            CartLine(
+                id=line_id,
+                product_id=product_id,
+                quantity=quantity,
+                selected_size=size,
+                selected_color=color,
+                product=products[product_id],
+            )
+            for line_id, (product_id, size, color, quantity) in sorted(parsed.items())
+            if product_id in products
+        ]
+
+    def add(self, user, product, quantity, selected_size, selected_color):
+        line_key = _line_key(product.pk, selected_size, selected_color)
+        return self._run(ADD_SCRIPT, user, line_key, quantity, CART_TTL, user.pk)
+
+    def update(self, user, line_id, quantity):
+        args = (line_id, max(quantity, 0), CART_TTL, user.pk)
+        return bool(self._run(UPDATE_SCRIPT, user, *args))
+
+    def clear(self, user):
+        self._run(CLEAR_SCRIPT, user, CART_TTL, user.pk)
+
+    def apply(self, user, changes):
+        args = [CART_TTL, user.pk]
+        for change in changes:
+            if change[0] == "add":
+                _, product, quantity, size, color = change
+                args += ["add", _line_key(product.pk, size, color), quantity]
+            elif change[0] == "set":
+                args += ["set", change[1], max(change[2], 0)]
+            else:
+                args += ["clear", "", 0]
+        missing = self._run(APPLY_SCRIPT, user, *args)
+        if missing:
+            raise InvalidCartOperation(f"Cart item {missing[0]} not found")
+
+
+def _uses_redis():
+    return "django_redis" in settings.CACHES["default"]["BACKEND"]
+
+
+def _flush_delay():
+    return getattr(settings, "CART_FLUSH_DELAY", 5)
+
+
+def get_store():
+    if getattr(settings, "CART_BACKEND", "database") == "redis" and _uses_redis():
+        return RedisCartStore()
+    return DatabaseCartStore()
+
+
+def _changed(user):
+    """Move the cart's version (its ``cart:{id}`` tag) once the change commits."""
+    transaction.on_commit(partial(invalidate_tags, f"cart:{user.pk}"))
+
+
+def lines(user):
+    """The user's cart lines, oldest first, with ``product`` loaded."""
+    return get_store().lines(user)
+
+
+def add(user, product, quantity, selected_size="", selected_color=""):
+    """Set the quantity of a product/size/colour line; returns the line id."""
+    line_id = get_store().add(user, product, quantity, selected_size, selected_color)
+    _changed(user)
+    return line_id
+
+
+def update(user, line_id, quantity):
+    """Set a line's quantity (removing it when ``quantity`` <= 0).
+
+    Returns False when the user's cart has no such line.
+    """
+    found = get_store().update(user, line_id, quantity)
+    if found:
+        _changed(user)
+    return found
+
+
+def remove(user, line_id):
+    return update(user, line_id, 0)
+
+
+def clear(user):
+    get_store().clear(user)
+    _changed(user)
+
+
+def _changes(operations):
+    """Validate ``operations`` and turn them into store changes."""
+    if len(operations) > MAX_OPERATIONS:
+        raise InvalidCartOperation(
+            f"At most {MAX_OPERATIONS} operations can be applied at once"
+        )
+    products = Product.objects.in_bulk(
+        {op.product_id for op in operations if op.action == "add"}
+    )
+    changes = []
+    for index, op in enumerate(operations):
+        if op.action not in ACTIONS:
+            raise InvalidCartOperation(f"Operation {index}: unknown action")
+        if op.action == "add":
+            product = products.get(op.product_id)
+            if product is None:
+                raise InvalidCartOperation(f"Operation {index}: product not found")
+            if op.quantity < 1:
+                raise InvalidCartOperation(
+                    f"Operation {index}: quantity must be at least 1"
+                )
+            if op.selected_size and op.selected_size not in product.sizes:
+                raise InvalidCartOperation(
+                    f"Operation {index}: invalid size {op.selected_size}"
+                )
+            if op.selected_color and op.selected_color not in product.colors:
+                raise InvalidCartOperation(
+                    f"Operation {index}: invalid color {op.selected_color}"
+                )
+            changes.append(
+                ("add", product, op.quantity, op.selected_size, op.selected_color)
+            )
+        elif op.action == "clear":
+            changes.append(("clear",))
+        elif op.item_id is None:
+            raise InvalidCartOperation(f"Operation {index}: item_id is required")
+        else:
+            quantity = op.quantity if op.action == "update" else 0
+            changes.append(("set", op.item_id, quantity))
+    return changes
+
+
+def apply(user, operations):
+    """Apply a list of ``CartOperation`` together; returns the new lines.
+
+    Products are loaded once and the cart is written in bulk. Either every
+    operation is applied or, if any is invalid, none is and
+    ``InvalidCartOperation`` is raised.
+    """
+    changes = _changes(operations)
+    store = get_store()
+    if changes:
+        store.apply(user, changes)
+        _changed(user)
+    return store.lines(user)
+
+
+def schedule_flush():
+    """Queue one delayed flush for all carts changed in the next few seconds."""
+    delay = _flush_delay()
+    if cache.add(FLUSH_SCHEDULED_KEY, 1, delay):
+        jobs.enqueue("carts.flush", delay=delay)
+
+
+def persist(snapshots):
+    """Make the database match ``{user_id: {(product_id, size, color): qty}}``.
+
+    Each listed user's ``CartItem`` rows are replaced by exactly those lines,
+    with one query per kind of change however many carts are written.
+    """
+    user_ids = set(User.objects.filter(pk__in=snapshots).values_list("pk", flat=True))
+    product_ids = set(
+        Product.objects.filter(
+            pk__in={line[0] for lines in snapshots.values() for line in lines}
+        ).values_list("pk", flat=True)
+    )
+    wanted = {
+        (user_id, *line): quantity
+        for user_id, lines in snapshots.items()
+        if user_id in user_ids
+        for line, quantity in lines.items()
+        if line[0] in product_ids
+    }
+
+    with transaction.atomic():
+        existing = set(
+            Cart.objects.filter(user_id__in=user_ids).values_list("user_id", flat=True)
+        )
+        if user_ids - existing:
+            Cart.objects.bulk_create(
+                [Cart(user_id=user_id) for user_id in user_ids - existing],
+                ignore_conflicts=True,
+            )
+        carts = {
+            cart.user_id: cart for cart in Cart.objects.filter(user_id__in=user_ids)
+        }
+        owners = {cart.pk: user_id for user_id, cart in carts.items()}
+        current = {
+            (
+                owners[item.cart_id],
+                item.product_id,
+                item.selected_size,
+                item.selected_color,
+            ): item
+            for item in CartItem.objects.filter(cart__in=carts.values())
+        }
+
+        stale = [item.pk for key, item in current.items() if key not in wanted]
+        changed, new = [], []
+        for key, quantity in wanted.items():
+            item = current.get(key)
+            if item is None:
+                user_id, product_id, size, color = key
+                new.append(
+                    CartItem(
+                        cart=carts[user_id],
+                        product_id=product_id,
+                        selected_size=size,
+                        selected_color=color,
+                        quantity=quantity,
+                    )
+                )
+            elif item.quantity != quantity:
+                item.quantity = quantity
+                changed.append(item)
+
+        CartItem.objects.filter(pk__in=stale).delete()
+        CartItem.objects.bulk_update(changed, ["quantity"])
+        CartItem.objects.bulk_create(new)
+        Cart.objects.filter(pk__in=owners).update(updated_at=timezone.now())
+    return len(user_ids)
+
+
+@jobs.handler("carts.flush")
+def flush(limit=FLUSH_BATCH):
+    """Write changed Redis carts to the database; returns how many."""
+    store = get_store()
+    if not isinstance(store, RedisCartStore):
+        return 0
+    conn = store.conn
+    flushed = 0
+    while True:
+        user_ids = [int(_decode(uid)) for uid in conn.spop(DIRTY_KEY, limit) or []]
+        if not user_ids:
+            return flushed
+        pipe = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(f"{KEY_PREFIX}:{user_id}")
+        snapshots = {
+            user_id: {
+                (product_id, size, color): quantity
+                for product_id, size, color, quantity in _parse_cart(raw).values()
+            }
+            for user_id, raw in zip(user_ids, pipe.execute())
+            # An expired cart was persisted before it expired.
+            if raw
+        }
+        try:
+            flushed += persist(snapshots)
+        except Exception as exc:
+            logger.warning("Cart flush failed for %d carts: %s", len(user_ids), exc)
+            conn.sadd(DIRTY_KEY, *user_ids)
+            raise
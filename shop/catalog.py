@@ -0,0 +1,122 @@
+"""Catalog listing helpers shared by the REST and GraphQL product endpoints.
+
+Listings are ordered by ``(-created_at, -id)`` and paginated with an opaque
+keyset cursor, so every page is a bounded index range scan no matter how
+deep the client has paged.
+"""
+
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+TRUE_VALUES = {"1", "true", "yes", "on"}
+FALSE_VALUES = {"0", "false", "no", "off"}
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+class InvalidFilter(ValueError):
+    """Raised when a listing filter value cannot be parsed."""
+
+
+def encode_cursor(product):
+    payload = json.dumps([product.created_at.isoformat(), product.id])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, product_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(product_id)
+    except (ValueError, TypeError) as exc:
+        raise InvalidCursor("Invalid pagination cursor") from exc
+
+
+def parse_bool(value):
+    """Parse an optional boolean query parameter (``None`` means unset)."""
+    if value is None or value == "":
+        return None
+    lowered = str(value).strip().lower()
+    if lowered in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
+    raise InvalidFilter(f"Invalid boolean value: {value}")
+
+
+def parse_price(value):
+    if value is None or value == "":
+        return None
+    try:
+        price = Decimal(str(value))
+    except InvalidOperation as exc:
+        raise InvalidFilter(f"Invalid price: {value}") from exc
+    if price < 0:
+        raise InvalidFilter("Price must not be negative")
+    return price
+
+
+def clamp_page_size(value, default=DEFAULT_PAGE_SIZE):
+    if value is None or value == "":
+        return default
+    try:
+        size = int(value)
+    except (TypeError, ValueError) as exc:
+        raise InvalidFilter(f"Invalid page size: {value}") from exc
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def filter_products(
+    queryset,
+    category=None,
+    in_stock=None,
+    on_sale=None,
+    is_new=None,
+    min_price=None,
+    max_price=None,
+):
+    """Apply the catalog filters; ``None`` leaves a filter unset.
+
+    Price bounds apply to the stored price in the product's own currency.
+    """
+    if category:
+        queryset = queryset.filter(category__slug=category)
+    if in_stock is not None:
+        queryset = queryset.filter(in_stock=in_stock)
+    if on_sale is not None:
+        queryset = queryset.filter(on_sale=on_sale)
+    if is_new is not None:
+        queryset = queryset.filter(is_new=is_new)
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+    return queryset
+
+
+def paginate_products(queryset, first=DEFAULT_PAGE_SIZE, after=None):
+    """Return ``(products, next_cursor)`` for one keyset page.
+
+    ``next_cursor`` is ``None`` on the last page.
+    """
+    queryset = queryset.order_by("-created_at", "-id")
+    if after:
+        created_at, product_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=product_id)
+        )
+
+    page = list(queryset[: first + 1])
+    if len(page) <= first:
+        return page, None
+    page = page[:first]
+    return page, encode_cursor(page[-1])
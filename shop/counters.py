@@ -0,0 +1,198 @@
+"""Hourly and daily event counters for what the daily rollups do not track.
+
+That is registrations, and logins per hour; orders, revenue and daily logins
+are counted once, by ``shop.rollups``.
+
+With Redis configured, ``incr`` is a single pipelined round trip into one
+hash per bucket (``arnova:counters:hour:2026101814`` with a field per
+event); ``flush`` moves those hashes into ``EventCounter`` rows. The first
+increment after a flush queues one delayed ``counters.flush`` job, so
+buckets reach the database within ``COUNTER_FLUSH_INTERVAL`` seconds
+(``manage.py flush_counters`` does the same on demand). Reads merge the stored rows
+with whatever has not been flushed yet, so a series of N buckets costs one
+query and one pipeline regardless of traffic. Without Redis (or when it is
+unreachable) the counters are written straight to the database.
+"""
+
+import logging
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import jobs
+from .models import EventCounter
+
+logger = logging.getLogger("shop")
+
+KEY_PREFIX = "arnova:counters"
+PENDING_KEY = f"{KEY_PREFIX}:pending"
+FLUSH_SCHEDULED_KEY = f"{KEY_PREFIX}:flush_scheduled"
+# Unflushed buckets are dropped after this long rather than kept forever.
+BUCKET_TTL = 30 * 24 * 3600
+GRANULARITIES = ("hour", "day")
+# Redis hashes hold integers, so fractional counters are stored scaled.
+SCALES = {"revenue": 100}
+
+
+def bucket_start(moment, granularity):
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def _step(granularity):
+    return timedelta(hours=1) if granularity == "hour" else timedelta(days=1)
+
+
+def _bucket_key(granularity, bucket):
+    fmt = "%Y%m%d%H" if granularity == "hour" else "%Y%m%d"
+    return f"{KEY_PREFIX}:{granularity}:{bucket.strftime(fmt)}"
+
+
+def _parse_key(key):
+    _, _, granularity, stamp = key.split(":")[:4]
+    fmt = "%Y%m%d%H" if granularity == "hour" else "%Y%m%d"
+    return granularity, timezone.make_aware(datetime.strptime(stamp, fmt))
+
+
+def _to_raw(name, value):
+    return int(Decimal(str(value)) * SCALES.get(name, 1))
+
+
+def _from_raw(name, raw):
+    return Decimal(int(raw)) / SCALES.get(name, 1)
+
+
+def _uses_redis():
+    return "django_redis" in settings.CACHES["default"]["BACKEND"]
+
+
+def _redis():
+    from django_redis import get_redis_connection
+
+    return get_redis_connection("default")
+
+
+def _flush_interval():
+    return getattr(settings, "COUNTER_FLUSH_INTERVAL", 300)
+
+
+def schedule_flush():
+    """Queue one delayed flush for all counters bumped in the next interval."""
+    interval = _flush_interval()
+    if cache.add(FLUSH_SCHEDULED_KEY, 1, interval):
+        jobs.enqueue("counters.flush", delay=interval)
+
+
+def _add_to_rows(granularity, bucket, values):
+    for name, value in values.items():
+        lookup = {"name": name, "granularity": granularity, "bucket": bucket}
+        EventCounter.objects.get_or_create(**lookup)
+        EventCounter.objects.filter(**lookup).update(value=F("value") + value)
+
+
+def incr(counts, at=None, granularities=GRANULARITIES):
+    """Add ``counts`` such as ``{"registrations": 1}`` to the hour and day buckets.
+
+    ``granularities`` limits which of the two buckets are counted.
+    """
+    at = at or timezone.now()
+    buckets = [(g, bucket_start(at, g)) for g in granularities]
+    if _uses_redis():
+        try:
+            pipe = _redis().pipeline(transaction=False)
+            for granularity, bucket in buckets:
+                key = _bucket_key(granularity, bucket)
+                for name, value in counts.items():
+                    pipe.hincrby(key, name, _to_raw(name, value))
+                pipe.expire(key, BUCKET_TTL)
+                pipe.sadd(PENDING_KEY, key)
+            pipe.execute()
+        except Exception as exc:
+            logger.warning("Event counter update failed for %s: %s", counts, exc)
+        else:
+            schedule_flush()
+            return
+    with transaction.atomic():
+        for granularity, bucket in buckets:
+            _add_to_rows(granularity, bucket, counts)
+
+
+@jobs.handler("counters.flush")
+def flush():
+    """Move unflushed Redis buckets into ``EventCounter``; returns how many."""
+    if not _uses_redis():
+        return 0
+    conn = _redis()
+    flushed = 0
+    for key in conn.smembers(PENDING_KEY):
+        key = key.decode() if isinstance(key, bytes) else key
+        # Forget the key before renaming it: an increment in between re-adds
+        # it, so nothing written after the rename is left behind.
+        conn.srem(PENDING_KEY, key)
+        staging = f"{key}:flushing:{uuid.uuid4().hex}"
+        try:
+            conn.rename(key, staging)
+        except Exception:
+            continue  # Already flushed (or expired) by someone else.
+        raw = conn.hgetall(staging)
+        values = {
+            name.decode(): _from_raw(name.decode(), count)
+            for name, count in raw.items()
+        }
+        granularity, bucket = _parse_key(key)
+        try:
+            with transaction.atomic():
+                _add_to_rows(granularity, bucket, values)
+        except Exception as exc:
+            logger.warning("Event counter flush failed for %s: %s", key, exc)
+            pipe = conn.pipeline(transaction=False)
+            for name, count in raw.items():
+                pipe.hincrby(key, name, int(count))
+            pipe.sadd(PENDING_KEY, key)
+            pipe.execute()
+        else:
+            flushed += 1
+        conn.delete(staging)
+    return flushed
+
+
+def series(names, granularity="day", count=7, end=None):
+    """The last ``count`` buckets up to ``end`` (default now), newest first.
+
+    Each entry is ``{"bucket": datetime, name: Decimal, ...}``.
+    """
+    last = bucket_start(end or timezone.now(), granularity)
+    step = _step(granularity)
+    buckets = [last - step * offset for offset in range(count)]
+    totals = {bucket: dict.fromkeys(names, Decimal(0)) for bucket in buckets}
+
+    rows = EventCounter.objects.filter(
+        name__in=names,
+        granularity=granularity,
+        bucket__gte=buckets[-1],
+        bucket__lte=last,
+    )
+    for row in rows:
+        totals[row.bucket][row.name] += row.value
+
+    if _uses_redis():
+        try:
+            pipe = _redis().pipeline(transaction=False)
+            for bucket in buckets:
+                pipe.hmget(_bucket_key(granularity, bucket), *names)
+            for bucket, pending in zip(buckets, pipe.execute()):
+                for name, raw in zip(names, pending):
+                    if raw is not None:
+                        totals[bucket][name] += _from_raw(name, raw)
+        except Exception as exc:
+            logger.warning("Unflushed event counters unavailable: %s", exc)
+
+    return [{"bucket": bucket, **totals[bucket]} for bucket in buckets]
@@ -0,0 +1,200 @@
+"""Exchange-rate tables cached in Redis and process memory.
+
+Each base currency's rate table is fetched from exchangerate-api.com once,
+stored in the shared cache and in a per-process snapshot, and refreshed in a
+background thread shortly before it goes stale. Request handlers only ever
+read the snapshot, so converting a whole catalog costs no outbound I/O.
+
+Only ``SUPPORTED_CURRENCIES`` are fetched, and a failed fetch is not retried
+until a backoff (doubling per consecutive failure) has passed, so unknown or
+failing bases cannot turn requests into a stream of upstream calls. With
+``EXCHANGE_RATE_ONLINE`` off nothing is fetched in the background.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import outbound
+
+logger = logging.getLogger("shop")
+
+RATES_URL = "https://api.exchangerate-api.com/v4/latest/{base}"
+CACHE_KEY = "fx_rates:{base}"
+FAILURE_KEY = "fx_rates:{base}:failed"
+# A failed refresh waits this long before the next try, doubling each time.
+RETRY_BACKOFF = 60
+MAX_RETRY_BACKOFF = 3600
+
+# Used until the first successful fetch for a base currency lands.
+FALLBACK_RATES = {
+    "USD": {"USD": 1.0, "KES": 150.0, "EUR": 0.85},
+    "KES": {"KES": 1.0, "USD": 0.0067, "EUR": 0.0057},
+    "EUR": {"EUR": 1.0, "USD": 1.18, "KES": 175.0},
+}
+
+SUPPORTED_CURRENCIES = frozenset(FALLBACK_RATES)
+
+
+class UnsupportedCurrency(ValueError):
+    pass
+
+
+def normalize_currency(code):
+    """``code`` upper-cased; raises ``UnsupportedCurrency`` if it is not served."""
+    code = (code or "").upper()
+    if code not in SUPPORTED_CURRENCIES:
+        supported = ", ".join(sorted(SUPPORTED_CURRENCIES))
+        raise UnsupportedCurrency(f"Unsupported currency; use one of {supported}")
+    return code
+
+
+_snapshots = {}
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def _ttl():
+    return getattr(settings, "EXCHANGE_RATE_TTL", 3600)
+
+
+def _refresh_margin():
+    return getattr(settings, "EXCHANGE_RATE_REFRESH_MARGIN", 300)
+
+
+def _fallback_table(base):
+    return dict(FALLBACK_RATES.get(base, {base: 1.0}))
+
+
+def fetch_rate_table(base):
+    """Fetch the latest rate table for ``base`` from the upstream API."""
+    response = outbound.get(RATES_URL.format(base=base))
+    response.raise_for_status()
+    rates = response.json().get("rates") or {}
+    rates[base] = 1.0
+    return {str(code): float(rate) for code, rate in rates.items()}
+
+
+def store_rate_table(base, rates, fetched_at=None):
+    """Publish a rate table to the shared cache and the local snapshot."""
+    if fetched_at is None:
+        fetched_at = time.time()
+    entry = {"rates": rates, "fetched_at": fetched_at}
+    # Keep the shared copy well past its TTL so a failing upstream degrades
+    # to slightly old rates instead of the hardcoded fallback table.
+    cache.set(CACHE_KEY.format(base=base), entry, timeout=_ttl() * 24)
+    with _lock:
+        _snapshots[base] = entry
+    return entry
+
+
+def _record_failure(base):
+    key = FAILURE_KEY.format(base=base)
+    try:
+        failures = (cache.get(key) or {}).get("failures", 0) + 1
+        backoff = min(RETRY_BACKOFF * 2 ** (failures - 1), MAX_RETRY_BACKOFF)
+        cache.set(
+            key,
+            {"failures": failures, "retry_at": time.time() + backoff},
+            timeout=MAX_RETRY_BACKOFF * 2,
+        )
+    except Exception as exc:
+        logger.warning("Exchange rate cache write failed for %s: %s", base, exc)
+
+
+def _backing_off(base):
+    try:
+        failure = cache.get(FAILURE_KEY.format(base=base))
+    except Exception as exc:
+        logger.warning("Exchange rate cache read failed for %s: %s", base, exc)
+        return False
+    return failure is not None and failure["retry_at"] > time.time()
+
+
+def refresh_rate_table(base):
+    """Fetch and store the table for ``base``; keep the old one on failure."""
+    try:
+        entry = store_rate_table(base, fetch_rate_table(base))
+        cache.delete(FAILURE_KEY.format(base=base))
+        return entry
+    except Exception as exc:
+        logger.warning("Exchange rate refresh failed for %s: %s", base, exc)
+        _record_failure(base)
+        return None
+
+
+def _refresh_in_background(base):
+    if not getattr(settings, "EXCHANGE_RATE_ONLINE", True):
+        return
+    if base not in SUPPORTED_CURRENCIES or _backing_off(base):
+        return
+    with _lock:
+        if base in _refreshing:
+            return
+        _refreshing.add(base)
+
+    def run():
+        try:
+            refresh_rate_table(base)
+        finally:
+            with _lock:
+                _refreshing.discard(base)
+
+    threading.Thread(target=run, name=f"fx-refresh-{base}", daemon=True).start()
+
+
+def _is_ageing(entry):
+    return time.time() - entry["fetched_at"] >= _ttl() - _refresh_margin()
+
+
+def _read_shared(base):
+    try:
+        return cache.get(CACHE_KEY.format(base=base))
+    except Exception as exc:
+        logger.warning("Exchange rate cache read failed for %s: %s", base, exc)
+        return None
+
+
+def get_rate_table(base):
+    """Return the cached ``{currency: rate}`` table for ``base``.
+
+    Never blocks on the upstream API: a missing or ageing table schedules a
+    background refresh and the best available snapshot is returned meanwhile.
+    """
+    base = (base or "").upper()
+    with _lock:
+        entry = _snapshots.get(base)
+
+    if entry is None or _is_ageing(entry):
+        # Another process may already have refreshed the shared entry.
+        shared = _read_shared(base)
+        if shared is not None and (
+            entry is None or shared["fetched_at"] > entry["fetched_at"]
+        ):
+            entry = shared
+            with _lock:
+                _snapshots[base] = entry
+
+    if entry is None:
+        _refresh_in_background(base)
+        return _fallback_table(base)
+
+    if _is_ageing(entry):
+        _refresh_in_background(base)
+    return entry["rates"]
+
+
+def get_rate(from_currency, to_currency):
+    """Rate to multiply an amount in ``from_currency`` by."""
+    if from_currency == to_currency:
+        return 1.0
+    return float(get_rate_table(from_currency).get(to_currency, 1.0))
+
+
+def clear_snapshots():
+    """Drop the in-process snapshots (the shared cache is left untouched)."""
+    with _lock:
+        _snapshots.clear()
@@ -0,0 +1,199 @@
+"""Coordinates for profile locations without per-request network calls.
+
+Places are matched on a normalized ``(city, country)`` key: first against
+the bundled gazetteer (``data/gazetteer.csv``), then against the
+``GeocodeCache`` table. Anything still unknown is queued for a background
+Nominatim lookup whose result is stored for good, so building the admin
+location map costs one query per dashboard load regardless of user count.
+"""
+
+import csv
+import logging
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+from . import outbound
+from .models import GeocodeCache
+
+logger = logging.getLogger("shop")
+
+GAZETTEER_PATH = Path(__file__).resolve().parent / "data" / "gazetteer.csv"
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+# Nominatim's usage policy allows at most one request per second.
+NOMINATIM_INTERVAL = 1.0
+
+COUNTRY_ALIASES = {
+    "usa": "united states",
+    "us": "united states",
+    "united states of america": "united states",
+    "uk": "united kingdom",
+    "great britain": "united kingdom",
+    "england": "united kingdom",
+    "scotland": "united kingdom",
+    "uae": "united arab emirates",
+    "drc": "dr congo",
+    "democratic republic of the congo": "dr congo",
+    "cote d'ivoire": "ivory coast",
+    "ke": "kenya",
+    "ug": "uganda",
+    "tz": "tanzania",
+}
+
+_gazetteer = None
+_pending = set()
+_worker = None
+_lock = threading.Lock()
+
+
+def _online():
+    return getattr(settings, "GEOCODING_ONLINE", True)
+
+
+def _fold(value):
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(ch for ch in value if not unicodedata.combining(ch))
+    return " ".join(value.replace(".", " ").casefold().split())
+
+
+def normalize(city, country):
+    """Return the ``(city_key, country_key)`` a place is stored under."""
+    country_key = _fold(country)
+    return _fold(city), COUNTRY_ALIASES.get(country_key, country_key)
+
+
+def gazetteer():
+    """The bundled ``{(city_key, country_key): (lat, lng)}`` table."""
+    global _gazetteer
+    if _gazetteer is None:
+        table = {}
+        with open(GAZETTEER_PATH, newline="", encoding="utf-8") as fh:
+            for row in csv.DictReader(fh):
+                key = normalize(row["city"], row["country"])
+                table[key] = (float(row["latitude"]), float(row["longitude"]))
+        _gazetteer = table
+    return _gazetteer
+
+
+def _cached(keys):
+    rows = GeocodeCache.objects.filter(
+        city_key__in={city for city, _ in keys},
+        country_key__in={country for _, country in keys},
+    )
+    return {
+        (row.city_key, row.country_key): row
+        for row in rows
+        if (row.city_key, row.country_key) in keys
+    }
+
+
+def locate_many(places):
+    """Map each ``(city, country)`` in ``places`` to ``(lat, lng)`` or None.
+
+    Never performs network I/O: unknown places come back as None and are
+    queued for a background lookup.
+    """
+    keys = {place: normalize(*place) for place in set(places) if all(place)}
+    table = gazetteer()
+    found = {key: table[key] for key in keys.values() if key in table}
+
+    missing = {key for key in keys.values() if key not in found}
+    if missing:
+        for key, row in _cached(missing).items():
+            missing.discard(key)
+            if row.latitude is not None:
+                found[key] = (row.latitude, row.longitude)
+        if missing:
+            schedule(missing)
+
+    return {place: found.get(key) for place, key in keys.items()}
+
+
+def uncached(places, retry_unresolved=False):
+    """Normalized keys for ``places`` that neither table can answer."""
+    table = gazetteer()
+    keys = {normalize(*place) for place in places if all(place)} - table.keys()
+    cached = _cached(keys) if keys else {}
+    return {
+        key
+        for key in keys
+        if key not in cached or (retry_unresolved and cached[key].latitude is None)
+    }
+
+
+def fetch_coordinates(city_key, country_key):
+    """Ask Nominatim for a place; returns ``(lat, lng)`` or None."""
+    response = outbound.get(
+        NOMINATIM_URL,
+        params={"city": city_key, "country": country_key, "format": "json"},
+        headers={"User-Agent": "Arnova-App/1.0"},
+    )
+    response.raise_for_status()
+    results = response.json()
+    if not results:
+        return None
+    return float(results[0]["lat"]), float(results[0]["lon"])
+
+
+def resolve(keys):
+    """Look up and store ``keys`` one at a time; returns how many resolved."""
+    resolved = 0
+    for index, (city_key, country_key) in enumerate(sorted(keys)):
+        if index:
+            time.sleep(NOMINATIM_INTERVAL)
+        try:
+            coordinates = fetch_coordinates(city_key, country_key)
+        except Exception as exc:
+            # Leave the place uncached so a later load retries it.
+            logger.warning(
+                "Geocoding failed for %s, %s: %s", city_key, country_key, exc
+            )
+            continue
+        latitude, longitude = coordinates or (None, None)
+        GeocodeCache.objects.update_or_create(
+            city_key=city_key,
+            country_key=country_key,
+            defaults={
+                "latitude": latitude,
+                "longitude": longitude,
+                "source": "nominatim" if coordinates else "unresolved",
+            },
+        )
+        resolved += coordinates is not None
+    return resolved
+
+
+def _drain():
+    global _worker
+    try:
+        while True:
+            with _lock:
+                if not _pending:
+                    _worker = None
+                    return
+                batch = set(_pending)
+                _pending.clear()
+            resolve(batch)
+    except Exception as exc:
+        logger.warning("Background geocoding stopped: %s", exc)
+        with _lock:
+            _worker = None
+    finally:
+        connections.close_all()
+
+
+def schedule(keys):
+    """Queue normalized keys for a background lookup (one worker at a time)."""
+    global _worker
+    if not _online():
+        return
+    with _lock:
+        _pending.update(keys)
+        if _worker is not None:
+            return
+        _worker = threading.Thread(target=_drain, name="geocoder", daemon=True)
+        _worker.start()
@@ -1,15 +1,69 @@
 import datetime as dt
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional
 
 import jwt
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+
+logger = logging.getLogger("shop")
 
 JWT_ALGORITHM = getattr(settings, "JWT_ALGORITHM", "HS256")
 ACCESS_TTL_MINUTES = getattr(settings, "JWT_ACCESS_TTL_MINUTES", 15)
 REFRESH_TTL_DAYS = getattr(settings, "JWT_REFRESH_TTL_DAYS", 7)
 
+USER_CACHE_KEY = "auth_user:{id}"
+# Every User column but the password, in model order (``Model.from_db``
+# expects that). Snapshots leave the password deferred, so ``save()`` on one
+# only writes these columns and never touches it.
+USER_SNAPSHOT_FIELDS = tuple(
+    field.attname for field in User._meta.concrete_fields if field.attname != "password"
+)
+
+
+class VerifiedTokens:
+    """LRU of decoded access tokens keyed by token hash, valid until ``exp``."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                return None
+            if payload["exp"] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload):
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+verified_tokens = VerifiedTokens(getattr(settings, "JWT_VERIFIED_CACHE_SIZE", 1024))
+
+
+def _user_cache_ttl():
+    return getattr(settings, "AUTH_USER_CACHE_TTL", 60)
+
 
 def _jwt_secret() -> str:
     return getattr(settings, "JWT_SECRET", settings.SECRET_KEY)
@@ -45,14 +99,55 @@ def decode_token(token: str) -> Optional[dict]:
         return None
 
 
-def get_user_from_token(token: str) -> User | AnonymousUser:
+def verify_access_token(token: str) -> Optional[dict]:
+    """Decode an access token, skipping the signature check for tokens
+    already verified by this process."""
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    payload = verified_tokens.get(digest)
+    if payload is not None:
+        return payload
     payload = decode_token(token)
-    if not payload or payload.get("type") != "access":
+    if not payload or payload.get("type") != "access" or "exp" not in payload:
+        return None
+    verified_tokens.set(digest, payload)
+    return payload
+
+
+def get_cached_user(user_id) -> User | None:
+    """An active user's snapshot, from the shared cache when possible."""
+    key = USER_CACHE_KEY.format(id=user_id)
+    try:
+        values = cache.get(key)
+    except Exception as exc:
+        logger.warning("User cache read failed for %s: %s", key, exc)
+        values = None
+    if values is None:
+        values = (
+            User.objects.filter(id=user_id, is_active=True)
+            .values_list(*USER_SNAPSHOT_FIELDS)
+            .first()
+        )
+        if values is None:
+            return None
+        try:
+            cache.set(key, values, _user_cache_ttl())
+        except Exception as exc:
+            logger.warning("User cache write failed for %s: %s", key, exc)
+    return User.from_db("default", USER_SNAPSHOT_FIELDS, values)
+
+
+def forget_user(user_id) -> None:
+    cache.delete(USER_CACHE_KEY.format(id=user_id))
+
+
+def get_user_from_token(token: str) -> User | AnonymousUser:
+    payload = verify_access_token(token)
+    if not payload:
         return AnonymousUser()
     user_id = payload.get("sub")
     if not user_id:
         return AnonymousUser()
-    return User.objects.filter(id=user_id).first() or AnonymousUser()
+    return get_cached_user(user_id) or AnonymousUser()
 
 
 def authenticate_credentials(username_or_email: str, password: str) -> User | None:
@@ -1,14 +1,17 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import AnonymousUser
 
 from .auth import get_user_from_token
+from .loaders import Loaders
 
 
 @dataclass
 class GraphQLContext:
     request: object
     user: object
+    loaders: Loaders = field(default_factory=Loaders)
 
 
 def get_context(request, response=None) -> GraphQLContext:
@@ -23,3 +26,8 @@ def get_context(request, response=None) -> GraphQLContext:
         if not getattr(user, "is_authenticated", False):
             user = AnonymousUser()
     return GraphQLContext(request=request, user=user)
+
+
+async def get_async_context(request, response=None) -> GraphQLContext:
+    # Token and session lookups hit the database.
+    return await sync_to_async(get_context)(request, response)
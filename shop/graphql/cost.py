@@ -0,0 +1,236 @@
+"""Static cost analysis for GraphQL operations.
+
+Each field costs its weight plus the cost of its selection, multiplied by
+the number of items it can return when it is a list. The cost is computed
+from the validated document before any resolver runs: operations over
+GRAPHQL_MAX_QUERY_COST are rejected outright, and every client draws from a
+per-window budget (GRAPHQL_COST_BUDGET) so a stream of individually cheap
+operations cannot pin workers either. The result is reported under
+``extensions.cost`` in every response.
+"""
+
+from __future__ import annotations
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from graphql import (
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLList,
+    GraphQLNonNull,
+    InlineFragmentNode,
+    IntValueNode,
+    OperationDefinitionNode,
+    VariableNode,
+    get_named_type,
+    is_leaf_type,
+)
+from strawberry.extensions import SchemaExtension
+
+logger = logging.getLogger("shop")
+
+# Items assumed for a list field that has no ``limit``/``first`` argument.
+DEFAULT_LIST_SIZE = 20
+PAGE_SIZE_ARGS = ("limit", "first")
+
+# Per-item weights for fields that do more work than loading a row. Object
+# fields default to 1, scalars to 0 and mutations to MUTATION_WEIGHT.
+FIELD_WEIGHTS = {
+    "Query.adminAnalytics": 200,
+    "Query.mpesaStatus": 50,
+    "Query.searchProducts": 20,
+    "Mutation.processPayment": 50,
+    "Mutation.cartApply": 20,
+    "Mutation.login": 20,
+    "Mutation.register": 20,
+}
+MUTATION_WEIGHT = 10
+
+# Expected sizes of lists that are not paginated.
+LIST_SIZES = {
+    "Query.products": 100,
+    "Query.categories": 20,
+}
+
+
+def _max_cost():
+    return getattr(settings, "GRAPHQL_MAX_QUERY_COST", 2000)
+
+
+def _budget():
+    return getattr(settings, "GRAPHQL_COST_BUDGET", 20000)
+
+
+def _budget_window():
+    return getattr(settings, "GRAPHQL_COST_BUDGET_WINDOW", 60)
+
+
+def _is_list(type_):
+    if isinstance(type_, GraphQLNonNull):
+        type_ = type_.of_type
+    return isinstance(type_, GraphQLList)
+
+
+def _int_argument(node, names, variables):
+    for argument in node.arguments:
+        if argument.name.value not in names:
+            continue
+        value = argument.value
+        if isinstance(value, VariableNode):
+            value = variables.get(value.name.value)
+        elif isinstance(value, IntValueNode):
+            value = int(value.value)
+        if isinstance(value, int):
+            return max(value, 0)
+    return None
+
+
+class _CostCalculator:
+    def __init__(self, schema, fragments, variables):
+        self.schema = schema
+        self.fragments = fragments
+        self.variables = variables or {}
+
+    def selection_set(self, parent_type, selection_set, page_size=None):
+        total = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                total += self.field(parent_type, selection, page_size)
+            elif isinstance(selection, InlineFragmentNode):
+                type_ = parent_type
+                if selection.type_condition:
+                    type_ = self.schema.get_type(selection.type_condition.name.value)
+                total += self.selection_set(type_, selection.selection_set, page_size)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = self.fragments[selection.name.value]
+                type_ = self.schema.get_type(fragment.type_condition.name.value)
+                total += self.selection_set(type_, fragment.selection_set, page_size)
+        return total
+
+    def field(self, parent_type, node, inherited_page_size=None):
+        name = node.name.value
+        fields = getattr(parent_type, "fields", {})
+        if name.startswith("__") or name not in fields:
+            return 0
+        field_def = fields[name]
+        coordinate = f"{parent_type.name}.{name}"
+        named_type = get_named_type(field_def.type)
+
+        default_weight = 0 if is_leaf_type(named_type) else 1
+        if parent_type is self.schema.mutation_type:
+            default_weight = MUTATION_WEIGHT
+        weight = FIELD_WEIGHTS.get(coordinate, default_weight)
+
+        page_size = _int_argument(node, PAGE_SIZE_ARGS, self.variables)
+        if page_size is None:
+            for arg_name in PAGE_SIZE_ARGS:
+                default = getattr(field_def.args.get(arg_name), "default_value", None)
+                if isinstance(default, int):
+                    page_size = default
+        if page_size is None:
+            page_size = inherited_page_size
+
+        if not _is_list(field_def.type):
+            # Connection-style fields (``productPage(first:)``) size the
+            # list nested inside them.
+            children = 0
+            if node.selection_set:
+                children = self.selection_set(named_type, node.selection_set, page_size)
+            return weight + children
+
+        children = 0
+        if node.selection_set:
+            children = self.selection_set(named_type, node.selection_set)
+        if page_size is None:
+            page_size = LIST_SIZES.get(coordinate, DEFAULT_LIST_SIZE)
+        return page_size * (weight + children)
+
+
+def calculate_cost(schema, document, operation_name=None, variables=None):
+    """Return the static cost of the selected operation in ``document``."""
+    fragments = {}
+    operations = []
+    for definition in document.definitions:
+        if isinstance(definition, FragmentDefinitionNode):
+            fragments[definition.name.value] = definition
+        elif isinstance(definition, OperationDefinitionNode):
+            operations.append(definition)
+
+    if operation_name:
+        operations = [
+            op for op in operations if op.name and op.name.value == operation_name
+        ]
+    if not operations:
+        return 0
+
+    operation = operations[0]
+    root_type = schema.get_root_type(operation.operation)
+    calculator = _CostCalculator(schema, fragments, variables)
+    return calculator.selection_set(root_type, operation.selection_set)
+
+
+def _client_key(context):
+    user = getattr(context, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    request = getattr(context, "request", None)
+    meta = getattr(request, "META", {})
+    return f"ip:{meta.get('REMOTE_ADDR', 'unknown')}"
+
+
+def _charge_budget(client_key, cost):
+    """Add ``cost`` to the client's spend for this window; return the total."""
+    key = f"graphql_cost:{client_key}"
+    try:
+        cache.add(key, 0, timeout=_budget_window())
+        return cache.incr(key, cost)
+    except Exception as exc:
+        logger.warning("GraphQL cost budget update failed for %s: %s", key, exc)
+        return None
+
+
+class QueryCostLimiter(SchemaExtension):
+    """Reject operations whose static cost exceeds the configured limits."""
+
+    def __init__(self, *, execution_context=None):
+        self.cost = None
+        self.spent = None
+
+    def on_execute(self):
+        execution_context = self.execution_context
+        self.cost = calculate_cost(
+            execution_context.schema._schema,
+            execution_context.graphql_document,
+            execution_context.operation_name,
+            execution_context.variables,
+        )
+        if self.cost > _max_cost():
+            logger.warning(
+                "Rejected GraphQL operation %s with cost %s",
+                execution_context.operation_name,
+                self.cost,
+            )
+            raise GraphQLError(
+                f"Query cost {self.cost} exceeds the maximum of {_max_cost()}."
+            )
+
+        client_key = _client_key(execution_context.context)
+        self.spent = _charge_budget(client_key, self.cost)
+        if self.spent is not None and self.spent > _budget():
+            logger.warning(
+                "GraphQL cost budget exhausted for %s (%s)", client_key, self.spent
+            )
+            raise GraphQLError("Query cost budget exceeded. Please try again later.")
+        yield
+
+    def get_results(self):
+        if self.cost is None:
+            return {}
+        result = {"requested": self.cost, "maximum": _max_cost()}
+        if self.spent is not None:
+            result["remaining"] = max(_budget() - self.spent, 0)
+        return {"cost": result}
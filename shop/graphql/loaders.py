@@ -0,0 +1,128 @@
+"""Per-request batch loaders for GraphQL resolvers.
+
+Resolvers hand a loader every key they need (``load_many``) and get the
+results back from a single query; values are memoized for the rest of the
+request so repeated lookups are free. The resolvers that use them are plain
+``def`` functions, which ``sync_resolvers`` runs in a ``sync_to_async``
+thread; there is no event loop there to defer to the way
+``strawberry.dataloader.DataLoader`` does, so these batch eagerly instead.
+"""
+
+from django.contrib.auth.models import User
+from django.db.models import Count
+
+from shop.models import (
+    Category,
+    Order,
+    OrderItem,
+    Product,
+    Review,
+    SavedItem,
+    UserProfile,
+)
+
+
+class BatchLoader:
+    def __init__(self, batch_load_fn, default=None):
+        self._batch_load_fn = batch_load_fn
+        self._default = default
+        self._cache = {}
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def load_many(self, keys):
+        keys = list(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in self._cache]
+        if missing:
+            found = self._batch_load_fn(missing)
+            for key in missing:
+                value = found.get(key)
+                if value is None and self._default is not None:
+                    value = self._default()
+                self._cache[key] = value
+        return [self._cache[key] for key in keys]
+
+    def prime(self, key, value):
+        self._cache.setdefault(key, value)
+
+
+def _group_by(rows, attr):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(getattr(row, attr), []).append(row)
+    return grouped
+
+
+def _count_by(queryset, field):
+    return {
+        row[field]: row["n"]
+        for row in queryset.values(field).annotate(n=Count("id")).order_by()
+    }
+
+
+def load_products(ids):
+    return Product.objects.select_related("category").in_bulk(ids)
+
+
+def load_categories(ids):
+    return Category.objects.in_bulk(ids)
+
+
+def load_users(ids):
+    return User.objects.in_bulk(ids)
+
+
+def load_reviews_by_product(product_ids):
+    reviews = Review.objects.filter(product_id__in=product_ids).select_related("user")
+    return _group_by(reviews, "product_id")
+
+
+def load_order_items_by_order(order_ids):
+    items = (
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .select_related("product")
+        .order_by("id")
+    )
+    return _group_by(items, "order_id")
+
+
+def load_order_counts_by_user(user_ids):
+    return _count_by(Order.objects.filter(user_id__in=user_ids), "user_id")
+
+
+def load_saved_counts_by_category(category_ids):
+    return _count_by(
+        SavedItem.objects.filter(product__category_id__in=category_ids),
+        "product__category_id",
+    )
+
+
+def load_or_create_profiles(user_ids):
+    profiles = {p.user_id: p for p in UserProfile.objects.filter(user_id__in=user_ids)}
+    missing = [UserProfile(user_id=uid) for uid in user_ids if uid not in profiles]
+    if missing:
+        UserProfile.objects.bulk_create(missing, ignore_conflicts=True)
+        profiles.update(
+            (p.user_id, p)
+            for p in UserProfile.objects.filter(
+                user_id__in=[p.user_id for p in missing]
+            )
+        )
+    return profiles
+
+
+class Loaders:
+    """The loaders available to one GraphQL request."""
+
+    def __init__(self):
+        self.products = BatchLoader(load_products)
+        self.categories = BatchLoader(load_categories)
+        self.users = BatchLoader(load_users)
+        self.reviews_by_product = BatchLoader(load_reviews_by_product, default=list)
+        self.order_items_by_order = BatchLoader(load_order_items_by_order, default=list)
+        self.order_counts_by_user = BatchLoader(load_order_counts_by_user, default=int)
+        self.saved_counts_by_category = BatchLoader(
+            load_saved_counts_by_category, default=int
+        )
+        self.profiles_by_user = BatchLoader(load_or_create_profiles)
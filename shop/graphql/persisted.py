@@ -0,0 +1,203 @@
+"""Automatic persisted queries and a parsed-document cache.
+
+Clients may send ``extensions.persistedQuery.sha256Hash`` instead of the
+query text. Unknown hashes answer ``PersistedQueryNotFound`` and the client
+retries once with the full text, which is then stored in the shared cache for
+every worker. Parsed and validated documents are kept in a per-process LRU,
+and the shared entry remembers which schema it was validated against, so a
+known document is never re-validated.
+
+With GRAPHQL_PERSISTED_QUERIES_ONLY enabled only the documents listed in
+GRAPHQL_PERSISTED_QUERIES_MANIFEST (a JSON object of ``{hash: query}``) are
+executed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from graphql import GraphQLError, print_schema
+from strawberry.extensions import SchemaExtension
+
+logger = logging.getLogger("shop")
+
+CACHE_KEY = "graphql_doc:{hash}"
+
+
+class DocumentCache:
+    """Thread-safe LRU of parsed, validated documents keyed by hash."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            document = self._entries.get(key)
+            if document is not None:
+                self._entries.move_to_end(key)
+            return document
+
+    def set(self, key, document):
+        with self._lock:
+            self._entries[key] = document
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+documents = DocumentCache(getattr(settings, "GRAPHQL_DOCUMENT_CACHE_SIZE", 1000))
+_manifest = None
+_fingerprints = {}
+_manifest_lock = threading.Lock()
+
+
+def _allowlist_only():
+    return getattr(settings, "GRAPHQL_PERSISTED_QUERIES_ONLY", False)
+
+
+def _ttl():
+    return getattr(settings, "GRAPHQL_PERSISTED_QUERY_TTL", 7 * 24 * 3600)
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def load_manifest():
+    """Return the allowlisted ``{hash: query}`` documents (read once)."""
+    global _manifest
+    if _manifest is not None:
+        return _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            path = getattr(settings, "GRAPHQL_PERSISTED_QUERIES_MANIFEST", "")
+            manifest = {}
+            if path:
+                with open(path) as fh:
+                    manifest = json.load(fh)
+                mismatched = [h for h, q in manifest.items() if query_hash(q) != h]
+                if mismatched:
+                    raise ValueError(
+                        f"Persisted query manifest has bad hashes: {mismatched}"
+                    )
+            _manifest = manifest
+    return _manifest
+
+
+def reset():
+    """Forget the manifest and cached documents (used by tests)."""
+    global _manifest
+    _manifest = None
+    documents.clear()
+
+
+def _schema_fingerprint(execution_context):
+    """Identify the schema and rules a document was validated against."""
+    rules = tuple(rule.__qualname__ for rule in execution_context.validation_rules)
+    key = (id(execution_context.schema), rules)
+    if key not in _fingerprints:
+        source = "\n".join(
+            (
+                print_schema(execution_context.schema._schema),
+                *rules,
+                str(getattr(settings, "GRAPHQL_MAX_QUERY_DEPTH", "")),
+            )
+        )
+        _fingerprints[key] = query_hash(source)
+    return _fingerprints[key]
+
+
+def _error(message, code):
+    return GraphQLError(message, extensions={"code": code})
+
+
+class PersistedQueries(SchemaExtension):
+    """Resolve persisted-query hashes and reuse validated documents."""
+
+    def __init__(self, *, execution_context=None):
+        self.document_hash = None
+        self.shared = False
+        self.cached = False
+        self.validated_for = None
+
+    def _resolve_query(self, execution_context):
+        persisted = (execution_context.operation_extensions or {}).get("persistedQuery")
+        query = execution_context.query
+
+        if not persisted:
+            if _allowlist_only():
+                raise _error(
+                    "Only persisted queries are allowed.", "PERSISTED_QUERY_REQUIRED"
+                )
+            return query_hash(query) if query else None
+
+        digest = str(persisted.get("sha256Hash") or "").lower()
+        if _allowlist_only():
+            allowed = load_manifest().get(digest)
+            if allowed is None or (query and query != allowed):
+                raise _error("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+            execution_context.query = allowed
+            return digest
+
+        self.shared = True
+        if query:
+            if query_hash(query) != digest:
+                raise _error(
+                    "Provided sha256Hash does not match query.",
+                    "PERSISTED_QUERY_HASH_MISMATCH",
+                )
+            return digest
+
+        entry = cache.get(CACHE_KEY.format(hash=digest))
+        if entry is None:
+            raise _error("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+        execution_context.query = entry["query"]
+        self.validated_for = entry.get("validated")
+        return digest
+
+    def on_operation(self):
+        execution_context = self.execution_context
+        self.document_hash = self._resolve_query(execution_context)
+        if self.document_hash:
+            document = documents.get(self.document_hash)
+            if document is not None:
+                self.cached = True
+                execution_context.graphql_document = document
+                # Validation is skipped when errors are already set; the
+                # document passed the same rules when it was cached.
+                execution_context.pre_execution_errors = []
+        yield
+
+    def on_validate(self):
+        execution_context = self.execution_context
+        fingerprint = _schema_fingerprint(execution_context)
+        if not self.cached and self.validated_for == fingerprint:
+            # Another worker already validated this document against the
+            # same schema and rules.
+            execution_context.pre_execution_errors = []
+        yield
+        if (
+            self.cached
+            or not self.document_hash
+            or execution_context.pre_execution_errors
+        ):
+            return
+        documents.set(self.document_hash, execution_context.graphql_document)
+        if self.shared and self.validated_for != fingerprint:
+            entry = {"query": execution_context.query, "validated": fingerprint}
+            try:
+                cache.set(CACHE_KEY.format(hash=self.document_hash), entry, _ttl())
+            except Exception as exc:
+                logger.warning("Persisted query store failed: %s", exc)
@@ -1,32 +1,41 @@
 from __future__ import annotations
 
 import json
+from functools import partial
 from typing import List, Optional
 
 import strawberry
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
 from django.db import transaction
-from strawberry.extensions import DisableIntrospection
+from strawberry.extensions import DisableIntrospection, QueryDepthLimiter
 from strawberry.schema.config import StrawberryConfig
 from strawberry.types import Info
 
-from shop import payment_views
-from shop.api_views import get_coordinates
-from shop.cache_utils import cache_query, invalidate_cache
+from shop import (
+    carts,
+    catalog,
+    counters,
+    exchange_rates,
+    geocoding,
+    payment_views,
+    pricing,
+    rollups,
+    search,
+)
+from shop.cache_utils import cache_query
 from shop.forms import ProfileForm, RegistrationForm
 from shop.models import (
     Cart,
-    CartItem,
     Category,
     Notification,
     Order,
-    OrderItem,
     Product,
-    Review,
     SavedItem,
     UserProfile,
 )
+from shop.reviews import save_review
 
 from .auth import (
     authenticate_credentials,
@@ -34,7 +43,10 @@ from .auth import (
     create_refresh_token,
     decode_token,
 )
+from .cost import QueryCostLimiter
+from .persisted import PersistedQueries
 from .security import rate_limit, require_auth, require_staff
+from .sync_resolvers import SyncResolversInThreads
 from .types import (
     JSON,
     AdminAnalytics,
@@ -46,6 +58,7 @@ from .types import (
     CardValidationResult,
     CartItemType,
     CartProductType,
+    CategoryFacet,
     CategoryType,
     ExchangeRates,
     MpesaStatus,
@@ -54,12 +67,15 @@ from .types import (
     OrderItemType,
     OrderType,
     PaymentResult,
+    ProductPage,
+    ProductSearchPage,
     ProductType,
     ProfileType,
     ReviewsPayload,
     ReviewType,
     SavedAddPayload,
     SavedItemType,
+    SearchFacets,
     SimplePayload,
     UserProfileType,
     UserType,
@@ -74,6 +90,16 @@ class CartAddInput:
     selectedColor: str
 
 
+@strawberry.input
+class CartOperationInput:
+    action: str
+    productId: Optional[int] = None
+    itemId: Optional[int] = None
+    quantity: int = 1
+    selectedSize: str = ""
+    selectedColor: str = ""
+
+
 @strawberry.input
 class ProfileUpdateInput:
     firstName: Optional[str] = None
@@ -93,6 +119,8 @@ class PaymentInput:
     phoneNumber: Optional[str] = None
     orderData: Optional[JSON] = None
     cardData: Optional["CardDataInput"] = None
+    # Same as the Idempotency-Key header, for clients that cannot set one.
+    idempotencyKey: Optional[str] = None
 
 
 @strawberry.input
@@ -103,6 +131,16 @@ class CardDataInput:
     cardName: str
 
 
+@strawberry.input
+class ProductFilterInput:
+    category: Optional[str] = None
+    inStock: Optional[bool] = None
+    onSale: Optional[bool] = None
+    isNew: Optional[bool] = None
+    minPrice: Optional[float] = None
+    maxPrice: Optional[float] = None
+
+
 @strawberry.input
 class AdminCreateProductInput:
     name: str
@@ -116,6 +154,17 @@ class AdminCreateProductInput:
     currency: Optional[str] = "KES"
 
 
+ADMIN_PAGE_SIZE = 100
+MAX_ADMIN_PAGE_SIZE = 500
+ACTIVITY_EVENTS = ["logins", "registrations"]
+
+
+def _admin_page(queryset, limit: int, offset: int):
+    limit = max(1, min(limit, MAX_ADMIN_PAGE_SIZE))
+    offset = max(0, offset)
+    return queryset[offset : offset + limit]
+
+
 def _product_to_type(p: Product) -> ProductType:
     price = float(p.price)
     sale_price = float(p.sale_price) if p.sale_price else None
@@ -147,6 +196,35 @@ def _product_to_type(p: Product) -> ProductType:
 @strawberry.type
 class CartPayload:
     items: List[CartItemType]
+    currency: str
+    itemCount: int
+    subtotal: float
+    discount: float
+
+
+def _cart_line_to_type(line: carts.CartLine) -> CartItemType:
+    return CartItemType(
+        id=line.id,
+        product=CartProductType(
+            id=line.product.id,
+            name=line.product.name,
+            price=float(line.product.price),
+            images=line.product.images or [],
+        ),
+        quantity=line.quantity,
+        selectedSize=line.selected_size,
+        selectedColor=line.selected_color,
+    )
+
+
+def _cart_payload(priced: pricing.PricedCart) -> CartPayload:
+    return CartPayload(
+        items=[_cart_line_to_type(entry.line) for entry in priced.lines],
+        currency=priced.currency,
+        itemCount=priced.item_count,
+        subtotal=float(priced.subtotal),
+        discount=float(priced.discount),
+    )
 
 
 @strawberry.type
@@ -176,23 +254,91 @@ class Query:
         )
 
     @strawberry.field
-    @cache_query(timeout=300)
+    @cache_query(timeout=300, tags=["catalog"], local=True)
     def products(self, info: Info) -> List[ProductType]:
-        products = (
-            Product.objects.select_related("category")
-            .prefetch_related("product_reviews")
-            .order_by("-created_at")
-        )
+        products = Product.objects.select_related("category").order_by("-created_at")
         return [_product_to_type(p) for p in products]
 
     @strawberry.field
-    @cache_query(timeout=600)
+    @cache_query(timeout=300, tags=["catalog"])
+    def product_page(
+        self,
+        info: Info,
+        first: int = catalog.DEFAULT_PAGE_SIZE,
+        after: Optional[str] = None,
+        filter: Optional[ProductFilterInput] = None,
+    ) -> ProductPage:
+        filter = filter or ProductFilterInput()
+        try:
+            queryset = catalog.filter_products(
+                Product.objects.select_related("category"),
+                category=filter.category,
+                in_stock=filter.inStock,
+                on_sale=filter.onSale,
+                is_new=filter.isNew,
+                min_price=catalog.parse_price(filter.minPrice),
+                max_price=catalog.parse_price(filter.maxPrice),
+            )
+            products, next_cursor = catalog.paginate_products(
+                queryset, first=catalog.clamp_page_size(first), after=after
+            )
+        except (catalog.InvalidCursor, catalog.InvalidFilter) as e:
+            raise strawberry.exceptions.GraphQLError(str(e))
+        return ProductPage(
+            items=[_product_to_type(p) for p in products],
+            nextCursor=next_cursor,
+            hasMore=next_cursor is not None,
+        )
+
+    @strawberry.field
+    @cache_query(timeout=300, tags=["catalog"])
+    def search_products(
+        self,
+        info: Info,
+        query: str,
+        limit: int = catalog.DEFAULT_PAGE_SIZE,
+        offset: int = 0,
+        filter: Optional[ProductFilterInput] = None,
+    ) -> ProductSearchPage:
+        filter = filter or ProductFilterInput()
+        try:
+            results = search.search_products(
+                query,
+                category=filter.category,
+                in_stock=filter.inStock,
+                on_sale=filter.onSale,
+                is_new=filter.isNew,
+                min_price=catalog.parse_price(filter.minPrice),
+                max_price=catalog.parse_price(filter.maxPrice),
+                limit=catalog.clamp_page_size(limit),
+                offset=offset,
+            )
+        except catalog.InvalidFilter as e:
+            raise strawberry.exceptions.GraphQLError(str(e))
+        facets = results.facets
+        return ProductSearchPage(
+            items=[_product_to_type(p) for p in results.products],
+            total=results.total,
+            nextOffset=results.next_offset,
+            hasMore=results.next_offset is not None,
+            facets=SearchFacets(
+                categories=[CategoryFacet(**row) for row in facets["categories"]],
+                inStock=facets["in_stock"],
+                onSale=facets["on_sale"],
+                isNew=facets["is_new"],
+            ),
+        )
+
+    @strawberry.field
+    @cache_query(timeout=600, tags=["product:{id}"], local=True)
     def product(self, info: Info, id: int) -> ProductType:
-        product = Product.objects.get(id=id)
+        product = info.context.loaders.products.load(id)
+        if product is None:
+            raise Product.DoesNotExist("Product matching query does not exist.")
         return _product_to_type(product)
 
     @strawberry.field
-    @cache_query(timeout=600)
+    @cache_query(timeout=600, tags=["categories"], local=True)
     def categories(self, info: Info) -> List[CategoryType]:
         return [
             CategoryType(
@@ -206,11 +352,7 @@ class Query:
     @strawberry.field
     def product_reviews(self, info: Info, id: int) -> ReviewsPayload:
         product = Product.objects.get(id=id)
-        reviews = (
-            Review.objects.filter(product=product)
-            .select_related("user")
-            .order_by("-created_at")
-        )
+        reviews = info.context.loaders.reviews_by_product.load(product.id)
         review_types = [
             ReviewType(
                 id=r.id,
@@ -225,35 +367,19 @@ class Query:
             reviews=review_types,
             averageRating=product.average_rating,
             reviewCount=product.review_count,
+            ratingHistogram=product.rating_histogram,
         )
 
     @strawberry.field
     def cart(self, info: Info) -> CartPayload:
         require_auth(info.context.user)
-        cart, _ = Cart.objects.get_or_create(user=info.context.user)
-        items = cart.items.all().select_related("product")
-        data = [
-            CartItemType(
-                id=item.id,
-                product=CartProductType(
-                    id=item.product.id,
-                    name=item.product.name,
-                    price=float(item.product.price),
-                    images=item.product.images or [],
-                ),
-                quantity=item.quantity,
-                selectedSize=item.selected_size,
-                selectedColor=item.selected_color,
-            )
-            for item in items
-        ]
-        return CartPayload(items=data)
+        return _cart_payload(pricing.price_cart(info.context.user))
 
     @strawberry.field
     def saved(self, info: Info) -> SavedPayload:
         require_auth(info.context.user)
         items = SavedItem.objects.filter(user=info.context.user).select_related(
-            "product"
+            "product__category"
         )
         data = [
             SavedItemType(id=item.id, product=_product_to_type(item.product))
@@ -288,16 +414,21 @@ class Query:
     @strawberry.field
     def orders(self, info: Info) -> List[OrderType]:
         require_auth(info.context.user)
-        orders = Order.objects.filter(user=info.context.user).order_by("-created_at")
+        orders = list(
+            Order.objects.filter(user=info.context.user).order_by("-created_at")
+        )
+        items_by_order = info.context.loaders.order_items_by_order.load_many(
+            [order.id for order in orders]
+        )
         data: List[OrderType] = []
-        for order in orders:
+        for order, order_items in zip(orders, items_by_order):
             items = [
                 OrderItemType(
                     productName=item.product.name if item.product else "Unknown",
                     quantity=item.quantity,
                     price=float(item.price),
                 )
-                for item in order.items.all()
+                for item in order_items
             ]
             data.append(
                 OrderType(
@@ -337,48 +468,59 @@ class Query:
 
     @strawberry.field
     def exchange_rates(self, info: Info, base: str = "KES") -> ExchangeRates:
-        # Always return KES as the only currency
-        return ExchangeRates(base="KES", rates={"KES": 1.0})
+        try:
+            base = exchange_rates.normalize_currency(base)
+        except exchange_rates.UnsupportedCurrency as e:
+            raise strawberry.exceptions.GraphQLError(str(e))
+        return ExchangeRates(base=base, rates=exchange_rates.get_rate_table(base))
 
     @strawberry.field
     def admin_analytics(self, info: Info) -> AdminAnalytics:
         require_staff(info.context.user)
         from django.contrib.auth.models import User as DjangoUser
-        from django.db.models import Count, Sum
 
-        total_orders = Order.objects.count()
-        total_revenue = (
-            Order.objects.aggregate(Sum("total_amount"))["total_amount__sum"] or 0
-        )
+        totals = rollups.totals()
         total_users = DjangoUser.objects.count()
         total_products = Product.objects.count()
 
+        loaders = info.context.loaders
         user_locations = []
-        profiles = UserProfile.objects.select_related("user").all()
-        for profile in profiles:
-            if profile.city and profile.country:
-                lat, lng = get_coordinates(profile.city, profile.country)
-                user_locations.append(
-                    {
-                        "user": profile.user.username,
-                        "city": profile.city,
-                        "country": profile.country,
-                        "lat": lat,
-                        "lng": lng,
-                        "orders": Order.objects.filter(user=profile.user).count(),
-                        "last_login": (
-                            profile.user.last_login.isoformat()
-                            if profile.user.last_login
-                            else None
-                        ),
-                    }
-                )
+        profiles = [
+            profile
+            for profile in UserProfile.objects.select_related("user")
+            if profile.city and profile.country
+        ]
+        order_counts = loaders.order_counts_by_user.load_many(
+            [profile.user_id for profile in profiles]
+        )
+        coordinates = geocoding.locate_many(
+            (profile.city, profile.country) for profile in profiles
+        )
+        for profile, order_count in zip(profiles, order_counts):
+            lat, lng = coordinates[(profile.city, profile.country)] or (None, None)
+            user_locations.append(
+                {
+                    "user": profile.user.username,
+                    "city": profile.city,
+                    "country": profile.country,
+                    "lat": lat,
+                    "lng": lng,
+                    "orders": order_count,
+                    "last_login": (
+                        profile.user.last_login.isoformat()
+                        if profile.user.last_login
+                        else None
+                    ),
+                }
+            )
 
         category_stats = []
-        categories = Category.objects.all()
-        for category in categories:
-            saved_count = SavedItem.objects.filter(product__category=category).count()
-            order_count = OrderItem.objects.filter(product__category=category).count()
+        categories = list(Category.objects.all())
+        category_ids = [category.id for category in categories]
+        saved_counts = loaders.saved_counts_by_category.load_many(category_ids)
+        order_item_counts = rollups.order_items_by_category()
+        for category, saved_count in zip(categories, saved_counts):
+            order_count = order_item_counts.get(category.id, 0)
             category_stats.append(
                 {
                     "name": category.name,
@@ -388,52 +530,47 @@ class Query:
                 }
             )
 
-        popular_products = list(
-            Product.objects.annotate(order_count=Count("orderitem"))
-            .order_by("-order_count")[:5]
-            .values("name", "order_count")
-        )
-
-        sales_trends = [
-            {"month": "Jan", "sales": 15000, "orders": 100},
-            {"month": "Feb", "sales": 18000, "orders": 120},
-            {"month": "Mar", "sales": 20000, "orders": 140},
-            {"month": "Apr", "sales": 22000, "orders": 160},
-            {"month": "May", "sales": 25000, "orders": 180},
-            {"month": "Jun", "sales": 28000, "orders": 200},
-        ]
-
-        login_activity = []
-        import random
-        from datetime import datetime, timedelta
-
-        for i in range(7):
-            date = datetime.now() - timedelta(days=i)
-            login_activity.append(
-                {
-                    "date": date.strftime("%Y-%m-%d"),
-                    "logins": random.randint(20, 100),
-                    "unique_users": random.randint(15, 80),
-                }
-            )
+        login_activity = rollups.login_activity()
+        registrations = counters.series(["registrations"], "day", 7)
+        for day, counted in zip(login_activity, registrations):
+            day["registrations"] = int(counted["registrations"])
 
         return AdminAnalytics(
-            totalOrders=total_orders,
-            totalRevenue=float(total_revenue),
+            totalOrders=totals["orders"],
+            totalRevenue=float(totals["revenue"]),
             totalUsers=total_users,
             totalProducts=total_products,
-            recentOrders=Order.objects.count(),
-            popularProducts=popular_products,
+            recentOrders=totals["orders"],
+            popularProducts=rollups.top_products(),
             userLocations=user_locations,
             categoryPreferences=category_stats,
-            salesTrends=sales_trends,
+            salesTrends=rollups.sales_by_month(),
             loginActivity=login_activity,
+            hourlyActivity=[
+                {
+                    "hour": row["bucket"].isoformat(),
+                    "logins": int(row["logins"]),
+                    "registrations": int(row["registrations"]),
+                    "orders": sales["orders"],
+                    "revenue": float(sales["revenue"]),
+                }
+                for row, sales in zip(
+                    counters.series(ACTIVITY_EVENTS, "hour", 24),
+                    rollups.hourly_sales(24),
+                )
+            ],
         )
 
     @strawberry.field
-    def admin_products(self, info: Info) -> List[AdminProductType]:
+    def admin_products(
+        self, info: Info, limit: int = ADMIN_PAGE_SIZE, offset: int = 0
+    ) -> List[AdminProductType]:
         require_staff(info.context.user)
-        products = Product.objects.all()
+        products = _admin_page(
+            Product.objects.select_related("category").order_by("-created_at", "-id"),
+            limit,
+            offset,
+        )
         return [
             AdminProductType(
                 id=p.id,
@@ -458,12 +595,18 @@ class Query:
         ]
 
     @strawberry.field
-    def admin_users(self, info: Info) -> List[AdminUserType]:
+    def admin_users(
+        self, info: Info, limit: int = ADMIN_PAGE_SIZE, offset: int = 0
+    ) -> List[AdminUserType]:
         require_staff(info.context.user)
-        users = User.objects.all().order_by("-date_joined")
+        users = list(
+            _admin_page(User.objects.order_by("-date_joined", "-id"), limit, offset)
+        )
+        profiles = info.context.loaders.profiles_by_user.load_many(
+            [user.id for user in users]
+        )
         data = []
-        for user in users:
-            profile, _ = UserProfile.objects.get_or_create(user=user)
+        for user, profile in zip(users, profiles):
             data.append(
                 AdminUserType(
                     id=user.id,
@@ -487,9 +630,15 @@ class Query:
         return data
 
     @strawberry.field
-    def admin_orders(self, info: Info) -> List[AdminOrderType]:
+    def admin_orders(
+        self, info: Info, limit: int = ADMIN_PAGE_SIZE, offset: int = 0
+    ) -> List[AdminOrderType]:
         require_staff(info.context.user)
-        orders = Order.objects.all().order_by("-created_at")
+        orders = _admin_page(
+            Order.objects.select_related("user").order_by("-created_at", "-id"),
+            limit,
+            offset,
+        )
         return [
             AdminOrderType(
                 id=order.id,
@@ -503,11 +652,9 @@ class Query:
         ]
 
     @strawberry.field
-    def mpesa_status(self, info: Info, checkoutRequestId: str) -> MpesaStatus:
+    async def mpesa_status(self, info: Info, checkoutRequestId: str) -> MpesaStatus:
         require_auth(info.context.user)
-        response = payment_views.check_mpesa_status(
-            info.context.request, checkoutRequestId
-        )
+        response = await payment_views.mpesa_status(checkoutRequestId)
         data = json.loads(response.content.decode())
         return MpesaStatus(
             status=data.get("status"),
@@ -525,6 +672,9 @@ class Mutation:
         user = authenticate_credentials(username, password)
         if not user:
             raise strawberry.exceptions.GraphQLError("Invalid credentials")
+        user_logged_in.send(
+            sender=user.__class__, request=info.context.request, user=user
+        )
         return AuthPayload(
             accessToken=create_access_token(user),
             refreshToken=create_refresh_token(user),
@@ -591,6 +741,7 @@ class Mutation:
             )
             UserProfile.objects.create(user=user)
             Cart.objects.create(user=user)
+            transaction.on_commit(partial(counters.incr, {"registrations": 1}))
         return AuthPayload(
             accessToken=create_access_token(user),
             refreshToken=create_refresh_token(user),
@@ -613,36 +764,52 @@ class Mutation:
     def cart_add(self, info: Info, input: CartAddInput) -> SimplePayload:
         require_auth(info.context.user)
         product = Product.objects.get(id=input.productId)
-        cart, _ = Cart.objects.get_or_create(user=info.context.user)
-        item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            selected_size=input.selectedSize,
-            selected_color=input.selectedColor,
-            defaults={"quantity": input.quantity},
+        carts.add(
+            info.context.user,
+            product,
+            input.quantity,
+            input.selectedSize,
+            input.selectedColor,
         )
-        if not created:
-            item.quantity = input.quantity
-            item.save()
         return SimplePayload(success=True)
 
     @strawberry.mutation
     def cart_update(self, info: Info, item_id: int, quantity: int) -> SimplePayload:
         require_auth(info.context.user)
-        item = CartItem.objects.get(id=item_id, cart__user=info.context.user)
-        if quantity > 0:
-            item.quantity = quantity
-            item.save()
-        else:
-            item.delete()
+        if not carts.update(info.context.user, item_id, quantity):
+            raise strawberry.exceptions.GraphQLError("Cart item not found")
         return SimplePayload(success=True)
 
     @strawberry.mutation
     def cart_remove(self, info: Info, item_id: int) -> SimplePayload:
         require_auth(info.context.user)
-        CartItem.objects.filter(id=item_id, cart__user=info.context.user).delete()
+        carts.remove(info.context.user, item_id)
         return SimplePayload(success=True)
 
+    @strawberry.mutation
+    def cart_apply(
+        self, info: Info, operations: List[CartOperationInput]
+    ) -> CartPayload:
+        require_auth(info.context.user)
+        try:
+            lines = carts.apply(
+                info.context.user,
+                [
+                    carts.CartOperation(
+                        action=op.action,
+                        product_id=op.productId,
+                        item_id=op.itemId,
+                        quantity=op.quantity,
+                        selected_size=op.selectedSize,
+                        selected_color=op.selectedColor,
+                    )
+                    for op in operations
+                ],
+            )
+        except carts.InvalidCartOperation as e:
+            raise strawberry.exceptions.GraphQLError(str(e))
+        return _cart_payload(pricing.price_lines(lines))
+
     @strawberry.mutation
     def saved_add(self, info: Info, product_id: int) -> SavedAddPayload:
         require_auth(info.context.user)
@@ -697,11 +864,7 @@ class Mutation:
         product = Product.objects.get(id=product_id)
         if rating < 1 or rating > 5:
             raise strawberry.exceptions.GraphQLError("Rating must be between 1 and 5")
-        Review.objects.update_or_create(
-            product=product,
-            user=info.context.user,
-            defaults={"rating": rating, "comment": comment},
-        )
+        save_review(product, info.context.user, rating, comment)
         return SimplePayload(success=True)
 
     @strawberry.mutation
@@ -721,7 +884,7 @@ class Mutation:
         return SimplePayload(success=True)
 
     @strawberry.mutation
-    def process_payment(self, info: Info, input: PaymentInput) -> PaymentResult:
+    async def process_payment(self, info: Info, input: PaymentInput) -> PaymentResult:
         require_auth(info.context.user)
         payload = {
             "payment_method": input.paymentMethod,
@@ -740,7 +903,9 @@ class Mutation:
         request = info.context.request
         request.user = info.context.user
         request._body = json.dumps(payload).encode()
-        result = payment_views.process_payment(request)
+        if input.idempotencyKey:
+            request.META["HTTP_IDEMPOTENCY_KEY"] = input.idempotencyKey
+        result = await payment_views.process_payment(request)
         data = json.loads(result.content.decode())
         return PaymentResult(
             success=data.get("success", False),
@@ -780,12 +945,18 @@ class Mutation:
             images=input.images,
             in_stock=input.inStock,
         )
-        # Invalidate product cache
-        invalidate_cache("products")
         return AdminCreateProductPayload(success=True, productId=product.id)
 
 
-schema_extensions: List[object] = []
+schema_extensions: List[object] = [
+    PersistedQueries,
+    partial(
+        QueryDepthLimiter,
+        max_depth=getattr(settings, "GRAPHQL_MAX_QUERY_DEPTH", 10),
+    ),
+    QueryCostLimiter,
+    SyncResolversInThreads,
+]
 if not settings.DEBUG:
     schema_extensions.append(DisableIntrospection())
 
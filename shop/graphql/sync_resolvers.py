@@ -0,0 +1,36 @@
+"""Run synchronous resolvers off the event loop.
+
+The schema is served by an async view, where a plain ``def`` resolver would
+execute on the event loop thread: Django refuses ORM calls there, and any
+blocking I/O would stall every other request on the worker. Root resolvers
+that are not ``async def`` are therefore run through ``sync_to_async``
+(the request's thread-sensitive executor). Nested fields only read
+attributes of already-built objects and run inline.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from strawberry.extensions import SchemaExtension
+from strawberry.schema.schema_converter import GraphQLCoreConverter
+
+
+def _is_sync_resolver(info):
+    field = info.parent_type.fields[info.field_name]
+    definition = field.extensions.get(GraphQLCoreConverter.DEFINITION_BACKREF)
+    return definition is not None and not definition.is_async
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class SyncResolversInThreads(SchemaExtension):
+    def resolve(self, _next, root, info, *args, **kwargs):
+        if info.path.prev is None and _is_sync_resolver(info) and _in_event_loop():
+            return sync_to_async(_next)(root, info, *args, **kwargs)
+        return _next(root, info, *args, **kwargs)
@@ -43,6 +43,37 @@ class ProductType:
     reviews: int
 
 
+@strawberry.type
+class ProductPage:
+    items: list[ProductType]
+    nextCursor: str | None
+    hasMore: bool
+
+
+@strawberry.type
+class CategoryFacet:
+    slug: str
+    name: str
+    count: int
+
+
+@strawberry.type
+class SearchFacets:
+    categories: list[CategoryFacet]
+    inStock: int
+    onSale: int
+    isNew: int
+
+
+@strawberry.type
+class ProductSearchPage:
+    items: list[ProductType]
+    total: int
+    nextOffset: int | None
+    hasMore: bool
+    facets: SearchFacets
+
+
 @strawberry.type
 class CartProductType:
     id: strawberry.ID
@@ -130,6 +161,7 @@ class ReviewsPayload:
     reviews: list[ReviewType]
     averageRating: float
     reviewCount: int
+    ratingHistogram: JSON
 
 
 @strawberry.type
@@ -200,6 +232,7 @@ class AdminAnalytics:
     categoryPreferences: list[JSON]
     salesTrends: list[JSON]
     loginActivity: list[JSON]
+    hourlyActivity: list[JSON]
 
 
 @strawberry.type
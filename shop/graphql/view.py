@@ -1,13 +1,16 @@
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from strawberry.django.views import GraphQLView
+from strawberry.django.views import AsyncGraphQLView
 
 
 @method_decorator(csrf_exempt, name="dispatch")
-@method_decorator(csrf_exempt, name="post")
-class CSRFExemptGraphQLView(GraphQLView):
-    """GraphQL view with CSRF exemption for JWT-based API calls."""
+class CSRFExemptGraphQLView(AsyncGraphQLView):
+    """GraphQL view with CSRF exemption for JWT-based API calls.
+
+    Served asynchronously so resolvers awaiting upstream APIs (M-Pesa) do not
+    hold a worker thread; see ``sync_resolvers`` for the synchronous ones.
+    """
 
     @csrf_exempt
-    def dispatch(self, request, *args, **kwargs):
-        return super().dispatch(request, *args, **kwargs)
+    async def dispatch(self, request, *args, **kwargs):
+        return await super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,181 @@
+"""Idempotency keys for endpoints that must not run twice, such as payments.
+
+A request that carries an ``Idempotency-Key`` header claims the key for its
+caller with one atomic cache add before doing any work. While it runs, a
+duplicate gets 409; once it has finished, its response is kept for
+``IDEMPOTENCY_TTL`` seconds and duplicates get that response back without
+touching the database or the payment provider. Reusing a key for a
+different request body is rejected with 422. Server errors and rate-limited
+responses release the key so the client can try again, unless the view
+marked the error with ``keep_key`` because the upstream call may already
+have gone through; that answer is replayed like any other.
+
+Requests without a key, or arriving while the cache is unreachable, are
+processed normally.
+"""
+
+import hashlib
+import logging
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from .ratelimit import client_key
+
+logger = logging.getLogger("shop")
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+CACHE_KEY = "idempotency:{scope}:{caller}:{digest}"
+MAX_KEY_LENGTH = 255
+# How long a claimed key blocks duplicates if its request never finishes.
+IN_FLIGHT_TTL = 120
+# Answers a retry should not get replayed (besides any 5xx).
+RETRY_STATUSES = (409, 429)
+
+
+def _ttl():
+    return getattr(settings, "IDEMPOTENCY_TTL", 24 * 3600)
+
+
+def _digest(value):
+    return hashlib.sha256(value).hexdigest()
+
+
+def keep_key(response):
+    """Replay error ``response`` to retries instead of releasing the key."""
+    response.idempotency_keep = True
+    return response
+
+
+def _error(message, status):
+    return JsonResponse({"success": False, "error": message}, status=status)
+
+
+class _Call:
+    """One keyed request: its cache key, body fingerprint and stored entry."""
+
+    def __init__(self, scope, request):
+        key = request.META.get(HEADER, "")
+        self.invalid = len(key) > MAX_KEY_LENGTH
+        self.cache_key = None
+        if key and not self.invalid:
+            self.cache_key = CACHE_KEY.format(
+                scope=scope,
+                caller=client_key(request, "user_or_ip"),
+                digest=_digest(key.encode()),
+            )
+        self.fingerprint = _digest(request.body)
+        self.claim = {"state": "in_flight", "fingerprint": self.fingerprint}
+
+    def duplicate_response(self, entry):
+        """What to answer a duplicate whose key holds ``entry``."""
+        if entry is None:
+            # Expired between the failed claim and the read; ask for a retry.
+            return _error("Request with this Idempotency-Key is in progress", 409)
+        if entry["fingerprint"] != self.fingerprint:
+            return _error(
+                "Idempotency-Key was already used for a different request", 422
+            )
+        if entry["state"] == "in_flight":
+            return _error("Request with this Idempotency-Key is in progress", 409)
+        response = JsonResponse({}, status=entry["status"])
+        response.content = entry["content"]
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+    def outcome(self, response):
+        """The entry to store for ``response``, or None to release the key."""
+        if response is None or response.status_code in RETRY_STATUSES:
+            return None
+        if response.status_code >= 500 and not getattr(
+            response, "idempotency_keep", False
+        ):
+            return None
+        return {
+            "state": "done",
+            "fingerprint": self.fingerprint,
+            "status": response.status_code,
+            "content": response.content,
+        }
+
+    def finish(self, response):
+        entry = self.outcome(response)
+        try:
+            if entry is None:
+                cache.delete(self.cache_key)
+            else:
+                cache.set(self.cache_key, entry, _ttl())
+        except Exception as exc:
+            logger.warning("Idempotency store failed: %s", exc)
+
+    async def afinish(self, response):
+        entry = self.outcome(response)
+        try:
+            if entry is None:
+                await cache.adelete(self.cache_key)
+            else:
+                await cache.aset(self.cache_key, entry, _ttl())
+        except Exception as exc:
+            logger.warning("Idempotency store failed: %s", exc)
+
+
+def idempotent(scope):
+    """Make a (sync or async) view replay its response for repeated keys."""
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                call = _Call(scope, request)
+                if call.invalid:
+                    return _error("Idempotency-Key is too long", 400)
+                if call.cache_key is None:
+                    return await view(request, *args, **kwargs)
+                try:
+                    claimed = await cache.aadd(
+                        call.cache_key, call.claim, IN_FLIGHT_TTL
+                    )
+                    if not claimed:
+                        entry = await cache.aget(call.cache_key)
+                        return call.duplicate_response(entry)
+                except Exception as exc:
+                    logger.warning("Idempotency check failed: %s", exc)
+                    return await view(request, *args, **kwargs)
+
+                response = None
+                try:
+                    response = await view(request, *args, **kwargs)
+                    return response
+                finally:
+                    await call.afinish(response)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            call = _Call(scope, request)
+            if call.invalid:
+                return _error("Idempotency-Key is too long", 400)
+            if call.cache_key is None:
+                return view(request, *args, **kwargs)
+            try:
+                if not cache.add(call.cache_key, call.claim, IN_FLIGHT_TTL):
+                    return call.duplicate_response(cache.get(call.cache_key))
+            except Exception as exc:
+                logger.warning("Idempotency check failed: %s", exc)
+                return view(request, *args, **kwargs)
+
+            response = None
+            try:
+                response = view(request, *args, **kwargs)
+                return response
+            finally:
+                call.finish(response)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,317 @@
+"""Background jobs for work that should not hold up a request.
+
+Handlers are registered with ``@handler("name")`` and queued with
+``enqueue("name", {...}, key=...)``; the payload must be JSON-serializable
+and is passed to the handler as keyword arguments. Jobs are pushed when the
+surrounding transaction commits. A ``key`` makes the enqueue idempotent:
+a second job with the same key within ``KEY_TTL`` is dropped.
+
+With Redis configured, jobs live in a list that ``manage.py run_jobs``
+workers consume reliably (each job sits in a processing list until it is
+acknowledged), and failed jobs are retried with exponential backoff from a
+sorted set before ending up in a dead-letter list. Without Redis, jobs go
+to an in-process queue that a background thread drains (or, in tests, that
+``work(burst=True)`` drains); those jobs are lost if the process exits, so
+callers that must not lose work check ``durable()`` first.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+
+logger = logging.getLogger("shop")
+
+KEY_PREFIX = "arnova:jobs"
+QUEUE_KEY = f"{KEY_PREFIX}:queue"
+PROCESSING_KEY = f"{KEY_PREFIX}:processing"
+DELAYED_KEY = f"{KEY_PREFIX}:delayed"
+DEAD_KEY = f"{KEY_PREFIX}:dead"
+DEAD_LIMIT = 1000
+KEY_TTL = 24 * 3600
+DEFAULT_MAX_ATTEMPTS = 5
+# Retries wait 2s, 4s, 8s, ... after each failed attempt.
+RETRY_BASE_DELAY = 2
+
+_handlers = {}
+
+
+def handler(name):
+    """Register ``func`` as the handler for jobs called ``name``."""
+
+    def decorator(func):
+        _handlers[name] = func
+        return func
+
+    return decorator
+
+
+class LocalQueue:
+    """In-process queue, used when Redis is not configured."""
+
+    def __init__(self):
+        self._ready = deque()
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.dead = []
+
+    def _promote(self):
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._ready.append(heapq.heappop(self._delayed)[2])
+
+    def push(self, raw, run_at=None):
+        with self._cond:
+            if run_at is None:
+                self._ready.append(raw)
+            else:
+                heapq.heappush(self._delayed, (run_at, next(self._seq), raw))
+            self._cond.notify()
+
+    def pop(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self._promote()
+                if self._ready:
+                    return self._ready.popleft()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if self._delayed:
+                    remaining = min(remaining, self._delayed[0][0] - time.time())
+                self._cond.wait(max(remaining, 0))
+
+    def ack(self, raw):
+        pass
+
+    def retry(self, raw, new_raw, run_at):
+        self.push(new_raw, run_at)
+
+    def bury(self, raw, new_raw):
+        with self._cond:
+            self.dead.append(new_raw)
+
+    def pending(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    def clear(self):
+        with self._cond:
+            self._ready.clear()
+            self._delayed.clear()
+            self.dead.clear()
+
+
+class RedisQueue:
+    def __init__(self):
+        from django_redis import get_redis_connection
+
+        self.conn = get_redis_connection("default")
+
+    def _promote(self):
+        for raw in self.conn.zrangebyscore(DELAYED_KEY, 0, time.time()):
+            # Only the worker whose ZREM succeeds moves the job.
+            if self.conn.zrem(DELAYED_KEY, raw):
+                self.conn.lpush(QUEUE_KEY, raw)
+
+    def push(self, raw, run_at=None):
+        if run_at is None:
+            self.conn.lpush(QUEUE_KEY, raw)
+        else:
+            self.conn.zadd(DELAYED_KEY, {raw: run_at})
+
+    def pop(self, timeout):
+        self._promote()
+        if timeout <= 0:
+            raw = self.conn.rpoplpush(QUEUE_KEY, PROCESSING_KEY)
+        else:
+            raw = self.conn.brpoplpush(QUEUE_KEY, PROCESSING_KEY, max(int(timeout), 1))
+        return raw.decode() if isinstance(raw, bytes) else raw
+
+    def ack(self, raw):
+        self.conn.lrem(PROCESSING_KEY, 1, raw)
+
+    def retry(self, raw, new_raw, run_at):
+        pipe = self.conn.pipeline()
+        pipe.zadd(DELAYED_KEY, {new_raw: run_at})
+        pipe.lrem(PROCESSING_KEY, 1, raw)
+        pipe.execute()
+
+    def bury(self, raw, new_raw):
+        pipe = self.conn.pipeline()
+        pipe.lpush(DEAD_KEY, new_raw)
+        pipe.ltrim(DEAD_KEY, 0, DEAD_LIMIT - 1)
+        pipe.lrem(PROCESSING_KEY, 1, raw)
+        pipe.execute()
+
+    def pending(self):
+        return self.conn.llen(QUEUE_KEY) + self.conn.zcard(DELAYED_KEY)
+
+    def recover(self):
+        """Requeue jobs left in the processing list by a crashed worker."""
+        moved = 0
+        while self.conn.rpoplpush(PROCESSING_KEY, QUEUE_KEY) is not None:
+            moved += 1
+        return moved
+
+
+local_queue = LocalQueue()
+_inline_worker = None
+_lock = threading.Lock()
+
+
+def _uses_redis():
+    return "django_redis" in settings.CACHES["default"]["BACKEND"]
+
+
+def _inline():
+    return getattr(settings, "JOBS_INLINE_WORKER", True)
+
+
+def durable():
+    """Whether queued jobs survive a restart of the web process."""
+    return _uses_redis()
+
+
+def backend():
+    return RedisQueue() if _uses_redis() else local_queue
+
+
+def _drain_inline():
+    global _inline_worker
+    try:
+        while True:
+            raw = local_queue.pop(timeout=1)
+            if raw is not None:
+                _execute(raw, local_queue)
+                continue
+            with _lock:
+                if not local_queue.pending():
+                    _inline_worker = None
+                    return
+    except Exception as exc:
+        logger.warning("Inline job worker stopped: %s", exc)
+        with _lock:
+            _inline_worker = None
+    finally:
+        connections.close_all()
+
+
+def _start_inline_worker():
+    global _inline_worker
+    with _lock:
+        if _inline_worker is not None:
+            return
+        _inline_worker = threading.Thread(
+            target=_drain_inline, name="jobs", daemon=True
+        )
+        _inline_worker.start()
+
+
+def _claim(key, job_id):
+    try:
+        return cache.add(f"{KEY_PREFIX}:key:{key}", job_id, KEY_TTL)
+    except Exception as exc:
+        logger.warning("Job key check failed for %s: %s", key, exc)
+        return True
+
+
+def _push(job, delay=None):
+    if job["key"] and not _claim(job["key"], job["id"]):
+        logger.info("Skipping duplicate job %s (%s)", job["name"], job["key"])
+        return
+    raw = json.dumps(job)
+    try:
+        queue = backend()
+        queue.push(raw, time.time() + delay if delay else None)
+    except Exception as exc:
+        # Better late than never: run it here rather than lose it.
+        logger.warning("Could not queue job %s, running inline: %s", job["name"], exc)
+        _execute(raw, local_queue)
+        return
+    if queue is local_queue and _inline():
+        _start_inline_worker()
+
+
+def enqueue(
+    name, payload=None, key=None, max_attempts=DEFAULT_MAX_ATTEMPTS, delay=None
+):
+    """Queue ``name`` once the current transaction commits; returns the job id.
+
+    ``delay`` holds the job back for that many seconds.
+    """
+    job = {
+        "id": uuid.uuid4().hex,
+        "name": name,
+        "payload": payload or {},
+        "key": key,
+        "attempts": 0,
+        "max_attempts": max_attempts,
+    }
+    transaction.on_commit(partial(_push, job, delay))
+    return job["id"]
+
+
+def _execute(raw, queue):
+    job = json.loads(raw)
+    func = _handlers.get(job["name"])
+    try:
+        if func is None:
+            raise LookupError(f"No handler registered for job {job['name']}")
+        func(**job["payload"])
+    except Exception as exc:
+        job["attempts"] += 1
+        if job["attempts"] >= job["max_attempts"]:
+            logger.error(
+                "Job %s %s failed after %d attempts: %s",
+                job["name"],
+                job["id"],
+                job["attempts"],
+                exc,
+            )
+            queue.bury(raw, json.dumps(job))
+            if job["key"]:
+                cache.delete(f"{KEY_PREFIX}:key:{job['key']}")
+        else:
+            delay = RETRY_BASE_DELAY * 2 ** (job["attempts"] - 1)
+            logger.warning(
+                "Job %s %s failed (attempt %d), retrying in %ds: %s",
+                job["name"],
+                job["id"],
+                job["attempts"],
+                delay,
+                exc,
+            )
+            queue.retry(raw, json.dumps(job), time.time() + delay)
+        return False
+    queue.ack(raw)
+    return True
+
+
+def work(burst=False, max_jobs=None, timeout=5):
+    """Run queued jobs; returns how many ran.
+
+    ``burst`` stops as soon as no job is ready instead of waiting for more.
+    """
+    queue = backend()
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        raw = queue.pop(0 if burst else timeout)
+        if raw is None:
+            if burst:
+                break
+            continue
+        _execute(raw, queue)
+        done += 1
+    return done
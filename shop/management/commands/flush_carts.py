@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop import carts
+
+
+class Command(BaseCommand):
+    help = "Write carts changed in Redis to the database"
+
+    def handle(self, *args, **options):
+        flushed = carts.flush()
+        self.stdout.write(self.style.SUCCESS(f"✅ Flushed {flushed} carts"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop import counters
+
+
+class Command(BaseCommand):
+    help = "Flush event counters buffered in Redis to the database"
+
+    def handle(self, *args, **options):
+        flushed = counters.flush()
+        self.stdout.write(self.style.SUCCESS(f"✅ Flushed {flushed} counter buckets"))
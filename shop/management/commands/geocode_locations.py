@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from shop import geocoding
+from shop.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = "Geocode profile locations missing from the gazetteer and cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retry-unresolved",
+            action="store_true",
+            help="Also retry places a previous lookup could not find",
+        )
+
+    def handle(self, *args, **options):
+        places = (
+            UserProfile.objects.exclude(city="")
+            .exclude(country="")
+            .values_list("city", "country")
+            .distinct()
+        )
+        keys = geocoding.uncached(places, options["retry_unresolved"])
+        resolved = geocoding.resolve(keys)
+        self.stdout.write(
+            self.style.SUCCESS(f"✅ Geocoded {resolved} of {len(keys)} locations")
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from shop.reviews import rebuild_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = "Recompute product rating aggregates from the review table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--product",
+            type=int,
+            action="append",
+            dest="product_ids",
+            help="Only rebuild the given product id (repeatable)",
+        )
+
+    def handle(self, *args, **options):
+        updated = rebuild_rating_aggregates(options["product_ids"])
+        self.stdout.write(
+            self.style.SUCCESS(f"✅ Rebuilt ratings for {updated} products")
+        )
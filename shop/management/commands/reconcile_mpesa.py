@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from shop import reconciliation
+
+
+class Command(BaseCommand):
+    help = "Query Daraja for M-Pesa payments still waiting on their callback"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=60,
+            help="Only check payments pending for at least this many seconds "
+            "(default: 60)",
+        )
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            default=24,
+            help="Skip payments older than this many hours (default: 24)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=200,
+            help="Maximum number of payments to check (default: 200)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=5,
+            help="Queries in flight at once (default: 5)",
+        )
+
+    def handle(self, *args, **options):
+        checked, settled = reconciliation.reconcile(
+            min_age=options["min_age"],
+            max_age=options["max_age"] * 3600,
+            limit=options["limit"],
+            concurrency=max(options["concurrency"], 1),
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"✅ Settled {settled} of {checked} pending M-Pesa payments"
+            )
+        )
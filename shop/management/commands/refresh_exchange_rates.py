@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from shop.exchange_rates import FALLBACK_RATES, refresh_rate_table
+
+
+class Command(BaseCommand):
+    help = "Fetch exchange-rate tables into the shared cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "bases",
+            nargs="*",
+            help="Base currencies to refresh (defaults to all known bases)",
+        )
+
+    def handle(self, *args, **options):
+        bases = [b.upper() for b in options["bases"]] or sorted(FALLBACK_RATES)
+        for base in bases:
+            entry = refresh_rate_table(base)
+            if entry is None:
+                self.stdout.write(self.style.WARNING(f"⚠️  Failed to refresh {base}"))
+                continue
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"✅ Refreshed {base}: {len(entry['rates'])} currencies"
+                )
+            )
@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+from django.utils import timezone
+
+from shop import rollups
+from shop.models import Order
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily sales rollups from orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=2,
+            help="Number of most recent days to rebuild (default: 2)",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Rebuild every day since the first order",
+        )
+
+    def handle(self, *args, **options):
+        end = timezone.localdate()
+        start = end - timedelta(days=max(options["days"], 1) - 1)
+        if options["all"]:
+            first = Order.objects.aggregate(first=Min("created_at"))["first"]
+            start = rollups.day_of(first) if first else end
+        count = rollups.rebuild(start, end)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"✅ Rebuilt sales rollups for {start}..{end} ({count} days with orders)"
+            )
+        )
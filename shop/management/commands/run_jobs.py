@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from shop import jobs
+
+
+class Command(BaseCommand):
+    help = "Process background jobs (payment callbacks, notifications)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit once no job is ready instead of waiting for more",
+        )
+        parser.add_argument(
+            "--max-jobs",
+            type=int,
+            default=None,
+            help="Exit after running this many jobs",
+        )
+        parser.add_argument(
+            "--recover",
+            action="store_true",
+            help="First requeue jobs a crashed worker left unacknowledged "
+            "(only run with no other worker active)",
+        )
+
+    def handle(self, *args, **options):
+        queue = jobs.backend()
+        if options["recover"] and hasattr(queue, "recover"):
+            moved = queue.recover()
+            self.stdout.write(f"Requeued {moved} unacknowledged jobs")
+        try:
+            done = jobs.work(burst=options["burst"], max_jobs=options["max_jobs"])
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(self.style.SUCCESS(f"✅ Ran {done} jobs"))
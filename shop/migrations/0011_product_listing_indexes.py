@@ -0,0 +1,50 @@
+# Generated by Django 5.2.14 on 2026-10-18 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0010_remove_product_rating_remove_product_reviews_review"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["-created_at", "-id"], name="product_listing_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["category", "-created_at", "-id"],
+                name="product_category_listing_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("in_stock", True)),
+                fields=["-created_at", "-id"],
+                name="product_in_stock_listing_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("on_sale", True)),
+                fields=["-created_at", "-id"],
+                name="product_on_sale_listing_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("is_new", True)),
+                fields=["-created_at", "-id"],
+                name="product_is_new_listing_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.14 on 2026-10-18 00:15
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model("shop", "Product")
+    Review = apps.get_model("shop", "Review")
+
+    counts = {}
+    for row in Review.objects.values("product_id", "rating").annotate(n=Count("id")):
+        counts.setdefault(row["product_id"], {})[row["rating"]] = row["n"]
+
+    for product_id, histogram in counts.items():
+        Product.objects.filter(pk=product_id).update(
+            rating_sum=sum(star * n for star, n in histogram.items()),
+            rating_count=sum(histogram.values()),
+            **{f"rating_{star}_count": histogram.get(star, 0) for star in range(1, 6)},
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0011_product_listing_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="rating_1_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="rating_2_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="rating_3_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="rating_4_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="rating_5_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="rating_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="rating_sum",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,199 @@
+# Generated by Django 5.2.14 on 2026-10-18 00:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_sales_rollups(apps, schema_editor):
+    Order = apps.get_model("shop", "Order")
+    OrderItem = apps.get_model("shop", "OrderItem")
+    DailySales = apps.get_model("shop", "DailySales")
+    DailyProductSales = apps.get_model("shop", "DailyProductSales")
+    DailyCategorySales = apps.get_model("shop", "DailyCategorySales")
+
+    line_totals = {
+        "order_items": Count("id"),
+        "units": Sum("quantity"),
+        "revenue": Sum(
+            ExpressionWrapper(
+                F("price") * F("quantity"),
+                output_field=DecimalField(max_digits=14, decimal_places=2),
+            )
+        ),
+    }
+    orders = Order.objects.annotate(day=TruncDate("created_at")).values("day")
+    items = OrderItem.objects.annotate(day=TruncDate("order__created_at"))
+
+    sales = {
+        row["day"]: DailySales(
+            date=row["day"], orders=row["orders"], revenue=row["revenue"] or 0
+        )
+        for row in orders.annotate(
+            orders=Count("id"), revenue=Sum("total_amount")
+        ).order_by()
+    }
+    for row in items.values("day").annotate(units=Sum("quantity")).order_by():
+        sales.setdefault(row["day"], DailySales(date=row["day"])).units = row["units"]
+    DailySales.objects.bulk_create(sales.values())
+
+    sold = items.filter(product__isnull=False)
+    DailyProductSales.objects.bulk_create(
+        DailyProductSales(date=row.pop("day"), **row)
+        for row in sold.values("day", "product_id").annotate(**line_totals).order_by()
+    )
+    DailyCategorySales.objects.bulk_create(
+        DailyCategorySales(
+            date=row["day"],
+            category_id=row["product__category_id"],
+            order_items=row["order_items"],
+            units=row["units"],
+            revenue=row["revenue"],
+        )
+        for row in sold.values("day", "product__category_id")
+        .annotate(**line_totals)
+        .order_by()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0013_geocodecache"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyLogins",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(unique=True)),
+                ("logins", models.PositiveIntegerField(default=0)),
+                ("unique_users", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "ordering": ["-date"],
+            },
+        ),
+        migrations.CreateModel(
+            name="DailySales",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(unique=True)),
+                ("orders", models.PositiveIntegerField(default=0)),
+                ("units", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+            ],
+            options={
+                "ordering": ["-date"],
+            },
+        ),
+        migrations.CreateModel(
+            name="DailyCategorySales",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("order_items", models.PositiveIntegerField(default=0)),
+                ("units", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="shop.category"
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("date", "category")},
+            },
+        ),
+        migrations.CreateModel(
+            name="DailyProductSales",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("order_items", models.PositiveIntegerField(default=0)),
+                ("units", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="shop.product"
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("date", "product")},
+            },
+        ),
+        migrations.CreateModel(
+            name="UserLoginDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "date")},
+            },
+        ),
+        migrations.RunPython(backfill_sales_rollups, migrations.RunPython.noop),
+    ]
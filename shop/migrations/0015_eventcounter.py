@@ -0,0 +1,42 @@
+# Generated by Django 5.2.14 on 2026-10-18 00:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0014_daily_rollups"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EventCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50)),
+                (
+                    "granularity",
+                    models.CharField(
+                        choices=[("hour", "Hour"), ("day", "Day")], max_length=4
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                (
+                    "value",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=16),
+                ),
+            ],
+            options={
+                "unique_together": {("name", "granularity", "bucket")},
+            },
+        ),
+    ]
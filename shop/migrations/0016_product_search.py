@@ -0,0 +1,49 @@
+# Generated by Django 5.2.14 on 2026-10-18 01:40
+
+from django.db import migrations
+
+# The search column and indexes are PostgreSQL-only and live outside the
+# model: the column is generated by the database, so Django never writes it,
+# and shop.search reads it directly. Other databases use shop.search's
+# in-process index instead.
+FORWARD_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    ALTER TABLE shop_product ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A')
+        || setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX product_search_vector_idx ON shop_product "
+    "USING GIN (search_vector)",
+    "CREATE INDEX product_name_trgm_idx ON shop_product "
+    "USING GIN (name gin_trgm_ops)",
+]
+
+REVERSE_SQL = [
+    "DROP INDEX IF EXISTS product_name_trgm_idx",
+    "DROP INDEX IF EXISTS product_search_vector_idx",
+    "ALTER TABLE shop_product DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "postgresql":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0015_eventcounter"),
+    ]
+
+    operations = [
+        migrations.RunPython(_run(FORWARD_SQL), _run(REVERSE_SQL)),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.14 on 2026-10-18 02:20
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def drop_rollup_counters(apps, schema_editor):
+    # Orders, revenue and daily logins are counted by the daily rollups now.
+    EventCounter = apps.get_model("shop", "EventCounter")
+    EventCounter.objects.filter(
+        Q(name__in=["orders", "revenue"]) | Q(name="logins", granularity="day")
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0016_product_search"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="order",
+            index=models.Index(fields=["created_at"], name="order_created_at_idx"),
+        ),
+        migrations.RunPython(drop_rollup_counters, migrations.RunPython.noop),
+    ]
@@ -30,22 +30,62 @@ class Product(models.Model):
     in_stock = models.BooleanField(default=True)
     is_new = models.BooleanField(default=False)
     on_sale = models.BooleanField(default=False)
+    # Review aggregates, maintained by shop.reviews so listings never scan
+    # the review table.
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Keyset pagination walks (created_at, id) descending; the partial
+        # indexes keep the common storefront filters on the same access path.
+        indexes = [
+            models.Index(fields=["-created_at", "-id"], name="product_listing_idx"),
+            models.Index(
+                fields=["category", "-created_at", "-id"],
+                name="product_category_listing_idx",
+            ),
+            models.Index(
+                fields=["-created_at", "-id"],
+                condition=models.Q(in_stock=True),
+                name="product_in_stock_listing_idx",
+            ),
+            models.Index(
+                fields=["-created_at", "-id"],
+                condition=models.Q(on_sale=True),
+                name="product_on_sale_listing_idx",
+            ),
+            models.Index(
+                fields=["-created_at", "-id"],
+                condition=models.Q(is_new=True),
+                name="product_is_new_listing_idx",
+            ),
+        ]
+
     def __str__(self):
         return self.name
 
     @property
     def average_rating(self):
-        reviews = self.product_reviews.all()
-        if not reviews:
+        if not self.rating_count:
             return 0.0
-        return round(sum(r.rating for r in reviews) / len(reviews), 1)
+        return round(self.rating_sum / self.rating_count, 1)
 
     @property
     def review_count(self):
-        return self.product_reviews.count()
+        return self.rating_count
+
+    @property
+    def rating_histogram(self):
+        return {
+            str(star): getattr(self, f"rating_{star}_count") for star in range(1, 6)
+        }
 
 
 class UserProfile(models.Model):
@@ -62,6 +102,33 @@ class UserProfile(models.Model):
         return f"{self.user.username} Profile"
 
 
+class GeocodeCache(models.Model):
+    """Coordinates for a normalized (city, country), looked up once.
+
+    Rows with no coordinates record places the geocoder could not find, so
+    they are not retried on every dashboard load.
+    """
+
+    SOURCE_CHOICES = [
+        ("nominatim", "Nominatim"),
+        ("unresolved", "Unresolved"),
+    ]
+
+    city_key = models.CharField(max_length=100)
+    country_key = models.CharField(max_length=100)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("city_key", "country_key")
+
+    def __str__(self):
+        return f"{self.city_key}, {self.country_key}"
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -114,6 +181,10 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Hourly activity and rollup rebuilds read orders by creation time.
+        indexes = [models.Index(fields=["created_at"], name="order_created_at_idx")]
+
     def __str__(self):
         return f"Order {self.order_id}"
 
@@ -221,3 +292,88 @@ class Review(models.Model):
 
     def __str__(self):
         return f"{self.user.username} - {self.product.name} ({self.rating}★)"
+
+
+class DailySales(models.Model):
+    """Orders placed on one day; see ``shop.rollups``."""
+
+    date = models.DateField(unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ["-date"]
+
+    def __str__(self):
+        return f"{self.date}: {self.orders} orders"
+
+
+class DailyCategorySales(models.Model):
+    date = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    order_items = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ("date", "category")
+
+    def __str__(self):
+        return f"{self.date}: {self.category.name}"
+
+
+class DailyProductSales(models.Model):
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    order_items = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ("date", "product")
+
+    def __str__(self):
+        return f"{self.date}: {self.product.name}"
+
+
+class DailyLogins(models.Model):
+    date = models.DateField(unique=True)
+    logins = models.PositiveIntegerField(default=0)
+    unique_users = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-date"]
+
+    def __str__(self):
+        return f"{self.date}: {self.logins} logins"
+
+
+class UserLoginDay(models.Model):
+    """Marks a user as seen on ``date`` so unique logins count once."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+
+    class Meta:
+        unique_together = ("user", "date")
+
+
+class EventCounter(models.Model):
+    """Flushed total of one event counter for an hour or a day."""
+
+    GRANULARITY_CHOICES = [
+        ("hour", "Hour"),
+        ("day", "Day"),
+    ]
+
+    name = models.CharField(max_length=50)
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField()
+    value = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ("name", "granularity", "bucket")
+
+    def __str__(self):
+        return f"{self.name} {self.granularity} {self.bucket}: {self.value}"
@@ -1,6 +1,8 @@
+from django.contrib.auth.models import User
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 
+from . import jobs
 from .models import Notification
 
 
@@ -72,3 +74,16 @@ def create_notification(user, title, message, notification_type="system", link=N
         notification_type=notification_type,
         link=link,
     )
+
+
+@jobs.handler("notifications.create")
+def notify(user_id, title, message, notification_type="system", link=None):
+    """Job: create a notification for ``user_id`` if the user still exists"""
+    if User.objects.filter(pk=user_id).exists():
+        Notification.objects.create(
+            user_id=user_id,
+            title=title,
+            message=message,
+            notification_type=notification_type,
+            link=link,
+        )
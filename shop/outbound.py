@@ -0,0 +1,310 @@
+"""Pooled HTTP clients for third-party APIs.
+
+Every upstream host (M-Pesa, FX rates, geocoding, Unsplash) gets one
+keep-alive ``requests`` session, and one ``httpx.AsyncClient`` per event
+loop, so repeat calls reuse the TCP/TLS connection. Calls get the host's
+timeouts and are retried with exponential backoff when the connection
+cannot be established; idempotent methods are also retried on read errors
+and 502/503/504. POSTs are never resent once they reach the server: an STK
+push must not be sent twice.
+
+A per-host circuit breaker opens after ``failure_threshold`` consecutive
+failures and fails fast for ``reset_after`` seconds before letting a trial
+call through. Latency and error counts per host are available from
+``metrics()``.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("shop")
+
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+SLOW_CALL_SECONDS = 5.0
+
+
+@dataclass(frozen=True)
+class HostPolicy:
+    connect_timeout: float = 3.05
+    read_timeout: float = 10.0
+    retries: int = 2
+    backoff: float = 0.3
+    failure_threshold: int = 5
+    reset_after: float = 30.0
+    pool_size: int = 10
+
+
+DEFAULT_POLICY = HostPolicy()
+HOST_POLICIES = {
+    # STK push and query calls can take a while on Safaricom's side.
+    "sandbox.safaricom.co.ke": HostPolicy(read_timeout=30.0),
+    "api.safaricom.co.ke": HostPolicy(read_timeout=30.0),
+    "api.exchangerate-api.com": HostPolicy(read_timeout=5.0),
+    # Nominatim asks clients to back off rather than retry aggressively.
+    "nominatim.openstreetmap.org": HostPolicy(read_timeout=5.0, retries=0),
+    "api.unsplash.com": HostPolicy(read_timeout=10.0),
+}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling a host whose circuit is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_after):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def release_trial(self):
+        """Let another trial through after one ended without an answer."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class HostStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self):
+        average = self.total_seconds / self.calls if self.calls else 0.0
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round(average * 1000, 1),
+            "max_ms": round(self.max_seconds * 1000, 1),
+        }
+
+
+_sessions = {}
+_async_clients = {}
+_breakers = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def policy_for(host):
+    return HOST_POLICIES.get(host, DEFAULT_POLICY)
+
+
+def _host(url):
+    return urlsplit(url).hostname or ""
+
+
+def _breaker(host):
+    with _lock:
+        if host not in _breakers:
+            policy = policy_for(host)
+            _breakers[host] = CircuitBreaker(
+                policy.failure_threshold, policy.reset_after
+            )
+        return _breakers[host]
+
+
+def _session(host):
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            policy = policy_for(host)
+            retry = Retry(
+                total=policy.retries,
+                connect=policy.retries,
+                read=policy.retries,
+                status=policy.retries,
+                backoff_factor=policy.backoff,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=IDEMPOTENT_METHODS,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                max_retries=retry,
+                pool_connections=1,
+                pool_maxsize=policy.pool_size,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def _async_client(host):
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(host, weakref.WeakKeyDictionary())
+        client = clients.get(loop)
+        if client is None:
+            policy = policy_for(host)
+            client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(retries=policy.retries),
+                limits=httpx.Limits(max_keepalive_connections=policy.pool_size),
+            )
+            clients[loop] = client
+        return client
+
+
+def _timeout(policy, timeout):
+    if timeout is not None:
+        return timeout
+    return (policy.connect_timeout, policy.read_timeout)
+
+
+def _record(host, started, failed):
+    elapsed = time.monotonic() - started
+    with _lock:
+        stats = _stats.setdefault(host, HostStats())
+        stats.calls += 1
+        stats.errors += int(failed)
+        stats.total_seconds += elapsed
+        stats.max_seconds = max(stats.max_seconds, elapsed)
+    if elapsed >= SLOW_CALL_SECONDS:
+        logger.warning("Slow outbound call to %s: %.2fs", host, elapsed)
+
+
+def _circuit_is_open(host):
+    if _breaker(host).allow():
+        return False
+    with _lock:
+        _stats.setdefault(host, HostStats()).errors += 1
+    return True
+
+
+def _settle(host, started, status_code=None, error=None):
+    failed = error is not None or (status_code or 0) >= 500
+    breaker = _breaker(host)
+    if failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    _record(host, started, failed)
+
+
+def request(method, url, timeout=None, **kwargs):
+    """Send a request through the host's pooled session."""
+    host = _host(url)
+    policy = policy_for(host)
+    if _circuit_is_open(host):
+        raise CircuitOpenError(f"Circuit open for {host}")
+    started = time.monotonic()
+    try:
+        response = _session(host).request(
+            method, url, timeout=_timeout(policy, timeout), **kwargs
+        )
+    except requests.RequestException as exc:
+        _settle(host, started, error=exc)
+        raise
+    except BaseException:
+        # Cancelled (a client disconnect under ASGI) or otherwise cut short:
+        # the host gave no answer, but a half-open trial must not stay taken.
+        _breaker(host).release_trial()
+        raise
+    _settle(host, started, status_code=response.status_code)
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+async def arequest(method, url, timeout=None, **kwargs):
+    """Async ``request`` through the host's pooled client for this loop."""
+    host = _host(url)
+    policy = policy_for(host)
+    if _circuit_is_open(host):
+        raise httpx.ConnectError(f"Circuit open for {host}")
+    if timeout is None:
+        timeout = httpx.Timeout(policy.read_timeout, connect=policy.connect_timeout)
+    started = time.monotonic()
+    try:
+        response = await _async_client(host).request(
+            method, url, timeout=timeout, **kwargs
+        )
+    except httpx.HTTPError as exc:
+        _settle(host, started, error=exc)
+        raise
+    except BaseException:
+        # Cancelled (a client disconnect under ASGI) or otherwise cut short:
+        # the host gave no answer, but a half-open trial must not stay taken.
+        _breaker(host).release_trial()
+        raise
+    _settle(host, started, status_code=response.status_code)
+    return response
+
+
+async def aget(url, **kwargs):
+    return await arequest("GET", url, **kwargs)
+
+
+async def apost(url, **kwargs):
+    return await arequest("POST", url, **kwargs)
+
+
+def metrics():
+    """Per-host call counts, error counts, latency and circuit state."""
+    with _lock:
+        hosts = set(_stats) | set(_breakers)
+        snapshot = {
+            host: _stats.get(host, HostStats()).as_dict() for host in sorted(hosts)
+        }
+    for host, entry in snapshot.items():
+        entry["circuit"] = _breaker(host).state
+    return snapshot
+
+
+def reset():
+    """Drop circuit state and metrics (used by tests)."""
+    with _lock:
+        _breakers.clear()
+        _stats.clear()
@@ -1,26 +1,89 @@
+import asyncio
 import base64
+import hashlib
 import json
 import logging
+import time
+import uuid
+from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
+from functools import partial
 
-import requests
+import httpx
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.http import JsonResponse
 from django.utils import timezone
 from django.views.decorators.http import require_http_methods
-from django_ratelimit.decorators import ratelimit
 
+from . import jobs, outbound, pricing, rollups
+from .idempotency import idempotent, keep_key
 from .models import MpesaPayment, Order, OrderItem, Payment, Product
+from .ratelimit import hit, is_limited, parse_rate
 
 logger = logging.getLogger("shop")
 
+MPESA_TOKEN_CACHE_KEY = "mpesa_token:{digest}"
+# Renew the OAuth token this long before Daraja expires it.
+MPESA_TOKEN_RENEW_MARGIN = 300
+MPESA_TOKEN_LOCK_SECONDS = 30
+MPESA_TOKEN_LOCK_WAIT = 5.0
 
-def create_order_and_payment(
-    data, request, amount, payment_method, payment_status="pending"
-):
-    """Create order + payment records when order payload is available."""
+# Pending payments are settled by the callback or ``manage.py reconcile_mpesa``;
+# a status poll only queries Daraja itself once a payment has been pending this
+# long, and then at most once per this many seconds.
+STATUS_REFRESH_AFTER = 10
+STK_QUERY_KEY = "mpesa:stkquery"
+# Daraja's answer to a query for a push the customer has not acted on yet.
+STK_PROCESSING_ERROR = "500.001.1001"
+
+
+class InvalidOrder(ValueError):
+    """Raised when an order payload holds a line that cannot be priced."""
+
+
+@dataclass
+class PricedOrder:
+    user: object
+    shipping_address: dict
+    # Unsaved ``OrderItem`` rows, priced on the server.
+    items: list
+
+    @property
+    def total(self):
+        """What the order costs: its lines plus shipping."""
+        lines = sum((item.price * item.quantity for item in self.items), Decimal(0))
+        return lines + pricing.SHIPPING_FEE
+
+
+def _parse_line(index, item):
+    """``(product_id, quantity)`` of one order line; raises ``InvalidOrder``."""
+    if not isinstance(item, dict):
+        raise InvalidOrder(f"Item {index}: invalid line")
+    # GraphQL sends product IDs as strings.
+    try:
+        product_id = int(item.get("productId"))
+    except (TypeError, ValueError):
+        raise InvalidOrder(f"Item {index}: invalid productId")
+    try:
+        quantity = int(item.get("quantity", 1))
+    except (TypeError, ValueError):
+        raise InvalidOrder(f"Item {index}: invalid quantity")
+    if quantity < 1:
+        raise InvalidOrder(f"Item {index}: quantity must be at least 1")
+    return product_id, quantity
+
+
+def price_order(data, request):
+    """Price the order in a payment payload, or None when there is no order.
+
+    Lines that are in the user's cart take their price from its priced
+    snapshot; the rest are priced from the product. Raises ``InvalidOrder``
+    for an order without items or with a line that cannot be priced.
+    """
     order_data = data.get("order_data") or {}
     shipping_address = order_data.get("shippingAddress") or {}
 
@@ -31,35 +94,75 @@ def create_order_and_payment(
     if not user or not getattr(user, "is_authenticated", False):
         return None
 
+    lines = [
+        (*_parse_line(index, item), item)
+        for index, item in enumerate(order_data.get("items") or [])
+    ]
+    if not lines:
+        raise InvalidOrder("Order has no items")
+    products = Product.objects.in_bulk({product_id for product_id, _, _ in lines})
+    priced_cart = pricing.price_cart(user)
+    items = []
+    for index, (product_id, quantity, item) in enumerate(lines):
+        product = products.get(product_id)
+        if not product:
+            raise InvalidOrder(f"Item {index}: product not found")
+        size, color = item.get("size", ""), item.get("color", "")
+        priced = priced_cart.line_for(product.pk, size, color)
+        if priced is not None:
+            price = priced.unit_price
+        else:
+            price = pricing.convert(pricing.unit_price(product), product.currency)
+        items.append(
+            OrderItem(
+                product=product,
+                quantity=quantity,
+                price=price,
+                selected_size=size,
+                selected_color=color,
+            )
+        )
+    return PricedOrder(user, shipping_address, items)
+
+
+def _underpaid_response(amount, order):
+    """A 400 response when ``amount`` does not cover the priced order."""
+    if order is None or amount >= order.total:
+        return None
+    return JsonResponse(
+        {
+            "success": False,
+            "error": f"Payment amount is below the order total of {order.total}",
+        },
+        status=400,
+    )
+
+
+def create_order_and_payment(
+    data, request, amount, payment_method, payment_status="pending", order=None
+):
+    """Create order + payment records when order payload is available."""
+    if order is None:
+        order = price_order(data, request)
+    if order is None:
+        return None
+
     with transaction.atomic():
-        order = Order.objects.create(
-            user=user,
+        record = Order.objects.create(
+            user=order.user,
             order_id=f"ARNOVA{timezone.now().strftime('%Y%m%d%H%M%S%f')}",
             total_amount=amount,
-            shipping_address=json.dumps(shipping_address),
+            shipping_address=json.dumps(order.shipping_address),
             status="pending",
         )
-
-        for item in order_data.get("items", []):
-            product_id = item.get("productId")
-            if not product_id:
-                continue
-
-            product = Product.objects.filter(id=product_id).first()
-            if not product:
-                continue
-
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=max(1, int(item.get("quantity", 1))),
-                price=Decimal(str(item.get("price", product.price))),
-                selected_size=item.get("size", ""),
-                selected_color=item.get("color", ""),
-            )
+        for item in order.items:
+            item.order = record
+        OrderItem.objects.bulk_create(order.items)
+        # bulk_create skips post_save, so feed the rollups directly.
+        transaction.on_commit(partial(rollups.record_order_items, order.items))
 
         return Payment.objects.create(
-            order=order,
+            order=record,
             payment_method=payment_method,
             amount=amount,
             currency="KES" if payment_method == "mpesa" else "USD",
@@ -67,8 +170,14 @@ def create_order_and_payment(
         )
 
 
-def get_mpesa_access_token():
-    """Get M-Pesa access token using OAuth"""
+def _mpesa_url(path):
+    """Daraja API URL for ``path`` in the configured environment."""
+    if settings.MPESA_ENVIRONMENT == "sandbox":
+        return f"https://sandbox.safaricom.co.ke/{path}"
+    return f"https://api.safaricom.co.ke/{path}"
+
+
+def _access_token_request():
     consumer_key = settings.MPESA_CONSUMER_KEY
     consumer_secret = settings.MPESA_CONSUMER_SECRET
 
@@ -77,28 +186,92 @@ def get_mpesa_access_token():
         f"{consumer_key}:{consumer_secret}".encode()
     ).decode()
 
-    # Determine environment
-    if settings.MPESA_ENVIRONMENT == "sandbox":
-        url = (
-            "https://sandbox.safaricom.co.ke/oauth/v1/generate?"
-            "grant_type=client_credentials"
-        )
-    else:
-        url = (
-            "https://api.safaricom.co.ke/oauth/v1/generate?"
-            "grant_type=client_credentials"
-        )
-
+    url = _mpesa_url("oauth/v1/generate?grant_type=client_credentials")
     headers = {"Authorization": f"Basic {credentials}"}
+    return url, headers
+
+
+def _token_cache_key():
+    credentials = f"{settings.MPESA_ENVIRONMENT}:{settings.MPESA_CONSUMER_KEY}"
+    return MPESA_TOKEN_CACHE_KEY.format(
+        digest=hashlib.sha256(credentials.encode()).hexdigest()[:16]
+    )
+
+
+def _token_entry(payload):
+    token = payload.get("access_token")
+    if not token:
+        raise Exception("Failed to get M-Pesa access token: empty response")
+    expires_in = int(payload.get("expires_in") or 3599)
+    return {"token": token, "expires_at": time.time() + expires_in}
+
+
+def _token_is_fresh(entry):
+    if entry is None:
+        return False
+    return entry["expires_at"] - time.time() > MPESA_TOKEN_RENEW_MARGIN
+
+
+def _token_is_usable(entry):
+    return entry is not None and entry["expires_at"] - time.time() > 5
+
 
+def _token_timeout(entry):
+    return max(int(entry["expires_at"] - time.time()) - 5, 1)
+
+
+async def _fetch_mpesa_access_token():
+    url, headers = _access_token_request()
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = await outbound.aget(url, headers=headers)
         response.raise_for_status()
-        return response.json().get("access_token")
-    except requests.RequestException as e:
+        return _token_entry(response.json())
+    except httpx.HTTPError as e:
         raise Exception(f"Failed to get M-Pesa access token: {str(e)}")
 
 
+async def get_mpesa_access_token():
+    """Get M-Pesa access token using OAuth
+
+    The token lives in the shared cache until shortly before it expires.
+    Within MPESA_TOKEN_RENEW_MARGIN of expiry one worker renews it under a
+    lock while the others keep using the current one.
+    """
+    key = _token_cache_key()
+    entry = await cache.aget(key)
+    if _token_is_fresh(entry):
+        return entry["token"]
+
+    lock_key = f"{key}:lock"
+    lock = uuid.uuid4().hex
+    if await cache.aadd(lock_key, lock, MPESA_TOKEN_LOCK_SECONDS):
+        try:
+            renewed = await _fetch_mpesa_access_token()
+            await cache.aset(key, renewed, _token_timeout(renewed))
+            return renewed["token"]
+        except Exception:
+            if not _token_is_usable(entry):
+                raise
+            logger.warning("M-Pesa token renewal failed; using current token")
+            return entry["token"]
+        finally:
+            if await cache.aget(lock_key) == lock:
+                await cache.adelete(lock_key)
+
+    if _token_is_usable(entry):
+        return entry["token"]
+    # Another worker is fetching the first token; wait briefly for it.
+    deadline = time.monotonic() + MPESA_TOKEN_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+        entry = await cache.aget(key)
+        if _token_is_usable(entry):
+            return entry["token"]
+    renewed = await _fetch_mpesa_access_token()
+    await cache.aset(key, renewed, _token_timeout(renewed))
+    return renewed["token"]
+
+
 def generate_mpesa_password():
     """Generate M-Pesa password for STK Push"""
     shortcode = settings.MPESA_SHORTCODE
@@ -111,11 +284,16 @@ def generate_mpesa_password():
     return password, timestamp
 
 
-@ratelimit(key="user_or_ip", rate="10/h", method="POST")
+@idempotent("payments")
 @require_http_methods(["POST"])
-def process_payment(request):
-    """Process payment for orders"""
-    if getattr(request, "limited", False):
+async def process_payment(request):
+    """Process payment for orders
+
+    Serves the REST endpoint and the GraphQL mutation, which share one
+    rate-limit bucket; M-Pesa requests await the Daraja API instead of
+    holding a worker thread.
+    """
+    if is_limited(request, "payments", key="user_or_ip", rate="10/h"):
         return JsonResponse(
             {"success": False, "error": "Too many payment attempts"},
             status=429,
@@ -125,19 +303,28 @@ def process_payment(request):
         data = json.loads(request.body)
         payment_method = data.get("payment_method")
         amount = Decimal(str(data.get("amount", 0)))
+        order = await sync_to_async(price_order)(data, request)
+        underpaid = _underpaid_response(amount, order)
+        if underpaid is not None:
+            return underpaid
+        if order is not None:
+            # Charge what the server priced, not what the client sent.
+            amount = order.total
 
         if payment_method == "card":
             return process_card_payment(data, amount)
         elif payment_method == "paypal":
             return process_paypal_payment(data, amount)
         elif payment_method == "mpesa":
-            return process_mpesa_payment(data, amount, request)
+            return await process_mpesa_payment(data, amount, request, order)
         else:
             return JsonResponse(
                 {"success": False, "error": "Invalid payment method"},
                 status=400,
             )
 
+    except InvalidOrder as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
     except Exception as e:
         logger.exception("Payment processing failed: %s", e)
         return JsonResponse(
@@ -146,7 +333,60 @@ def process_payment(request):
         )
 
 
-def process_mpesa_payment(data, amount, request):
+def format_phone_number(phone_number):
+    """Normalise a Kenyan phone number to the 2547XXXXXXXX form."""
+    if phone_number.startswith("0"):
+        return "254" + phone_number[1:]
+    if phone_number.startswith("+254"):
+        return phone_number[1:]
+    if not phone_number.startswith("254"):
+        return "254" + phone_number
+    return phone_number
+
+
+def _stk_push_request(access_token, phone_number, amount):
+    password, timestamp = generate_mpesa_password()
+    url = _mpesa_url("mpesa/stkpush/v1/processrequest")
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": int(amount),
+        "PartyA": phone_number,
+        "PartyB": settings.MPESA_SHORTCODE,
+        "PhoneNumber": phone_number,
+        "CallBackURL": settings.MPESA_CALLBACK_URL,
+        "AccountReference": (f"ARNOVA{timezone.now().strftime('%Y%m%d%H%M%S')}"),
+        "TransactionDesc": "Arnova Purchase",
+    }
+    return url, payload, headers
+
+
+def _stk_push_response(result):
+    if result.get("ResponseCode") == "0":
+        return JsonResponse(
+            {
+                "success": True,
+                "checkout_request_id": result.get("CheckoutRequestID"),
+                "merchant_request_id": result.get("MerchantRequestID"),
+                "message": ("STK Push sent successfully. Please check your phone."),
+            }
+        )
+    return JsonResponse(
+        {
+            "success": False,
+            "error": result.get("errorMessage", "M-Pesa payment failed"),
+        },
+        status=400,
+    )
+
+
+async def process_mpesa_payment(data, amount, request, order=None):
     """Process M-Pesa STK Push payment"""
     try:
         phone_number = data.get("phone_number")
@@ -155,63 +395,48 @@ def process_mpesa_payment(data, amount, request):
                 {"success": False, "error": "Phone number is required"},
                 status=400,
             )
-
-        # Format phone number (ensure it starts with 254)
-        if phone_number.startswith("0"):
-            phone_number = "254" + phone_number[1:]
-        elif phone_number.startswith("+254"):
-            phone_number = phone_number[1:]
-        elif not phone_number.startswith("254"):
-            phone_number = "254" + phone_number
-
-        # Get access token
-        access_token = get_mpesa_access_token()
-
-        # Generate password and timestamp
-        password, timestamp = generate_mpesa_password()
-
-        # Determine environment URL
-        if settings.MPESA_ENVIRONMENT == "sandbox":
-            url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/" "processrequest"
-        else:
-            url = "https://api.safaricom.co.ke/mpesa/stkpush/v1/" "processrequest"
-
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
-
-        payload = {
-            "BusinessShortCode": settings.MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount),
-            "PartyA": phone_number,
-            "PartyB": settings.MPESA_SHORTCODE,
-            "PhoneNumber": phone_number,
-            "CallBackURL": settings.MPESA_CALLBACK_URL,
-            "AccountReference": (f"ARNOVA{timezone.now().strftime('%Y%m%d%H%M%S')}"),
-            "TransactionDesc": "Arnova Purchase",
-        }
-
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        phone_number = format_phone_number(phone_number)
+
+        access_token = await get_mpesa_access_token()
+        url, payload, headers = _stk_push_request(access_token, phone_number, amount)
+
+        try:
+            response = await outbound.apost(url, json=payload, headers=headers)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            raise
+        except Exception as e:
+            # The push may have reached Daraja before the call failed, so a
+            # retry with the same key must not send a second one.
+            logger.exception("M-Pesa STK push outcome unknown: %s", e)
+            return keep_key(
+                JsonResponse(
+                    {
+                        "success": False,
+                        "error": "M-Pesa payment status unknown; check your "
+                        "phone before trying again",
+                    },
+                    status=502,
+                )
+            )
         response.raise_for_status()
 
         result = response.json()
 
         if result.get("ResponseCode") == "0":
             try:
-                payment = create_order_and_payment(
+                # The order rows are written in one transaction, which the
+                # async ORM cannot span, so that part runs in a thread.
+                payment = await sync_to_async(create_order_and_payment)(
                     data,
                     request,
                     amount,
                     payment_method="mpesa",
                     payment_status="processing",
+                    order=order,
                 )
 
                 if payment is not None:
-                    MpesaPayment.objects.create(
+                    await MpesaPayment.objects.acreate(
                         payment=payment,
                         phone_number=phone_number,
                         checkout_request_id=result.get("CheckoutRequestID"),
@@ -220,22 +445,7 @@ def process_mpesa_payment(data, amount, request):
             except Exception as e:
                 logger.exception("Error creating M-Pesa payment records: %s", e)
 
-            return JsonResponse(
-                {
-                    "success": True,
-                    "checkout_request_id": result.get("CheckoutRequestID"),
-                    "merchant_request_id": result.get("MerchantRequestID"),
-                    "message": ("STK Push sent successfully. Please check your phone."),
-                }
-            )
-        else:
-            return JsonResponse(
-                {
-                    "success": False,
-                    "error": result.get("errorMessage", "M-Pesa payment failed"),
-                },
-                status=400,
-            )
+        return _stk_push_response(result)
 
     except Exception as e:
         logger.exception("M-Pesa payment failed: %s", e)
@@ -247,88 +457,145 @@ def process_mpesa_payment(data, amount, request):
 
 @require_http_methods(["POST"])
 def mpesa_callback(request):
-    """Handle M-Pesa payment callback"""
+    """Acknowledge an M-Pesa callback; the payment is updated by a job
+
+    Without a durable job queue the callback is applied before it is
+    acknowledged: Safaricom stops redelivering once we answer, so a job lost
+    to a restart would never be applied.
+    """
     try:
         data = json.loads(request.body)
-
-        # Extract callback data
         stk_callback = data.get("Body", {}).get("stkCallback", {})
-        result_code = stk_callback.get("ResultCode")
-        result_desc = stk_callback.get("ResultDesc")
+        if not jobs.durable():
+            apply_mpesa_callback(stk_callback)
+            return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
         checkout_request_id = stk_callback.get("CheckoutRequestID")
+        # Safaricom may deliver the same callback more than once.
+        key = f"mpesa-callback:{checkout_request_id}" if checkout_request_id else None
+        jobs.enqueue("mpesa.callback", {"callback": stk_callback}, key=key)
+        return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
 
-        if result_code == 0:
-            # Payment successful
-            callback_metadata = stk_callback.get("CallbackMetadata", {}).get("Item", [])
-
-            # Extract payment details
-            payment_data = {}
-            for item in callback_metadata:
-                name = item.get("Name")
-                value = item.get("Value")
-                if name == "Amount":
-                    payment_data["amount"] = value
-                elif name == "MpesaReceiptNumber":
-                    payment_data["receipt_number"] = value
-                elif name == "TransactionDate":
-                    payment_data["transaction_date"] = value
-                elif name == "PhoneNumber":
-                    payment_data["phone_number"] = value
-
-            # Update M-Pesa payment record
-            try:
-                mpesa_payment = MpesaPayment.objects.get(
-                    checkout_request_id=checkout_request_id
-                )
-                mpesa_payment.mpesa_receipt_number = payment_data.get(
-                    "receipt_number", ""
-                )
-                mpesa_payment.result_code = "0"
-                mpesa_payment.result_desc = result_desc
-                mpesa_payment.transaction_date = timezone.now()
-                mpesa_payment.save()
-
-                # Update payment status
-                mpesa_payment.payment.status = "completed"
-                mpesa_payment.payment.transaction_id = payment_data.get(
-                    "receipt_number", ""
-                )
-                mpesa_payment.payment.save()
+    except Exception as e:
+        logger.error(f"M-Pesa callback error: {str(e)}")
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Error"})
 
-            except MpesaPayment.DoesNotExist:
-                logger.warning(
-                    f"M-Pesa payment record not found for "
-                    f"checkout_request_id: {checkout_request_id}"
-                )
 
-            logger.info(f"M-Pesa payment successful: {payment_data}")
-        else:
-            # Payment failed
-            try:
-                mpesa_payment = MpesaPayment.objects.get(
-                    checkout_request_id=checkout_request_id
-                )
-                mpesa_payment.result_code = str(result_code)
-                mpesa_payment.result_desc = result_desc
-                mpesa_payment.save()
-
-                # Update payment status
-                mpesa_payment.payment.status = "failed"
-                mpesa_payment.payment.save()
-
-            except MpesaPayment.DoesNotExist:
-                logger.warning(
-                    f"M-Pesa payment record not found for "
-                    f"checkout_request_id: {checkout_request_id}"
-                )
+def _callback_metadata(stk_callback):
+    names = {
+        "Amount": "amount",
+        "MpesaReceiptNumber": "receipt_number",
+        "TransactionDate": "transaction_date",
+        "PhoneNumber": "phone_number",
+    }
+    items = stk_callback.get("CallbackMetadata", {}).get("Item", [])
+    return {
+        names[item.get("Name")]: item.get("Value")
+        for item in items
+        if item.get("Name") in names
+    }
+
+
+def _stk_result(data):
+    """Normalize an STK push callback or status query response."""
+    metadata = _callback_metadata(data)
+    return {
+        "checkout_request_id": data.get("CheckoutRequestID"),
+        "result_code": str(data.get("ResultCode")),
+        "result_desc": data.get("ResultDesc") or "",
+        "receipt_number": (
+            metadata.get("receipt_number") or data.get("MpesaReceiptNumber") or ""
+        ),
+    }
+
+
+def _result_notification(order, result):
+    if result["result_code"] == "0":
+        return (
+            "Payment received",
+            f"We received your M-Pesa payment for order {order.order_id}.",
+        )
+    return (
+        "Payment failed",
+        f"Your M-Pesa payment for order {order.order_id} did not go through: "
+        f"{result['result_desc']}",
+    )
 
-            logger.warning(f"M-Pesa payment failed: {result_desc}")
 
-        return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+def apply_stk_results(results):
+    """Record final STK push results on their payments and orders in bulk.
 
-    except Exception as e:
-        logger.error(f"M-Pesa callback error: {str(e)}")
-        return JsonResponse({"ResultCode": 1, "ResultDesc": "Error"})
+    Payments that already have a result are skipped, so the callback and
+    reconciliation can race safely. Returns the ``MpesaPayment`` rows updated.
+    """
+    by_id = {result["checkout_request_id"]: result for result in results}
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            MpesaPayment.objects.select_for_update()
+            .select_related("payment__order")
+            .filter(checkout_request_id__in=by_id, result_code="")
+        )
+        paid_orders = []
+        for row in rows:
+            result = by_id[row.checkout_request_id]
+            payment = row.payment
+            row.result_code = result["result_code"]
+            row.result_desc = result["result_desc"]
+            row.updated_at = payment.updated_at = now
+            if result["result_code"] == "0":
+                row.mpesa_receipt_number = result["receipt_number"]
+                row.transaction_date = now
+                payment.status = "completed"
+                payment.transaction_id = result["receipt_number"]
+                payment.order.status = "processing"
+                payment.order.updated_at = now
+                paid_orders.append(payment.order)
+            else:
+                payment.status = "failed"
+            title, message = _result_notification(payment.order, result)
+            jobs.enqueue(
+                "notifications.create",
+                {
+                    "user_id": payment.order.user_id,
+                    "title": title,
+                    "message": message,
+                    "notification_type": "order",
+                },
+            )
+
+        MpesaPayment.objects.bulk_update(
+            rows,
+            [
+                "result_code",
+                "result_desc",
+                "mpesa_receipt_number",
+                "transaction_date",
+                "updated_at",
+            ],
+        )
+        Payment.objects.bulk_update(
+            [row.payment for row in rows], ["status", "transaction_id", "updated_at"]
+        )
+        Order.objects.bulk_update(paid_orders, ["status", "updated_at"])
+    return rows
+
+
+@jobs.handler("mpesa.callback")
+def apply_mpesa_callback(callback):
+    """Job: record an STK push result on the payment and its order"""
+    result = _stk_result(callback)
+    if apply_stk_results([result]):
+        if result["result_code"] == "0":
+            logger.info(f"M-Pesa payment successful: {_callback_metadata(callback)}")
+        else:
+            logger.warning(f"M-Pesa payment failed: {result['result_desc']}")
+    elif not MpesaPayment.objects.filter(
+        checkout_request_id=result["checkout_request_id"]
+    ).exists():
+        logger.warning(
+            f"M-Pesa payment record not found for "
+            f"checkout_request_id: {result['checkout_request_id']}"
+        )
 
 
 def process_card_payment(data, amount):
@@ -375,61 +642,109 @@ def process_paypal_payment(data, amount):
     )
 
 
-@require_http_methods(["GET"])
-def check_mpesa_status(request, checkout_request_id):
-    """Check M-Pesa payment status"""
-    try:
-        # Get access token
-        access_token = get_mpesa_access_token()
+def _stk_query_request(access_token, checkout_request_id):
+    password, timestamp = generate_mpesa_password()
+    url = _mpesa_url("mpesa/stkpushquery/v1/query")
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id,
+    }
+    return url, payload, headers
 
-        # Generate password and timestamp
-        password, timestamp = generate_mpesa_password()
 
-        # Determine environment URL
-        if settings.MPESA_ENVIRONMENT == "sandbox":
-            url = "https://sandbox.safaricom.co.ke/mpesa/stkpushquery/v1/" "query"
-        else:
-            url = "https://api.safaricom.co.ke/mpesa/stkpushquery/v1/" "query"
-
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
+def stk_query_budget():
+    """Take one STK query from the budget shared by pollers and reconciliation."""
+    limit, window = parse_rate(getattr(settings, "MPESA_QUERY_RATE", "5/s"))
+    return hit(STK_QUERY_KEY, limit, window)
 
-        payload = {
-            "BusinessShortCode": settings.MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id,
-        }
 
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+def _stk_query_result(response, checkout_request_id):
+    """The final result in an STK query response, or None while pending."""
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if "ResultCode" in data:
+        return _stk_result({"CheckoutRequestID": checkout_request_id, **data})
+    if data.get("errorCode") != STK_PROCESSING_ERROR:
         response.raise_for_status()
+    return None
+
+
+async def query_stk_status(checkout_request_id, access_token):
+    """Ask Daraja for an STK push result; None while it is still pending."""
+    url, payload, headers = _stk_query_request(access_token, checkout_request_id)
+    response = await outbound.apost(url, json=payload, headers=headers)
+    return _stk_query_result(response, checkout_request_id)
+
+
+def _status_refresh_due(mpesa_payment):
+    """Whether a poll should ask Daraja about a payment that is still pending.
+
+    Only once the payment has waited ``STATUS_REFRESH_AFTER`` seconds for its
+    callback, then at most once per interval however many clients poll.
+    """
+    if mpesa_payment is None or mpesa_payment.result_code:
+        return False
+    age = (timezone.now() - mpesa_payment.created_at).total_seconds()
+    return (
+        age >= STATUS_REFRESH_AFTER
+        and cache.add(
+            f"mpesa_status_refresh:{mpesa_payment.checkout_request_id}",
+            1,
+            STATUS_REFRESH_AFTER,
+        )
+        and stk_query_budget().allowed
+    )
 
-        result = response.json()
 
+def _mpesa_status_response(mpesa_payment):
+    if mpesa_payment is None:
         return JsonResponse(
-            {
-                "status": (
-                    "success"
-                    if result.get("ResultCode") == "0"
-                    else ("pending" if result.get("ResultCode") == "1032" else "failed")
-                ),
-                "result_code": result.get("ResultCode", "1"),
-                "result_desc": result.get("ResultDesc", "Unknown status"),
-                "transaction_id": result.get("MpesaReceiptNumber"),
-            }
+            {"status": "failed", "result_code": "1", "result_desc": "Unknown payment"},
+            status=404,
         )
+    result_code = mpesa_payment.result_code
+    if not result_code:
+        status = "pending"
+    else:
+        status = "success" if result_code == "0" else "failed"
+    return JsonResponse(
+        {
+            "status": status,
+            "result_code": result_code,
+            "result_desc": mpesa_payment.result_desc
+            or "Waiting for the customer to confirm the payment",
+            "transaction_id": mpesa_payment.mpesa_receipt_number or None,
+        }
+    )
 
-    except Exception as e:
-        return JsonResponse(
-            {
-                "status": "failed",
-                "result_code": "1",
-                "result_desc": f"Status check failed: {str(e)}",
-            },
-            status=500,
-        )
+
+async def mpesa_status(checkout_request_id):
+    """M-Pesa payment status from the stored callback result
+
+    A payment still pending after ``STATUS_REFRESH_AFTER`` is queried from
+    Daraja, within the shared STK query budget.
+    """
+    mpesa_payment = await MpesaPayment.objects.filter(
+        checkout_request_id=checkout_request_id
+    ).afirst()
+    if _status_refresh_due(mpesa_payment):
+        try:
+            access_token = await get_mpesa_access_token()
+            result = await query_stk_status(checkout_request_id, access_token)
+            if result is not None:
+                applied = await sync_to_async(apply_stk_results)([result])
+                mpesa_payment = applied[0] if applied else mpesa_payment
+        except Exception as e:
+            logger.warning("M-Pesa status query failed: %s", e)
+    return _mpesa_status_response(mpesa_payment)
 
 
 @require_http_methods(["POST"])
@@ -0,0 +1,97 @@
+"""Cart pricing: selling prices, sale discounts and currency in one pass.
+
+``price_lines`` prices a list of cart lines in the store currency: each line
+sells at its product's sale price when on sale, and amounts in other
+currencies are converted with the cached exchange-rate snapshot.
+``price_cart`` prices a user's cart through ``cache_query``, keyed by the
+cart's version (the ``cart:{id}`` tag, bumped by every cart change) and the
+``catalog`` tag (bumped by every product save), so a cart is re-priced only
+after it or a price changes. Checkout reads order line prices from the same
+snapshot and charges their total plus ``SHIPPING_FEE``, whatever amount the
+client sent.
+"""
+
+from dataclasses import dataclass, field
+from decimal import ROUND_HALF_UP, Decimal
+
+from . import carts, exchange_rates
+from .cache_utils import cache_query
+
+CURRENCY = "KES"
+# Bounds how long a snapshot keeps an outdated exchange rate.
+PRICED_CART_TTL = 300
+CENT = Decimal("0.01")
+# Flat shipping charge added to every order; the checkout page shows the same.
+SHIPPING_FEE = Decimal("1.00")
+
+
+def unit_price(product):
+    """The price a product sells for right now."""
+    if product.on_sale and product.sale_price:
+        return product.sale_price
+    return product.price
+
+
+def convert(amount, from_currency, to_currency=CURRENCY):
+    """``amount`` in ``to_currency``, rounded to the cent."""
+    rate = Decimal(str(exchange_rates.get_rate(from_currency, to_currency)))
+    return (Decimal(amount) * rate).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+@dataclass
+class PricedLine:
+    line: carts.CartLine
+    unit_price: Decimal
+    list_price: Decimal
+
+    @property
+    def total(self):
+        return self.unit_price * self.line.quantity
+
+    @property
+    def discount(self):
+        return (self.list_price - self.unit_price) * self.line.quantity
+
+
+@dataclass
+class PricedCart:
+    currency: str
+    lines: list = field(default_factory=list)
+    item_count: int = 0
+    # At selling prices; ``discount`` is what sale prices save on list prices.
+    subtotal: Decimal = Decimal("0")
+    discount: Decimal = Decimal("0")
+
+    def line_for(self, product_id, selected_size="", selected_color=""):
+        """The priced line for a product/size/colour, or None."""
+        for priced in self.lines:
+            line = priced.line
+            if (line.product_id, line.selected_size, line.selected_color) == (
+                product_id,
+                selected_size,
+                selected_color,
+            ):
+                return priced
+        return None
+
+
+def price_lines(cart_lines, currency=CURRENCY):
+    priced = PricedCart(currency=currency)
+    for line in cart_lines:
+        product = line.product
+        entry = PricedLine(
+            line=line,
+            unit_price=convert(unit_price(product), product.currency, currency),
+            list_price=convert(product.price, product.currency, currency),
+        )
+        priced.lines.append(entry)
+        priced.item_count += line.quantity
+        priced.subtotal += entry.total
+        priced.discount += entry.discount
+    return priced
+
+
+@cache_query(timeout=PRICED_CART_TTL, tags=["cart:{user.pk}", "catalog"])
+def price_cart(user, currency=CURRENCY):
+    """The user's priced cart, cached until the cart or a product changes."""
+    return price_lines(carts.lines(user), currency)
@@ -0,0 +1,162 @@
+"""Shared rate limiting for the REST views and GraphQL resolvers.
+
+Limits use GCRA (the generic cell rate algorithm): each key stores one
+timestamp, the "theoretical arrival time" of the next request, and a check
+is a single Lua script run atomically in Redis, so concurrent requests can
+neither lose increments nor reset the window. ``rate="5/m"`` allows a burst
+of five and then one request every twelve seconds.
+
+When Redis is not configured or cannot be reached, checks fall back to an
+in-process token bucket with the same rate; limits are then enforced per
+worker rather than globally.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import NamedTuple
+
+from django.conf import settings
+
+logger = logging.getLogger("shop")
+
+KEY_PREFIX = "arnova:rl"
+LOCAL_MAX_KEYS = 10000
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# KEYS[1]: the limit's key. ARGV: now, emission interval, burst tolerance
+# (all in milliseconds). Returns {allowed, remaining, retry_after_ms}.
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local tat = tonumber(redis.call("GET", KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+local allow_at = new_tat - tolerance
+if allow_at > now then
+    return {0, 0, allow_at - now}
+end
+redis.call("SET", KEYS[1], new_tat, "PX", math.ceil(new_tat - now))
+return {1, math.floor((now - allow_at) / interval), 0}
+"""
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    remaining: int
+    retry_after: float
+
+
+class LocalBuckets:
+    """Per-process token buckets, used when Redis is unavailable."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        rate = limit / window
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (limit, now))
+            tokens = min(limit, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        retry_after = 0 if allowed else (1 - tokens) / rate
+        return RateLimitResult(allowed, int(tokens), retry_after)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+local_buckets = LocalBuckets(LOCAL_MAX_KEYS)
+_script = None
+
+
+def _uses_redis():
+    return "django_redis" in settings.CACHES["default"]["BACKEND"]
+
+
+def _gcra_script():
+    global _script
+    if _script is None:
+        from django_redis import get_redis_connection
+
+        _script = get_redis_connection("default").register_script(GCRA_SCRIPT)
+    return _script
+
+
+def parse_rate(rate):
+    """``"10/h"`` -> ``(10, 3600)``; the period may carry a count (``"5/10m"``)."""
+    count, period = rate.split("/")
+    multiplier = int(period[:-1] or 1)
+    return int(count), multiplier * PERIODS[period[-1]]
+
+
+def hit(key, limit, window):
+    """Count one request against ``key``; at most ``limit`` per ``window``."""
+    key = f"{KEY_PREFIX}:{key}"
+    if _uses_redis():
+        interval = window * 1000 / limit
+        try:
+            allowed, remaining, retry_after = _gcra_script()(
+                keys=[key],
+                args=[int(time.time() * 1000), interval, window * 1000],
+            )
+            return RateLimitResult(bool(allowed), remaining, retry_after / 1000)
+        except Exception as exc:
+            logger.warning("Rate limit check failed for %s: %s", key, exc)
+    return local_buckets.hit(key, limit, window)
+
+
+def reset():
+    """Forget the in-process buckets (used by tests)."""
+    local_buckets.clear()
+
+
+def client_key(request, key="ip"):
+    """Identify the caller: ``"ip"`` or ``"user_or_ip"``."""
+    user = getattr(request, "user", None)
+    if key == "user_or_ip" and user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"ip:{request.META.get('REMOTE_ADDR', 'unknown')}"
+
+
+def is_limited(request, group, key="ip", rate="5/m"):
+    limit, window = parse_rate(rate)
+    return not hit(f"{group}:{client_key(request, key)}", limit, window).allowed
+
+
+def ratelimit(key="ip", rate="5/m", method="POST", group=None):
+    """Mark over-limit requests with ``request.limited = True``.
+
+    Only requests whose method is in ``method`` are counted; the view decides
+    how to answer a limited request.
+    """
+    methods = {method} if isinstance(method, str) else set(method)
+
+    def decorator(view):
+        bucket = group or f"{view.__module__}.{view.__qualname__}"
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            limited = request.method in methods and is_limited(
+                request, bucket, key, rate
+            )
+            request.limited = getattr(request, "limited", False) or limited
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
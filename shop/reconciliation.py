@@ -0,0 +1,100 @@
+"""Settle M-Pesa payments whose STK push callback never arrived.
+
+A sweep picks up payments that have been pending for a while, asks Daraja
+for each result with bounded concurrency (paced by the same shared query
+budget as status polls) and records every final result in one bulk update.
+
+Each new STK push queues one delayed ``mpesa.reconcile`` job, which sweeps
+again every ``MPESA_RECONCILE_INTERVAL`` seconds while any payment is still
+pending. ``manage.py reconcile_mpesa`` runs a sweep on demand.
+"""
+
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import jobs, payment_views
+from .models import MpesaPayment
+
+logger = logging.getLogger("shop")
+
+SCHEDULED_KEY = "mpesa:reconcile_scheduled"
+
+
+def stale_payments(min_age=60, max_age=24 * 3600, limit=200):
+    """Checkout ids of payments pending for ``min_age``..``max_age`` seconds."""
+    now = timezone.now()
+    return list(
+        MpesaPayment.objects.filter(
+            result_code="",
+            payment__status__in=("pending", "processing"),
+            created_at__lte=now - timedelta(seconds=min_age),
+            created_at__gte=now - timedelta(seconds=max_age),
+        )
+        .order_by("created_at")
+        .values_list("checkout_request_id", flat=True)[:limit]
+    )
+
+
+async def _wait_for_budget():
+    while True:
+        budget = payment_views.stk_query_budget()
+        if budget.allowed:
+            return
+        await asyncio.sleep(budget.retry_after)
+
+
+async def query_results(checkout_request_ids, concurrency=5):
+    """Final results for the given pushes; pending or failed queries are left out."""
+    access_token = await payment_views.get_mpesa_access_token()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query(checkout_request_id):
+        async with semaphore:
+            await _wait_for_budget()
+            try:
+                return await payment_views.query_stk_status(
+                    checkout_request_id, access_token
+                )
+            except Exception as exc:
+                logger.warning(
+                    "M-Pesa status query failed for %s: %s", checkout_request_id, exc
+                )
+                return None
+
+    results = await asyncio.gather(*map(query, checkout_request_ids))
+    return [result for result in results if result is not None]
+
+
+def reconcile(min_age=60, max_age=24 * 3600, limit=200, concurrency=5):
+    """Query stale pending payments; returns ``(checked, settled)``."""
+    checkout_request_ids = stale_payments(min_age, max_age, limit)
+    if not checkout_request_ids:
+        return 0, 0
+    results = async_to_sync(query_results)(checkout_request_ids, concurrency)
+    return len(checkout_request_ids), len(payment_views.apply_stk_results(results))
+
+
+def _interval():
+    return getattr(settings, "MPESA_RECONCILE_INTERVAL", 300)
+
+
+def schedule():
+    """Queue one delayed sweep for pushes made in the next interval."""
+    interval = _interval()
+    if cache.add(SCHEDULED_KEY, 1, interval):
+        jobs.enqueue("mpesa.reconcile", delay=interval)
+
+
+@jobs.handler("mpesa.reconcile")
+def sweep():
+    """Reconcile stale payments, then sweep again while any are still pending."""
+    cache.delete(SCHEDULED_KEY)
+    reconcile()
+    if stale_payments(min_age=0, limit=1):
+        schedule()
@@ -0,0 +1,91 @@
+"""Product reviews and the rating aggregates denormalized onto Product."""
+
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Count, F
+
+from .cache_utils import invalidate_tags
+from .models import Product, Review
+
+STARS = range(1, 6)
+
+
+def _histogram_field(rating):
+    return f"rating_{rating}_count"
+
+
+def _apply_rating_delta(product_id, added=None, removed=None):
+    """Atomically move one rating into and/or out of a product's aggregates."""
+    count_delta = int(added is not None) - int(removed is not None)
+    updates = {
+        "rating_sum": F("rating_sum") + (added or 0) - (removed or 0),
+        "rating_count": F("rating_count") + count_delta,
+    }
+    if added is not None:
+        updates[_histogram_field(added)] = F(_histogram_field(added)) + 1
+    if removed is not None:
+        updates[_histogram_field(removed)] = F(_histogram_field(removed)) - 1
+    Product.objects.filter(pk=product_id).update(**updates)
+
+
+def save_review(product, user, rating, comment):
+    """Create or update ``user``'s review of ``product``.
+
+    Returns ``(review, created)``. The product's aggregates are updated in
+    the same transaction as the review row.
+    """
+    with transaction.atomic():
+        transaction.on_commit(
+            partial(invalidate_tags, "catalog", f"product:{product.pk}")
+        )
+        # get_or_create re-fetches (and locks) the row when a concurrent first
+        # submission wins the insert race on (product, user).
+        review, created = Review.objects.select_for_update().get_or_create(
+            product=product,
+            user=user,
+            defaults={"rating": rating, "comment": comment},
+        )
+        if created:
+            _apply_rating_delta(product.pk, added=rating)
+            return review, True
+
+        previous = review.rating
+        review.rating = rating
+        review.comment = comment
+        review.save(update_fields=["rating", "comment"])
+        if previous != rating:
+            _apply_rating_delta(product.pk, added=rating, removed=previous)
+        return review, False
+
+
+def remove_review_from_aggregates(review):
+    """Take a deleted review back out of its product's aggregates."""
+    _apply_rating_delta(review.product_id, removed=review.rating)
+
+
+def rebuild_rating_aggregates(product_ids=None):
+    """Recompute aggregates from the review table; returns products updated."""
+    products = Product.objects.all()
+    reviews = Review.objects.all()
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+        reviews = reviews.filter(product_id__in=product_ids)
+
+    counts = {}
+    for row in reviews.values("product_id", "rating").annotate(n=Count("id")):
+        counts.setdefault(row["product_id"], {})[row["rating"]] = row["n"]
+
+    fields = ["rating_sum", "rating_count"] + [_histogram_field(s) for s in STARS]
+    to_update = []
+    for product in products.only("pk", *fields).iterator():
+        histogram = counts.get(product.pk, {})
+        for star in STARS:
+            setattr(product, _histogram_field(star), histogram.get(star, 0))
+        product.rating_count = sum(histogram.values())
+        product.rating_sum = sum(star * n for star, n in histogram.items())
+        to_update.append(product)
+
+    Product.objects.bulk_update(to_update, fields, batch_size=500)
+    invalidate_tags("catalog", *(f"product:{p.pk}" for p in to_update))
+    return len(to_update)
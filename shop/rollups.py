@@ -0,0 +1,244 @@
+"""Daily analytics rollups behind the admin dashboards.
+
+Every committed order and order item adds its totals to the day's rows, and
+every login bumps the day's login counters, so dashboards aggregate a few
+hundred precomputed rows instead of scanning ``Order`` and ``OrderItem``.
+Deleting orders or items rebuilds the affected day from the source tables.
+``manage.py refresh_rollups`` rebuilds any range; run it periodically to
+pick up edits the signals do not track (changed quantities or totals). The
+migration that adds the tables fills them for existing orders.
+"""
+
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import TruncDate, TruncHour, TruncMonth
+from django.utils import timezone
+
+from .models import (
+    DailyCategorySales,
+    DailyLogins,
+    DailyProductSales,
+    DailySales,
+    Order,
+    OrderItem,
+    UserLoginDay,
+)
+
+LINE_TOTAL = ExpressionWrapper(
+    F("price") * F("quantity"),
+    output_field=DecimalField(max_digits=14, decimal_places=2),
+)
+
+
+def day_of(moment):
+    return timezone.localdate(moment)
+
+
+def _bump(model, lookup, **deltas):
+    """Add ``deltas`` to the row matching ``lookup``, creating it if needed."""
+    model.objects.get_or_create(**lookup)
+    model.objects.filter(**lookup).update(
+        **{name: F(name) + value for name, value in deltas.items()}
+    )
+
+
+def record_order(order):
+    _bump(
+        DailySales,
+        {"date": day_of(order.created_at)},
+        orders=1,
+        revenue=Decimal(str(order.total_amount)),
+    )
+
+
+def record_order_item(item):
+    record_order_items([item])
+
+
+def record_order_items(items):
+    """Add order lines to their day's rows with one update per row touched."""
+    sales, products, categories = {}, {}, {}
+    for item in items:
+        day = day_of(item.order.created_at)
+        revenue = Decimal(str(item.price)) * item.quantity
+        sales[day] = sales.get(day, 0) + item.quantity
+        if item.product is None:
+            continue
+        for totals, key in (
+            (products, (day, item.product_id)),
+            (categories, (day, item.product.category_id)),
+        ):
+            line = totals.setdefault(
+                key, {"order_items": 0, "units": 0, "revenue": Decimal(0)}
+            )
+            line["order_items"] += 1
+            line["units"] += item.quantity
+            line["revenue"] += revenue
+
+    for day, units in sales.items():
+        _bump(DailySales, {"date": day}, units=units)
+    for (day, product_id), line in products.items():
+        _bump(DailyProductSales, {"date": day, "product_id": product_id}, **line)
+    for (day, category_id), line in categories.items():
+        _bump(DailyCategorySales, {"date": day, "category_id": category_id}, **line)
+
+
+def record_login(user, moment=None):
+    day = day_of(moment or timezone.now())
+    _, first_today = UserLoginDay.objects.get_or_create(user=user, date=day)
+    _bump(DailyLogins, {"date": day}, logins=1, unique_users=int(first_today))
+
+
+def rebuild(start, end):
+    """Recompute the sales rollups for ``start``..``end`` from the orders.
+
+    Login rollups are left alone: individual logins are not stored anywhere
+    else to rebuild them from.
+    """
+    days = (start, end)
+    orders = (
+        Order.objects.filter(created_at__date__range=days)
+        .annotate(day=TruncDate("created_at"))
+        .values("day")
+        .order_by()
+    )
+    items = (
+        OrderItem.objects.filter(order__created_at__date__range=days)
+        .annotate(day=TruncDate("order__created_at"))
+        .order_by()
+    )
+    line_totals = {
+        "order_items": Count("id"),
+        "units": Sum("quantity"),
+        "revenue": Sum(LINE_TOTAL),
+    }
+
+    sales = {
+        row["day"]: DailySales(
+            date=row["day"], orders=row["orders"], revenue=row["revenue"] or 0
+        )
+        for row in orders.annotate(orders=Count("id"), revenue=Sum("total_amount"))
+    }
+    for row in items.values("day").annotate(units=Sum("quantity")):
+        sales.setdefault(row["day"], DailySales(date=row["day"])).units = row["units"]
+
+    sold = items.filter(product__isnull=False)
+    products = [
+        DailyProductSales(date=row.pop("day"), **row)
+        for row in sold.values("day", "product_id").annotate(**line_totals)
+    ]
+    categories = [
+        DailyCategorySales(
+            date=row["day"],
+            category_id=row["product__category_id"],
+            order_items=row["order_items"],
+            units=row["units"],
+            revenue=row["revenue"],
+        )
+        for row in sold.values("day", "product__category_id").annotate(**line_totals)
+    ]
+
+    with transaction.atomic():
+        for model in (DailySales, DailyProductSales, DailyCategorySales):
+            model.objects.filter(date__range=days).delete()
+        DailySales.objects.bulk_create(sales.values())
+        DailyProductSales.objects.bulk_create(products)
+        DailyCategorySales.objects.bulk_create(categories)
+    return len(sales)
+
+
+def rebuild_day(day):
+    rebuild(day, day)
+
+
+def totals():
+    """All-time order count and revenue."""
+    result = DailySales.objects.aggregate(orders=Sum("orders"), revenue=Sum("revenue"))
+    return {"orders": result["orders"] or 0, "revenue": result["revenue"] or 0}
+
+
+def hourly_sales(hours=24):
+    """Orders and revenue per hour for the last ``hours``, newest first.
+
+    Read from the orders themselves (by the ``created_at`` index): the daily
+    rows cannot be split into hours.
+    """
+    last = timezone.localtime().replace(minute=0, second=0, microsecond=0)
+    buckets = [last - timedelta(hours=offset) for offset in range(hours)]
+    rows = (
+        Order.objects.filter(created_at__gte=buckets[-1])
+        .annotate(hour=TruncHour("created_at"))
+        .values("hour")
+        .annotate(orders=Count("id"), revenue=Sum("total_amount"))
+        .order_by()
+    )
+    stored = {row["hour"]: row for row in rows}
+    return [
+        {
+            "bucket": bucket,
+            "orders": stored[bucket]["orders"] if bucket in stored else 0,
+            "revenue": stored[bucket]["revenue"] if bucket in stored else 0,
+        }
+        for bucket in buckets
+    ]
+
+
+def sales_by_month(days=180):
+    """Revenue and orders per month for the last ``days``, oldest first."""
+    since = timezone.localdate() - timedelta(days=days)
+    rows = (
+        DailySales.objects.filter(date__gte=since)
+        .annotate(month=TruncMonth("date"))
+        .values("month")
+        .annotate(sales=Sum("revenue"), orders=Sum("orders"))
+        .order_by("month")
+    )
+    return [
+        {
+            "month": row["month"].strftime("%b"),
+            "sales": float(row["sales"] or 0),
+            "orders": row["orders"],
+        }
+        for row in rows
+    ]
+
+
+def order_items_by_category():
+    """``{category_id: order item count}`` over all time."""
+    return {
+        row["category_id"]: row["order_items"]
+        for row in DailyCategorySales.objects.values("category_id")
+        .annotate(order_items=Sum("order_items"))
+        .order_by()
+    }
+
+
+def top_products(limit=5):
+    """The most ordered products as ``{"name", "order_count"}``."""
+    rows = (
+        DailyProductSales.objects.values("product_id", "product__name")
+        .annotate(order_count=Sum("order_items"))
+        .order_by("-order_count", "product__name")[:limit]
+    )
+    return [
+        {"name": row["product__name"], "order_count": row["order_count"]}
+        for row in rows
+    ]
+
+
+def login_activity(days=7):
+    """Logins per day for the last ``days``, newest first."""
+    today = timezone.localdate()
+    dates = [today - timedelta(days=offset) for offset in range(days)]
+    stored = {row.date: row for row in DailyLogins.objects.filter(date__in=dates)}
+    return [
+        {
+            "date": date.isoformat(),
+            "logins": stored[date].logins if date in stored else 0,
+            "unique_users": stored[date].unique_users if date in stored else 0,
+        }
+        for date in dates
+    ]
@@ -0,0 +1,257 @@
+"""Ranked product search over names and descriptions.
+
+On PostgreSQL, ``shop_product.search_vector`` is a generated ``tsvector``
+(name weighted above description) with a GIN index, and ``name`` has a
+trigram GIN index: a product matches when the query's words are in its
+document or its name is trigram-similar to the query, so typos still find
+it. Results are ranked by text rank plus name similarity.
+
+Other databases (SQLite in development and tests) use an in-process
+inverted index over the same fields, rebuilt whenever the ``catalog`` cache
+tag moves. Each query word matches the indexed words that are
+trigram-similar to it (itself included), and every query word has to match.
+
+Either way, the catalog filters narrow the matches, and results come back
+ranked and offset-paginated with facet counts for the matched products.
+"""
+
+import math
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from django.db import connection
+from django.db.models import Count, F, Q
+from django.db.models.expressions import RawSQL
+
+from . import catalog
+from .cache_utils import get_tag_versions
+from .models import Product
+
+MAX_QUERY_LENGTH = 200
+SEARCH_CONFIG = "english"
+# Same cut-off pg_trgm uses for its ``%`` operator.
+TRIGRAM_THRESHOLD = 0.3
+NAME_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+@dataclass
+class SearchResults:
+    products: list
+    total: int
+    next_offset: int = None
+    facets: dict = field(default_factory=dict)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def trigrams(term):
+    """pg_trgm-style trigrams: the word padded with two spaces before, one after."""
+    padded = f"  {term} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class InvertedIndex:
+    """Term -> ``{product id: weight}`` postings plus a trigram -> terms map."""
+
+    def __init__(self, documents):
+        self.postings = defaultdict(dict)
+        self.document_count = 0
+        for product_id, name, description in documents:
+            self.document_count += 1
+            for weight, text in (
+                (NAME_WEIGHT, name),
+                (DESCRIPTION_WEIGHT, description),
+            ):
+                for term in tokenize(text or ""):
+                    postings = self.postings[term]
+                    postings[product_id] = postings.get(product_id, 0) + weight
+        self.trigram_terms = defaultdict(set)
+        for term in self.postings:
+            for trigram in trigrams(term):
+                self.trigram_terms[trigram].add(term)
+
+    def _similar_terms(self, word):
+        """``[(term, similarity)]`` for the indexed terms like ``word``.
+
+        Trigram similarity stands in for stemming: "boot" also finds "boots".
+        """
+        wanted = trigrams(word)
+        candidates = set()
+        for trigram in wanted:
+            candidates |= self.trigram_terms.get(trigram, set())
+        similar = []
+        for term in candidates:
+            have = trigrams(term)
+            similarity = len(wanted & have) / len(wanted | have)
+            if similarity >= TRIGRAM_THRESHOLD:
+                similar.append((term, similarity))
+        return similar
+
+    def search(self, text):
+        """``{product id: score}`` for products matching every query word."""
+        scores = None
+        for word in dict.fromkeys(tokenize(text)):
+            word_scores = {}
+            for term, similarity in self._similar_terms(word):
+                postings = self.postings[term]
+                idf = math.log(1 + self.document_count / len(postings))
+                for product_id, weight in postings.items():
+                    score = similarity * weight * idf
+                    if score > word_scores.get(product_id, 0):
+                        word_scores[product_id] = score
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {
+                    product_id: score + word_scores[product_id]
+                    for product_id, score in scores.items()
+                    if product_id in word_scores
+                }
+            if not scores:
+                return {}
+        return scores or {}
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """This process's index of the catalog, rebuilt after catalog changes."""
+    global _index, _index_version
+    version = get_tag_versions(["catalog"])["catalog"]
+    if _index is not None and _index_version == version:
+        return _index
+    with _index_lock:
+        if _index is None or _index_version != version:
+            documents = Product.objects.values_list(
+                "id", "name", "description"
+            ).iterator()
+            _index, _index_version = InvertedIndex(documents), version
+        return _index
+
+
+def clear_index():
+    global _index, _index_version
+    with _index_lock:
+        _index = _index_version = None
+
+
+def facets(queryset):
+    """Category and flag counts for the matched products."""
+    categories = (
+        queryset.values("category__slug", "category__name")
+        .annotate(count=Count("pk"))
+        .order_by("-count", "category__name")
+    )
+    counts = queryset.aggregate(
+        in_stock=Count("pk", filter=Q(in_stock=True)),
+        on_sale=Count("pk", filter=Q(on_sale=True)),
+        is_new=Count("pk", filter=Q(is_new=True)),
+    )
+    return {
+        "categories": [
+            {
+                "slug": row["category__slug"],
+                "name": row["category__name"],
+                "count": row["count"],
+            }
+            for row in categories
+        ],
+        **counts,
+    }
+
+
+def _postgres_search(queryset, text, category, limit, offset):
+    from django.contrib.postgres.lookups import TrigramSimilar
+    from django.contrib.postgres.search import (
+        SearchQuery,
+        SearchRank,
+        SearchVectorField,
+        TrigramSimilarity,
+    )
+
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+    document = RawSQL(
+        f'"{Product._meta.db_table}"."search_vector"',
+        (),
+        output_field=SearchVectorField(),
+    )
+    matches = queryset.alias(document=document).filter(
+        Q(document=query) | Q(TrigramSimilar(F("name"), text))
+    )
+    found = facets(matches)
+    if category:
+        matches = matches.filter(category__slug=category)
+    ranked = matches.annotate(
+        rank=SearchRank(document, query) + TrigramSimilarity("name", text)
+    ).order_by("-rank", "-id")
+    products = list(ranked.select_related("category")[offset : offset + limit])
+    return products, matches.count(), found
+
+
+def _index_search(queryset, text, category, limit, offset):
+    scores = get_index().search(text)
+    matches = queryset.filter(pk__in=list(scores))
+    found = facets(matches)
+    if category:
+        matches = matches.filter(category__slug=category)
+    ids = sorted(
+        matches.values_list("pk", flat=True),
+        key=lambda product_id: (-scores[product_id], -product_id),
+    )
+    page_ids = ids[offset : offset + limit]
+    products = Product.objects.select_related("category").in_bulk(page_ids)
+    return [products[pk] for pk in page_ids if pk in products], len(ids), found
+
+
+def search_products(
+    text,
+    category=None,
+    in_stock=None,
+    on_sale=None,
+    is_new=None,
+    min_price=None,
+    max_price=None,
+    limit=catalog.DEFAULT_PAGE_SIZE,
+    offset=0,
+):
+    """One page of ranked matches for ``text`` with the catalog filters.
+
+    Facet counts cover every match that passes the filters other than
+    ``category``, so a client can show how many results each category has.
+    Raises ``catalog.InvalidFilter`` for an empty or overlong query.
+    """
+    text = (text or "").strip()
+    if not tokenize(text):
+        raise catalog.InvalidFilter("Search query must not be empty")
+    if len(text) > MAX_QUERY_LENGTH:
+        raise catalog.InvalidFilter(
+            f"Search query must be at most {MAX_QUERY_LENGTH} characters"
+        )
+    if offset < 0:
+        raise catalog.InvalidFilter("Offset must not be negative")
+
+    queryset = catalog.filter_products(
+        Product.objects.all(),
+        in_stock=in_stock,
+        on_sale=on_sale,
+        is_new=is_new,
+        min_price=min_price,
+        max_price=max_price,
+    )
+    if connection.vendor == "postgresql":
+        search = _postgres_search
+    else:
+        search = _index_search
+    products, total, found = search(queryset, text, category, limit, offset)
+    next_offset = offset + limit if offset + limit < total else None
+    return SearchResults(products, total, next_offset, found)
@@ -0,0 +1,110 @@
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import counters, geocoding, reconciliation, rollups
+from .cache_utils import invalidate_tags
+from .graphql.auth import forget_user
+from .models import (
+    Category,
+    MpesaPayment,
+    Order,
+    OrderItem,
+    Product,
+    Review,
+    UserProfile,
+)
+from .reviews import remove_review_from_aggregates
+
+
+def invalidate_on_commit(*tags):
+    transaction.on_commit(partial(invalidate_tags, *tags))
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    remove_review_from_aggregates(instance)
+    invalidate_on_commit("catalog", f"product:{instance.product_id}")
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate_on_commit("catalog", f"product:{instance.pk}")
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    invalidate_on_commit("catalog", "categories")
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_saved(sender, instance, **kwargs):
+    # Resolve new locations before the admin dashboard asks for them.
+    if instance.city and instance.country:
+        place = (instance.city, instance.country)
+        transaction.on_commit(partial(geocoding.locate_many, [place]))
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(partial(rollups.record_order, instance))
+
+
+@receiver(post_save, sender=OrderItem)
+def order_item_saved(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(partial(rollups.record_order_item, instance))
+
+
+@receiver(post_delete, sender=Order)
+def order_deleted(sender, instance, **kwargs):
+    day = rollups.day_of(instance.created_at)
+    transaction.on_commit(partial(rollups.rebuild_day, day))
+
+
+@receiver(post_delete, sender=OrderItem)
+def order_item_deleted(sender, instance, origin=None, **kwargs):
+    # Items deleted along with their order (or its user) leave the rebuild
+    # to order_deleted, instead of one lookup and rebuild per item.
+    if not (
+        isinstance(origin, OrderItem) or getattr(origin, "model", None) is OrderItem
+    ):
+        return
+    created_at = (
+        Order.objects.filter(pk=instance.order_id)
+        .values_list("created_at", flat=True)
+        .first()
+    )
+    if created_at is not None:
+        day = rollups.day_of(created_at)
+        transaction.on_commit(partial(rollups.rebuild_day, day))
+
+
+@receiver(post_save, sender=MpesaPayment)
+def mpesa_payment_saved(sender, instance, created, **kwargs):
+    # Settles the push from Daraja if its callback never arrives.
+    if created:
+        transaction.on_commit(reconciliation.schedule)
+
+
+@receiver(user_logged_in)
+def login_recorded(sender, user, **kwargs):
+    transaction.on_commit(partial(rollups.record_login, user))
+    # The rollups count logins per day; only the hourly series lives here.
+    transaction.on_commit(
+        partial(counters.incr, {"logins": 1}, granularities=("hour",))
+    )
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # Drops the JWT user snapshot, so deactivation takes effect immediately.
+    transaction.on_commit(partial(forget_user, instance.pk))
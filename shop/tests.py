@@ -1,10 +1,78 @@
+import asyncio
+import importlib
 import json
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import AsyncMock, MagicMock, patch
 
+from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import QuerySet
 from django.test import TestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from graphql import GraphQLError, parse
+from strawberry.schema import schema as strawberry_schema
 
-from shop.models import Category, Product
+from shop import (
+    carts,
+    catalog,
+    counters,
+    exchange_rates,
+    geocoding,
+    jobs,
+    outbound,
+    pricing,
+    ratelimit,
+    rollups,
+    search,
+)
+from shop.cache_utils import (
+    CacheEntry,
+    LocalCache,
+    _should_refresh,
+    cache_query,
+    invalidate_tags,
+    local_cache,
+)
+from shop.graphql import auth, persisted
+from shop.graphql.auth import create_access_token, forget_user
+from shop.graphql.cost import calculate_cost
+from shop.graphql.schema import schema
+from shop.graphql.security import rate_limit
+from shop.models import (
+    Cart,
+    CartItem,
+    Category,
+    DailyCategorySales,
+    DailyLogins,
+    DailyProductSales,
+    DailySales,
+    EventCounter,
+    GeocodeCache,
+    Order,
+    OrderItem,
+    Product,
+    Review,
+    UserProfile,
+)
+from shop.reviews import save_review
+
+LOCMEM_CACHE = {
+    "CACHES": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "arnova-tests",
+        }
+    }
+}
 
 
 @override_settings(
@@ -19,6 +87,8 @@ class SmokeTests(TestCase):
     def setUp(self):
         super().setUp()
         cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
 
     def test_health_endpoint(self):
         response = self.client.get("/health/")
@@ -82,3 +152,1457 @@ class SmokeTests(TestCase):
             first_response.json()["data"]["products"][0]["name"],
             "Cache Test Runner",
         )
+
+
+@override_settings(**LOCMEM_CACHE)
+class ExchangeRateSnapshotTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        exchange_rates.clear_snapshots()
+        self.category = Category.objects.create(name="Bags", slug="bags")
+        for name in ("Tote", "Wallet", "Belt"):
+            Product.objects.create(
+                name=name,
+                description=name,
+                price="1500.00",
+                currency="KES",
+                category=self.category,
+            )
+
+    @patch("shop.exchange_rates.outbound.get")
+    def test_products_convert_from_snapshot_without_outbound_calls(self, mock_get):
+        mock_get.return_value = MagicMock(
+            json=lambda: {"base": "KES", "rates": {"USD": 0.008, "EUR": 0.007}}
+        )
+        exchange_rates.refresh_rate_table("KES")
+        mock_get.reset_mock()
+        mock_get.side_effect = AssertionError("no I/O on the request path")
+
+        response = self.client.get("/api/products/?currency=USD")
+
+        self.assertEqual(response.status_code, 200)
+        prices = {p["price"] for p in response.json()["products"]}
+        self.assertEqual(prices, {12.0})
+        mock_get.assert_not_called()
+
+    @patch("shop.exchange_rates._refresh_in_background")
+    def test_cold_snapshot_serves_fallback_and_schedules_refresh(self, mock_refresh):
+        rates = exchange_rates.get_rate_table("USD")
+
+        self.assertEqual(rates["KES"], exchange_rates.FALLBACK_RATES["USD"]["KES"])
+        mock_refresh.assert_called_once_with("USD")
+
+    @patch("shop.exchange_rates._refresh_in_background")
+    def test_ageing_snapshot_is_refreshed_in_background(self, mock_refresh):
+        exchange_rates.store_rate_table("USD", {"USD": 1.0, "KES": 129.0}, 0)
+
+        self.assertEqual(exchange_rates.get_rate("USD", "KES"), 129.0)
+        mock_refresh.assert_called_once_with("USD")
+
+    @patch("shop.exchange_rates._refresh_in_background")
+    def test_ageing_snapshot_adopts_newer_shared_table(self, mock_refresh):
+        exchange_rates.store_rate_table("USD", {"USD": 1.0, "KES": 129.0}, 0)
+        # Another process refreshed the shared entry since.
+        cache.set(
+            exchange_rates.CACHE_KEY.format(base="USD"),
+            {"rates": {"USD": 1.0, "KES": 130.0}, "fetched_at": time.time()},
+        )
+
+        self.assertEqual(exchange_rates.get_rate("USD", "KES"), 130.0)
+        self.assertEqual(exchange_rates.get_rate("USD", "KES"), 130.0)
+        mock_refresh.assert_not_called()
+
+    @patch("shop.exchange_rates.threading.Thread")
+    def test_offline_mode_never_refreshes(self, mock_thread):
+        self.assertEqual(
+            exchange_rates.get_rate("USD", "KES"),
+            exchange_rates.FALLBACK_RATES["USD"]["KES"],
+        )
+        mock_thread.assert_not_called()
+
+    @override_settings(EXCHANGE_RATE_ONLINE=True)
+    @patch("shop.exchange_rates.threading.Thread")
+    def test_unsupported_base_is_rejected_without_refresh(self, mock_thread):
+        response = self.client.get("/api/exchange-rates/", {"base": "XYZ"})
+
+        self.assertEqual(response.status_code, 400)
+        for path in ("/api/products/", "/api/products/search/"):
+            response = self.client.get(path, {"q": "tote", "currency": "XYZ"})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(exchange_rates.get_rate_table("XYZ"), {"XYZ": 1.0})
+        mock_thread.assert_not_called()
+
+    @override_settings(EXCHANGE_RATE_ONLINE=True)
+    @patch("shop.exchange_rates.threading.Thread")
+    @patch("shop.exchange_rates.outbound.get", side_effect=RuntimeError("down"))
+    def test_failed_refresh_backs_off(self, _get, mock_thread):
+        with self.assertLogs("shop", level="WARNING"):
+            exchange_rates.refresh_rate_table("USD")
+
+        exchange_rates.get_rate_table("USD")
+        mock_thread.assert_not_called()
+
+        failure_key = exchange_rates.FAILURE_KEY.format(base="USD")
+        self.assertEqual(cache.get(failure_key)["failures"], 1)
+        cache.set(failure_key, {"failures": 1, "retry_at": 0})
+        exchange_rates.get_rate_table("USD")
+        mock_thread.assert_called_once()
+
+
+@override_settings(**LOCMEM_CACHE)
+class ProductListingPaginationTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        shoes = Category.objects.create(name="Shoes", slug="shoes")
+        bags = Category.objects.create(name="Bags", slug="bags")
+        for i in range(5):
+            Product.objects.create(
+                name=f"Shoe {i}",
+                description="Shoe",
+                price=f"{100 + i * 10}.00",
+                currency="USD",
+                category=shoes,
+                on_sale=i % 2 == 0,
+            )
+        Product.objects.create(
+            name="Bag", description="Bag", price="80.00", currency="USD", category=bags
+        )
+        # Identical timestamps force the id tie-breaker to do the work.
+        Product.objects.update(created_at="2026-01-01T00:00:00Z")
+
+    def _walk(self, params):
+        names, cursor = [], None
+        while True:
+            query = dict(params, limit=2, currency="USD")
+            if cursor:
+                query["cursor"] = cursor
+            body = self.client.get("/api/products/", query).json()
+            names.extend(p["name"] for p in body["products"])
+            cursor = body["next_cursor"]
+            self.assertEqual(body["has_more"], cursor is not None)
+            if not cursor:
+                return names
+
+    def test_pages_cover_catalog_once_in_order(self):
+        names = self._walk({})
+        expected = list(
+            Product.objects.order_by("-created_at", "-id").values_list(
+                "name", flat=True
+            )
+        )
+        self.assertEqual(names, expected)
+
+    def test_filters_are_applied(self):
+        names = self._walk({"category": "shoes", "on_sale": "true", "max_price": 130})
+        self.assertEqual(names, ["Shoe 2", "Shoe 0"])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get("/api/products/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_graphql_product_page(self):
+        query = """
+            query Page($after: String) {
+              productPage(first: 4, after: $after, filter: {category: "shoes"}) {
+                items { name }
+                nextCursor
+                hasMore
+              }
+            }
+        """
+        first = self.client.post(
+            "/graphql/",
+            data=json.dumps({"query": query}),
+            content_type="application/json",
+        ).json()["data"]["productPage"]
+        second = self.client.post(
+            "/graphql/",
+            data=json.dumps(
+                {"query": query, "variables": {"after": first["nextCursor"]}}
+            ),
+            content_type="application/json",
+        ).json()["data"]["productPage"]
+
+        self.assertEqual(len(first["items"]), 4)
+        self.assertTrue(first["hasMore"])
+        self.assertEqual([p["name"] for p in second["items"]], ["Shoe 0"])
+        self.assertFalse(second["hasMore"])
+
+
+@override_settings(**LOCMEM_CACHE)
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        search.clear_index()
+        shoes = Category.objects.create(name="Shoes", slug="shoes")
+        bags = Category.objects.create(name="Bags", slug="bags")
+        self.boot = Product.objects.create(
+            name="Leather Boot",
+            description="Waterproof hiking boot",
+            price="120.00",
+            category=shoes,
+            on_sale=True,
+        )
+        self.runner = Product.objects.create(
+            name="Running Shoe",
+            description="Light shoe for running",
+            price="90.00",
+            category=shoes,
+        )
+        self.bag = Product.objects.create(
+            name="Canvas Bag",
+            description="Room for your boots",
+            price="40.00",
+            category=bags,
+        )
+
+    def _names(self, query, **filters):
+        results = search.search_products(query, **filters)
+        return [product.name for product in results.products]
+
+    def test_matches_are_ranked_and_tolerate_typos(self):
+        self.assertEqual(self._names("boot"), ["Leather Boot", "Canvas Bag"])
+        self.assertEqual(self._names("runing shoo"), ["Running Shoe"])
+        # Every word has to match.
+        self.assertEqual(self._names("leather running"), [])
+        with self.assertRaises(catalog.InvalidFilter):
+            search.search_products("  ?! ")
+
+    def test_index_follows_catalog_changes(self):
+        self.assertEqual(self._names("sandal"), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                name="Beach Sandal",
+                description="Sandal",
+                price="30.00",
+                category=self.bag.category,
+            )
+        self.assertEqual(self._names("sandal"), ["Beach Sandal"])
+
+    def test_rest_search_filters_pages_and_facets(self):
+        response = self.client.get(
+            "/api/products/search/", {"q": "boots", "limit": 1, "currency": "KES"}
+        )
+        body = response.json()
+        self.assertEqual([p["name"] for p in body["products"]], ["Leather Boot"])
+        self.assertEqual((body["total"], body["next_offset"]), (2, 1))
+        self.assertEqual(
+            body["facets"],
+            {
+                "categories": [
+                    {"slug": "bags", "name": "Bags", "count": 1},
+                    {"slug": "shoes", "name": "Shoes", "count": 1},
+                ],
+                "in_stock": 2,
+                "on_sale": 1,
+                "is_new": 0,
+            },
+        )
+        body = self.client.get(
+            "/api/products/search/", {"q": "boots", "limit": 1, "offset": 1}
+        ).json()
+        self.assertEqual([p["name"] for p in body["products"]], ["Canvas Bag"])
+        self.assertFalse(body["has_more"])
+
+        body = self.client.get(
+            "/api/products/search/", {"q": "boots", "category": "bags"}
+        ).json()
+        self.assertEqual(body["total"], 1)
+        self.assertEqual(len(body["facets"]["categories"]), 2)
+        body = self.client.get(
+            "/api/products/search/", {"q": "boot", "on_sale": "false"}
+        ).json()
+        self.assertEqual([p["name"] for p in body["products"]], ["Canvas Bag"])
+
+        self.assertEqual(self.client.get("/api/products/search/").status_code, 400)
+        response = self.client.get("/api/products/search/", {"q": "x", "offset": "-1"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_graphql_search(self):
+        response = self.client.post(
+            "/graphql/",
+            data=json.dumps(
+                {
+                    "query": '{ searchProducts(query: "shoe", '
+                    'filter: {category: "shoes"}) { items { name } total hasMore '
+                    "facets { categories { slug count } onSale } } }"
+                }
+            ),
+            content_type="application/json",
+        )
+        self.assertEqual(
+            response.json()["data"]["searchProducts"],
+            {
+                "items": [{"name": "Running Shoe"}],
+                "total": 1,
+                "hasMore": False,
+                "facets": {"categories": [{"slug": "shoes", "count": 1}], "onSale": 0},
+            },
+        )
+
+
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        category = Category.objects.create(name="Shoes", slug="shoes")
+        self.product = Product.objects.create(
+            name="Runner",
+            description="Runner",
+            price="100.00",
+            category=category,
+        )
+        self.alice = User.objects.create_user("alice", "a@test.com", "pass1234")
+        self.bob = User.objects.create_user("bob", "b@test.com", "pass1234")
+
+    def _refresh(self):
+        self.product.refresh_from_db()
+        return self.product
+
+    def test_create_update_and_delete_keep_aggregates_current(self):
+        save_review(self.product, self.alice, 5, "Great")
+        save_review(self.product, self.bob, 2, "Meh")
+        save_review(self.product, self.bob, 4, "Grew on me")
+
+        product = self._refresh()
+        self.assertEqual(product.review_count, 2)
+        self.assertEqual(product.average_rating, 4.5)
+        self.assertEqual(
+            product.rating_histogram, {"1": 0, "2": 0, "3": 0, "4": 1, "5": 1}
+        )
+
+        Review.objects.get(user=self.alice).delete()
+        product = self._refresh()
+        self.assertEqual((product.rating_count, product.rating_sum), (1, 4))
+
+    def test_concurrent_first_reviews_do_not_conflict(self):
+        real_get = QuerySet.get
+        calls = []
+
+        def get(queryset, *args, **kwargs):
+            if queryset.model is Review and not calls:
+                calls.append(1)
+                # Another request inserts the same user's review first.
+                save_review(self.product, self.alice, 2, "First")
+                raise Review.DoesNotExist
+            return real_get(queryset, *args, **kwargs)
+
+        with patch.object(QuerySet, "get", get):
+            review, created = save_review(self.product, self.alice, 5, "Second")
+
+        self.assertFalse(created)
+        self.assertEqual(review.rating, 5)
+        product = self._refresh()
+        self.assertEqual((product.rating_count, product.rating_sum), (1, 5))
+
+    def test_rest_review_endpoint_updates_aggregates(self):
+        self.client.force_login(self.alice)
+        response = self.client.post(
+            f"/api/products/{self.product.id}/review/",
+            data=json.dumps({"rating": 3, "comment": "Fine"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._refresh().rating_3_count, 1)
+
+    def test_listing_does_not_query_reviews(self):
+        save_review(self.product, self.alice, 4, "Good")
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/products/", {"currency": "USD"})
+        self.assertEqual(response.json()["products"][0]["rating"], 4.0)
+
+    def test_rebuild_command_recomputes_from_reviews(self):
+        Review.objects.create(product=self.product, user=self.alice, rating=1)
+        call_command("rebuild_rating_aggregates", stdout=StringIO())
+        product = self._refresh()
+        self.assertEqual((product.rating_count, product.rating_1_count), (1, 1))
+
+
+@override_settings(**LOCMEM_CACHE)
+class CacheTagInvalidationTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        self.category = Category.objects.create(name="Hats", slug="hats")
+        self.product = Product.objects.create(
+            name="Bucket Hat",
+            description="Hat",
+            price="20.00",
+            category=self.category,
+        )
+
+    def _product_name(self):
+        query = "query($id: Int!) { product(id: $id) { name } }"
+        response = self.client.post(
+            "/graphql/",
+            data=json.dumps({"query": query, "variables": {"id": self.product.id}}),
+            content_type="application/json",
+        )
+        return response.json()["data"]["product"]["name"]
+
+    def test_tagged_entries_survive_until_their_tag_is_invalidated(self):
+        calls = []
+
+        @cache_query(timeout=60, tags=["product:{product_id}"])
+        def load(product_id):
+            calls.append(product_id)
+            return f"product-{product_id}"
+
+        load(1)
+        load(1)
+        load(2)
+        invalidate_tags("product:2")
+        load(1)
+        load(2)
+
+        self.assertEqual(calls, [1, 2, 2])
+
+    def test_product_save_invalidates_cached_graphql_product(self):
+        self.assertEqual(self._product_name(), "Bucket Hat")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Sun Hat"
+            self.product.save()
+
+        self.assertEqual(self._product_name(), "Sun Hat")
+
+    def test_new_review_invalidates_catalog_listing(self):
+        query = {"query": "query { products { name rating } }"}
+        before = self.client.post(
+            "/graphql/", data=json.dumps(query), content_type="application/json"
+        ).json()["data"]["products"][0]["rating"]
+
+        user = User.objects.create_user("carol", "c@test.com", "pass1234")
+        with self.captureOnCommitCallbacks(execute=True):
+            save_review(self.product, user, 5, "Love it")
+
+        after = self.client.post(
+            "/graphql/", data=json.dumps(query), content_type="application/json"
+        ).json()["data"]["products"][0]["rating"]
+        self.assertEqual((before, after), (0.0, 5.0))
+
+
+class LocalCacheTests(TestCase):
+    def test_lru_eviction_respects_memory_budget(self):
+        l1 = LocalCache(max_bytes=600, ttl=60)
+        for i in range(10):
+            l1.set(f"k{i}", "x" * 100)
+        self.assertIsNone(l1.get("k0"))
+        self.assertEqual(l1.get("k9"), "x" * 100)
+        self.assertLessEqual(l1._bytes, 600)
+
+    def test_tag_invalidation_and_racing_writes(self):
+        l1 = LocalCache(max_bytes=10_000, ttl=60)
+        l1.set("a", 1, tags=["catalog"])
+        l1.set("b", 2, tags=["categories"])
+        generation = l1.generation
+        l1.invalidate_tags(["catalog"])
+        l1.set("c", 3, tags=["catalog"], generation=generation)
+
+        self.assertIsNone(l1.get("a"))
+        self.assertEqual(l1.get("b"), 2)
+        self.assertIsNone(l1.get("c"))
+
+    @override_settings(QUERY_CACHE_LOCAL=True, **LOCMEM_CACHE)
+    def test_local_hits_skip_shared_cache(self):
+        @cache_query(timeout=60, tags=["categories"], local=True)
+        def load():
+            return ["shoes"]
+
+        local_cache.clear()
+        load()
+        with patch("shop.cache_utils.cache") as shared:
+            self.assertEqual(load(), ["shoes"])
+        shared.get.assert_not_called()
+
+
+@override_settings(**LOCMEM_CACHE)
+class CacheStampedeTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+
+    def test_concurrent_misses_recompute_once(self):
+        calls = []
+
+        @cache_query(timeout=60)
+        def slow_catalog():
+            calls.append(1)
+            time.sleep(0.2)
+            return ["catalog"]
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(slow_catalog()))
+            for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["catalog"]] * 6)
+
+    def test_lock_loser_serves_stale_value(self):
+        calls = []
+
+        @cache_query(timeout=60)
+        def load():
+            calls.append(1)
+            return "fresh"
+
+        load()
+        # Treat the entry as due for refresh while another worker holds the lease.
+        with (
+            patch("shop.cache_utils._should_refresh", return_value=True),
+            patch("shop.cache_utils.cache.add", return_value=False),
+        ):
+            self.assertEqual(load(), "fresh")
+        self.assertEqual(len(calls), 1)
+
+    def test_xfetch_refreshes_only_near_expiry(self):
+        now = time.time()
+        with patch("shop.cache_utils.random.random", return_value=0.5):
+            self.assertFalse(_should_refresh(CacheEntry("v", now + 300, 0.1)))
+            self.assertTrue(_should_refresh(CacheEntry("v", now + 0.5, 2.0)))
+            self.assertTrue(_should_refresh(CacheEntry("v", now - 1, 0.0)))
+
+
+class GraphQLBatchLoadingTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        self.user = User.objects.create_user(
+            "admin", "admin@test.com", "pass1234", is_staff=True
+        )
+        category = Category.objects.create(name="Shoes", slug="shoes")
+        self.product = Product.objects.create(
+            name="Runner", description="Shoe", price="50.00", category=category
+        )
+
+    def _count_queries(self, query):
+        # Measure every run with a cold user snapshot.
+        forget_user(self.user.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                "/graphql/",
+                data=json.dumps({"query": query}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {create_access_token(self.user)}",
+            )
+        self.assertNotIn("errors", response.json())
+        return len(ctx.captured_queries)
+
+    def _add_order(self, n):
+        order = Order.objects.create(
+            user=self.user,
+            order_id=f"ORD{n}",
+            total_amount="100.00",
+            shipping_address="Nairobi",
+        )
+        for _ in range(2):
+            OrderItem.objects.create(
+                order=order,
+                product=self.product,
+                quantity=1,
+                price="50.00",
+                selected_size="M",
+                selected_color="Red",
+            )
+
+    def test_orders_query_count_is_constant(self):
+        query = "{ orders { orderId items { productName quantity } } }"
+        self._add_order(1)
+        few = self._count_queries(query)
+        for n in range(2, 7):
+            self._add_order(n)
+        self.assertEqual(self._count_queries(query), few)
+
+    def test_admin_users_query_count_is_constant(self):
+        query = "{ adminUsers { username profile { phone country } } }"
+        User.objects.create_user("u1", "u1@test.com", "pass1234")
+        few = self._count_queries(query)
+        for n in range(2, 7):
+            User.objects.create_user(f"u{n}", f"u{n}@test.com", "pass1234")
+        self.assertEqual(self._count_queries(query), few)
+        self.assertEqual(UserProfile.objects.count(), User.objects.count())
+
+    def test_admin_lists_are_paged(self):
+        for n in range(1, 6):
+            self._add_order(n)
+        response = self.client.post(
+            "/graphql/",
+            data=json.dumps(
+                {"query": "{ adminOrders(limit: 2, offset: 1) { orderId } }"}
+            ),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {create_access_token(self.user)}",
+        )
+        orders = response.json()["data"]["adminOrders"]
+        self.assertEqual([o["orderId"] for o in orders], ["ORD4", "ORD3"])
+
+
+@override_settings(**LOCMEM_CACHE)
+class QueryCostTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+
+    def _cost(self, query, variables=None):
+        return calculate_cost(schema._schema, parse(query), variables=variables)
+
+    def _post(self, query, variables=None):
+        return self.client.post(
+            "/graphql/",
+            data=json.dumps({"query": query, "variables": variables or {}}),
+            content_type="application/json",
+        ).json()
+
+    def test_list_cost_scales_with_page_size(self):
+        query = "query($n: Int!) { productPage(first: $n) { items { id } } }"
+        small = self._cost(query, {"n": 10})
+        large = self._cost(query, {"n": 50})
+        self.assertEqual(small, 1 + 10)
+        self.assertEqual(large, 1 + 50)
+
+    def test_nested_lists_multiply(self):
+        flat = self._cost("{ adminOrders(limit: 10) { id } }")
+        nested = self._cost(
+            "{ adminAnalytics { categoryStats } adminUsers(limit: 10) "
+            "{ profile { city } } }"
+        )
+        self.assertEqual(flat, 10)
+        self.assertEqual(nested, 200 + 10 * (1 + 1))
+
+    def test_fragments_are_counted(self):
+        inline = self._cost("{ adminOrders(limit: 5) { id } }")
+        with_fragment = self._cost(
+            "{ adminOrders(limit: 5) { ...F } } fragment F on AdminOrderType { id }"
+        )
+        self.assertEqual(inline, with_fragment)
+
+    def test_cost_reported_in_extensions(self):
+        body = self._post("{ health }")
+        self.assertEqual(body["data"], {"health": "healthy"})
+        self.assertEqual(body["extensions"]["cost"]["requested"], 0)
+
+    @override_settings(GRAPHQL_MAX_QUERY_COST=50)
+    def test_rejects_operation_over_maximum(self):
+        body = self._post("{ products { id name } }")
+        self.assertIsNone(body["data"])
+        self.assertIn("exceeds the maximum", body["errors"][0]["message"])
+        self.assertEqual(body["extensions"]["cost"]["requested"], 100)
+
+    @override_settings(GRAPHQL_COST_BUDGET=150)
+    def test_throttles_client_over_budget(self):
+        query = "{ productPage(first: 50) { items { id } } }"
+        self.assertNotIn("errors", self._post(query))
+        self.assertNotIn("errors", self._post(query))
+        body = self._post(query)
+        self.assertIn("budget exceeded", body["errors"][0]["message"])
+
+
+@override_settings(**LOCMEM_CACHE)
+class PersistedQueryTests(TestCase):
+    QUERY = "{ categories { id name } }"
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        local_cache.clear()
+        persisted.reset()
+        self.addCleanup(persisted.reset)
+        self.hash = persisted.query_hash(self.QUERY)
+
+    def _post(self, query=None, sha=None):
+        payload = {}
+        if query:
+            payload["query"] = query
+        if sha:
+            payload["extensions"] = {
+                "persistedQuery": {"version": 1, "sha256Hash": sha}
+            }
+        return self.client.post(
+            "/graphql/", data=json.dumps(payload), content_type="application/json"
+        ).json()
+
+    def _code(self, body):
+        return body["errors"][0]["extensions"]["code"]
+
+    def test_unknown_hash_then_register_then_hash_only(self):
+        body = self._post(sha=self.hash)
+        self.assertEqual(self._code(body), "PERSISTED_QUERY_NOT_FOUND")
+
+        self.assertIn("categories", self._post(self.QUERY, self.hash)["data"])
+        self.assertIn("categories", self._post(sha=self.hash)["data"])
+
+    def test_hash_must_match_query(self):
+        body = self._post(self.QUERY, "0" * 64)
+        self.assertEqual(self._code(body), "PERSISTED_QUERY_HASH_MISMATCH")
+
+    def test_known_documents_skip_validation(self):
+        with patch.object(
+            strawberry_schema,
+            "validate_document",
+            wraps=strawberry_schema.validate_document,
+        ) as validate:
+            self._post(self.QUERY, self.hash)
+            self._post(sha=self.hash)
+            # A worker with a cold in-process cache trusts the shared entry.
+            persisted.documents.clear()
+            self._post(sha=self.hash)
+            self._post(self.QUERY)
+        self.assertEqual(validate.call_count, 1)
+
+    def test_allowlist_only_runs_manifest_queries(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as fh:
+            json.dump({self.hash: self.QUERY}, fh)
+        self.addCleanup(os.remove, fh.name)
+        with override_settings(
+            GRAPHQL_PERSISTED_QUERIES_ONLY=True,
+            GRAPHQL_PERSISTED_QUERIES_MANIFEST=fh.name,
+        ):
+            self.assertEqual(
+                self._code(self._post(self.QUERY)), "PERSISTED_QUERY_REQUIRED"
+            )
+            other = "{ health }"
+            body = self._post(other, persisted.query_hash(other))
+            self.assertEqual(self._code(body), "PERSISTED_QUERY_NOT_FOUND")
+            self.assertIn("categories", self._post(sha=self.hash)["data"])
+
+
+class GeocodingTests(TestCase):
+    def test_gazetteer_matches_normalized_places(self):
+        located = geocoding.locate_many([("nairobi ", "KE"), ("New York", "USA")])
+        self.assertAlmostEqual(located[("nairobi ", "KE")][0], -1.29, places=1)
+        self.assertIsNotNone(located[("New York", "USA")])
+
+    @patch("shop.geocoding.schedule")
+    def test_cached_places_are_served_without_lookup(self, schedule):
+        GeocodeCache.objects.create(
+            city_key="iten", country_key="kenya", latitude=0.51, longitude=35.27
+        )
+        GeocodeCache.objects.create(
+            city_key="atlantis", country_key="kenya", source="unresolved"
+        )
+        located = geocoding.locate_many([("Iten", "Kenya"), ("Atlantis", "Kenya")])
+        self.assertEqual(located[("Iten", "Kenya")], (0.51, 35.27))
+        self.assertIsNone(located[("Atlantis", "Kenya")])
+        schedule.assert_not_called()
+
+    @patch("shop.geocoding.schedule")
+    def test_unknown_places_are_queued(self, schedule):
+        located = geocoding.locate_many([("Kapsabet", "Kenya")])
+        self.assertIsNone(located[("Kapsabet", "Kenya")])
+        schedule.assert_called_once_with({("kapsabet", "kenya")})
+
+    @patch("shop.geocoding.time.sleep")
+    @patch("shop.geocoding.fetch_coordinates", side_effect=[(0.2, 35.1), None])
+    def test_resolve_stores_results(self, fetch, sleep):
+        keys = {("kapsabet", "kenya"), ("nowhere", "kenya")}
+        self.assertEqual(geocoding.resolve(keys), 1)
+        self.assertEqual(GeocodeCache.objects.get(city_key="kapsabet").latitude, 0.2)
+        self.assertEqual(
+            GeocodeCache.objects.get(city_key="nowhere").source, "unresolved"
+        )
+
+    @patch("shop.geocoding.fetch_coordinates")
+    def test_admin_analytics_makes_no_outbound_calls(self, fetch):
+        admin = User.objects.create_user(
+            "admin", "admin@test.com", "pass1234", is_staff=True
+        )
+        UserProfile.objects.update_or_create(
+            user=admin, defaults={"city": "Mombasa", "country": "Kenya"}
+        )
+        response = self.client.post(
+            "/graphql/",
+            data=json.dumps({"query": "{ adminAnalytics { userLocations } }"}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {create_access_token(admin)}",
+        )
+        locations = response.json()["data"]["adminAnalytics"]["userLocations"]
+        mombasa = next(loc for loc in locations if loc["user"] == "admin")
+        self.assertIsNotNone(mombasa["lat"])
+        fetch.assert_not_called()
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        ratelimit.reset()
+        self.user = User.objects.create_user(
+            "admin", "admin@test.com", "pass1234", is_staff=True
+        )
+        self.category = Category.objects.create(name="Shoes", slug="shoes")
+        self.product = Product.objects.create(
+            name="Runner", description="Shoe", price="50.00", category=self.category
+        )
+
+    def _place_order(self, n, quantity=2):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(
+                user=self.user,
+                order_id=f"ORD{n}",
+                total_amount=quantity * 50,
+                shipping_address="Nairobi",
+            )
+            OrderItem.objects.create(
+                order=order,
+                product=self.product,
+                quantity=quantity,
+                price="50.00",
+                selected_size="M",
+            )
+        return order
+
+    def test_orders_update_daily_rollups(self):
+        self._place_order(1)
+        self._place_order(2, quantity=1)
+        day = DailySales.objects.get()
+        self.assertEqual((day.orders, day.units, day.revenue), (2, 3, 150))
+        product_day = DailyProductSales.objects.get(product=self.product)
+        self.assertEqual((product_day.order_items, product_day.units), (2, 3))
+        category_day = DailyCategorySales.objects.get(category=self.category)
+        self.assertEqual(category_day.revenue, 150)
+        self.assertEqual(rollups.totals(), {"orders": 2, "revenue": 150})
+
+    def test_deleting_an_order_rebuilds_its_day(self):
+        self._place_order(1)
+        order = self._place_order(2, quantity=1)
+        OrderItem.objects.create(
+            order=order, product=self.product, quantity=1, price="50.00"
+        )
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            order.delete()
+        self.assertEqual(len(callbacks), 1)
+        day = DailySales.objects.get()
+        self.assertEqual((day.orders, day.units, day.revenue), (1, 2, 100))
+
+    def test_deleting_an_item_rebuilds_its_day(self):
+        order = self._place_order(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            order.items.get().delete()
+        day = DailySales.objects.get()
+        self.assertEqual((day.orders, day.units, day.revenue), (1, 0, 100))
+
+    def test_refresh_rollups_rebuilds_from_orders(self):
+        self._place_order(1)
+        expected = list(DailyProductSales.objects.values("units", "revenue"))
+        DailySales.objects.all().delete()
+        DailyProductSales.objects.all().delete()
+
+        out = StringIO()
+        call_command("refresh_rollups", "--all", stdout=out)
+
+        self.assertIn("Rebuilt sales rollups", out.getvalue())
+        self.assertEqual(DailySales.objects.get().orders, 1)
+        self.assertEqual(
+            list(DailyProductSales.objects.values("units", "revenue")), expected
+        )
+
+    def test_migration_backfills_rollups_from_historical_models(self):
+        self._place_order(1)
+        # The migration fills the tables it has just created.
+        DailySales.objects.all().delete()
+        DailyProductSales.objects.all().delete()
+        DailyCategorySales.objects.all().delete()
+        migration = importlib.import_module("shop.migrations.0014_daily_rollups")
+        executor = MigrationExecutor(connection)
+        state = executor.loader.project_state(("shop", "0014_daily_rollups"))
+
+        migration.backfill_sales_rollups(state.apps, None)
+
+        self.assertEqual(DailySales.objects.get().orders, 1)
+        self.assertEqual(DailyProductSales.objects.get().units, 2)
+
+    def test_logins_are_counted_per_day(self):
+        mutation = (
+            'mutation { login(username: "admin", password: "pass1234") '
+            "{ accessToken } }"
+        )
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    "/graphql/",
+                    data=json.dumps({"query": mutation}),
+                    content_type="application/json",
+                )
+        logins = DailyLogins.objects.get()
+        self.assertEqual((logins.logins, logins.unique_users), (2, 1))
+        self.assertEqual(rollups.login_activity()[0]["logins"], 2)
+        logins = EventCounter.objects.filter(name="logins")
+        self.assertEqual(
+            list(logins.values_list("granularity", "value")), [("hour", 2)]
+        )
+
+    def test_admin_analytics_reads_rollups(self):
+        self._place_order(1)
+        query = (
+            "{ adminAnalytics { totalRevenue popularProducts salesTrends "
+            "categoryPreferences hourlyActivity } }"
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                "/graphql/",
+                data=json.dumps({"query": query}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {create_access_token(self.user)}",
+            )
+        data = response.json()["data"]["adminAnalytics"]
+        self.assertEqual(data["totalRevenue"], 100.0)
+        self.assertEqual(data["popularProducts"][0]["order_count"], 1)
+        self.assertEqual(data["salesTrends"][-1]["orders"], 1)
+        self.assertEqual(data["hourlyActivity"][0]["orders"], 1)
+        self.assertFalse(
+            any('"shop_orderitem"' in q["sql"] for q in ctx.captured_queries)
+        )
+
+
+class EventCounterTests(TestCase):
+    def test_counters_fill_hour_and_day_series(self):
+        now = timezone.now()
+        counters.incr({"orders": 1, "revenue": "99.50"}, now)
+        counters.incr({"orders": 1, "revenue": 100}, now)
+        self.assertEqual(EventCounter.objects.filter(name="orders").count(), 2)
+
+        hours = counters.series(["orders", "revenue"], "hour", 3, end=now)
+        self.assertEqual(len(hours), 3)
+        self.assertEqual(hours[0]["bucket"], counters.bucket_start(now, "hour"))
+        self.assertEqual((hours[0]["orders"], hours[0]["revenue"]), (2, 199.5))
+        self.assertEqual(hours[1]["orders"], 0)
+        days = counters.series(["orders"], "day", 1, end=now)
+        self.assertEqual(days[0]["orders"], 2)
+
+    def test_registrations_are_counted_and_orders_left_to_rollups(self):
+        mutation = (
+            'mutation { register(username: "newbie", email: "n@test.com", '
+            'password: "Str0ng-pass!") { accessToken } }'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/graphql/",
+                data=json.dumps({"query": mutation}),
+                content_type="application/json",
+            )
+        self.assertNotIn("errors", response.json())
+        user = User.objects.get(username="newbie")
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(
+                user=user,
+                order_id="ORD1",
+                total_amount="250.00",
+                shipping_address="Nairobi",
+            )
+
+        today = counters.series(["registrations"])[0]
+        self.assertEqual(today["registrations"], 1)
+        self.assertFalse(EventCounter.objects.filter(name="orders").exists())
+        self.assertEqual(rollups.totals(), {"orders": 1, "revenue": 250})
+        self.assertEqual(rollups.hourly_sales(1)[0]["orders"], 1)
+
+    @override_settings(**LOCMEM_CACHE)
+    @patch("shop.counters.jobs.enqueue")
+    @patch("shop.counters._redis")
+    @patch("shop.counters._uses_redis", return_value=True)
+    def test_buffered_increments_schedule_one_flush(self, _uses, _redis, enqueue):
+        cache.clear()
+        counters.incr({"registrations": 1})
+        counters.incr({"registrations": 1})
+        enqueue.assert_called_once_with(
+            "counters.flush", delay=counters._flush_interval()
+        )
+        self.assertFalse(EventCounter.objects.exists())
+
+    def test_flush_without_redis_is_a_no_op(self):
+        out = StringIO()
+        call_command("flush_counters", stdout=out)
+        self.assertIn("Flushed 0 counter buckets", out.getvalue())
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        ratelimit.reset()
+
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate("10/h"), (10, 3600))
+        self.assertEqual(ratelimit.parse_rate("5/10m"), (5, 600))
+
+    @patch("shop.ratelimit.time.monotonic")
+    def test_local_bucket_allows_burst_then_refills(self, monotonic):
+        monotonic.return_value = 1000.0
+        results = [ratelimit.hit("test", 3, 60) for _ in range(4)]
+        self.assertEqual([r.allowed for r in results], [True, True, True, False])
+        self.assertAlmostEqual(results[-1].retry_after, 20.0)
+
+        monotonic.return_value = 1020.0
+        self.assertTrue(ratelimit.hit("test", 3, 60).allowed)
+        self.assertFalse(ratelimit.hit("test", 3, 60).allowed)
+
+    @patch("shop.ratelimit._gcra_script")
+    @patch("shop.ratelimit._uses_redis", return_value=True)
+    def test_redis_script_result_and_fallback(self, uses_redis, script):
+        script.return_value.return_value = [0, 0, 1500]
+        result = ratelimit.hit("test", 5, 60)
+        self.assertEqual(result, (False, 0, 1.5))
+        _, kwargs = script.return_value.call_args
+        self.assertEqual(kwargs["keys"], ["arnova:rl:test"])
+
+        script.return_value.side_effect = ConnectionError("redis down")
+        self.assertTrue(ratelimit.hit("test", 5, 60).allowed)
+
+    def test_rest_and_graphql_limits(self):
+        for _ in range(5):
+            self.client.post(
+                "/api/login/",
+                data=json.dumps({"username": "x", "password": "y"}),
+                content_type="application/json",
+            )
+        response = self.client.post(
+            "/api/login/",
+            data=json.dumps({"username": "x", "password": "y"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 429)
+
+        for _ in range(5):
+            rate_limit("login:127.0.0.1", 5, 60)
+        with self.assertRaisesMessage(GraphQLError, "Rate limit exceeded"):
+            rate_limit("login:127.0.0.1", 5, 60)
+
+
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        auth.verified_tokens.clear()
+        self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
+        self.token = create_access_token(self.user)
+
+    def _me(self):
+        response = self.client.post(
+            "/graphql/",
+            data=json.dumps({"query": "{ me { username } }"}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {self.token}",
+        )
+        return response.json()["data"]["me"]
+
+    def test_repeat_requests_skip_decode_and_user_query(self):
+        self.assertEqual(self._me(), {"username": "buyer"})
+        with patch("shop.graphql.auth.jwt.decode") as decode:
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self._me(), {"username": "buyer"})
+        decode.assert_not_called()
+        self.assertFalse(any("auth_user" in q["sql"] for q in ctx.captured_queries))
+
+    def test_deactivation_invalidates_snapshot(self):
+        self._me()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertIsNone(self._me())
+
+    def test_saving_a_snapshot_keeps_the_password(self):
+        snapshot = auth.get_cached_user(self.user.pk)
+        snapshot.first_name = "Bea"
+        snapshot.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, "Bea")
+        self.assertTrue(self.user.check_password("pass1234"))
+
+    def test_expired_tokens_are_not_served_from_cache(self):
+        auth.verified_tokens.set("expired", {"sub": "1", "exp": time.time() - 1})
+        self.assertIsNone(auth.verified_tokens.get("expired"))
+
+
+class OutboundClientTests(TestCase):
+    URL = "https://api.exchangerate-api.com/v4/latest/USD"
+
+    def setUp(self):
+        super().setUp()
+        outbound.reset()
+
+    def test_session_is_pooled_per_host_and_posts_are_not_retried(self):
+        session = outbound._session("api.exchangerate-api.com")
+        self.assertIs(session, outbound._session("api.exchangerate-api.com"))
+        self.assertIsNot(session, outbound._session("api.unsplash.com"))
+        retry = session.get_adapter(self.URL).max_retries
+        self.assertIn("GET", retry.allowed_methods)
+        self.assertNotIn("POST", retry.allowed_methods)
+
+    @patch("shop.outbound.requests.Session.request")
+    def test_uses_host_timeouts_and_records_metrics(self, send):
+        send.return_value = MagicMock(status_code=200)
+        outbound.get(self.URL)
+        self.assertEqual(send.call_args.kwargs["timeout"], (3.05, 5.0))
+        stats = outbound.metrics()["api.exchangerate-api.com"]
+        self.assertEqual((stats["calls"], stats["errors"]), (1, 0))
+        self.assertEqual(stats["circuit"], "closed")
+
+    @patch("shop.outbound.time.monotonic")
+    @patch("shop.outbound.requests.Session.request")
+    def test_circuit_opens_after_failures_and_half_opens(self, send, monotonic):
+        import requests
+
+        monotonic.return_value = 1000.0
+        send.side_effect = requests.ConnectionError("down")
+        for _ in range(5):
+            with self.assertRaises(requests.ConnectionError):
+                outbound.get(self.URL)
+        with self.assertRaises(outbound.CircuitOpenError):
+            outbound.get(self.URL)
+        self.assertEqual(send.call_count, 5)
+        self.assertEqual(outbound.metrics()["api.exchangerate-api.com"]["errors"], 6)
+
+        monotonic.return_value = 1031.0
+        send.side_effect = None
+        send.return_value = MagicMock(status_code=200)
+        outbound.get(self.URL)
+        self.assertEqual(
+            outbound.metrics()["api.exchangerate-api.com"]["circuit"], "closed"
+        )
+
+    @patch("shop.outbound.httpx.AsyncClient.request", new_callable=AsyncMock)
+    def test_cancelled_trial_call_frees_the_half_open_circuit(self, send):
+        breaker = outbound._breaker("api.exchangerate-api.com")
+        breaker.opened_at = time.monotonic() - breaker.reset_after
+        send.side_effect = asyncio.CancelledError
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(outbound.aget(self.URL))
+
+        send.side_effect = None
+        send.return_value = MagicMock(status_code=200)
+        asyncio.run(outbound.aget(self.URL))
+        self.assertEqual(breaker.state, "closed")
+
+    def test_health_check_reports_metrics_to_staff_only(self):
+        self.assertNotIn("outbound", self.client.get("/api/health/").json())
+        staff = User.objects.create_user("ops", "ops@test.com", "pass", is_staff=True)
+        self.client.force_login(staff)
+        self.assertIn("outbound", self.client.get("/api/health/").json())
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        jobs.local_queue.clear()
+        self.calls = []
+        jobs.handler("test.record")(lambda **payload: self.calls.append(payload))
+
+    def _enqueue(self, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return jobs.enqueue(*args, **kwargs)
+
+    def test_jobs_run_after_commit_and_keys_dedupe(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            jobs.enqueue("test.record", {"n": 1}, key="once")
+        self.assertEqual(jobs.local_queue.pending(), 0)
+        for callback in callbacks:
+            callback()
+        self._enqueue("test.record", {"n": 2}, key="once")
+        self._enqueue("test.record", {"n": 3})
+        self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(self.calls, [{"n": 1}, {"n": 3}])
+
+    @patch("shop.jobs.time.time")
+    def test_failures_back_off_then_dead_letter(self, now):
+        now.return_value = 1000.0
+        self._enqueue("test.missing", key="doomed", max_attempts=2)
+        with self.assertLogs("shop", level="WARNING"):
+            self.assertEqual(jobs.work(burst=True), 1)
+        # The retry waits RETRY_BASE_DELAY seconds.
+        self.assertEqual(jobs.work(burst=True), 0)
+        now.return_value = 1000.0 + jobs.RETRY_BASE_DELAY
+        with self.assertLogs("shop", level="ERROR"):
+            self.assertEqual(jobs.work(burst=True), 1)
+        self.assertEqual(jobs.local_queue.pending(), 0)
+        dead = json.loads(jobs.local_queue.dead[0])
+        self.assertEqual((dead["name"], dead["attempts"]), ("test.missing", 2))
+        # A dead job frees its key so the work can be queued again.
+        self._enqueue("test.missing", key="doomed")
+        self.assertEqual(jobs.local_queue.pending(), 1)
+
+    def test_run_jobs_command(self):
+        self._enqueue("test.record", {"n": 1})
+        out = StringIO()
+        call_command("run_jobs", "--burst", stdout=out)
+        self.assertIn("Ran 1 jobs", out.getvalue())
+        self.assertEqual(self.calls, [{"n": 1}])
+
+    @patch("shop.jobs.time.time")
+    def test_delayed_jobs_wait_until_due(self, now):
+        now.return_value = 1000.0
+        self._enqueue("test.record", {"n": 1}, delay=5)
+        self.assertEqual(jobs.work(burst=True), 0)
+        now.return_value = 1005.0
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertEqual(self.calls, [{"n": 1}])
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        ratelimit.reset()
+        self.user = User.objects.create_user("shopper", "s@test.com", "pass1234")
+        self.other = User.objects.create_user("other", "o@test.com", "pass1234")
+        category = Category.objects.create(name="Shoes", slug="shoes")
+        self.shoe = Product.objects.create(
+            name="Runner",
+            description="Shoe",
+            price="50.00",
+            category=category,
+            sizes=["42", "43"],
+        )
+        self.boot = Product.objects.create(
+            name="Boot", description="Boot", price="80.00", category=category
+        )
+
+    def _graphql(self, query):
+        response = self.client.post(
+            "/graphql/",
+            data=json.dumps({"query": query}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {create_access_token(self.user)}",
+        )
+        return response.json()
+
+    def test_rest_cart_round_trip(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            "/api/cart/add/",
+            data=json.dumps(
+                {"product_id": self.shoe.id, "quantity": 2, "selected_size": "42"}
+            ),
+            content_type="application/json",
+        )
+        item_id = response.json()["item_id"]
+        self.assertEqual(CartItem.objects.get(id=item_id).quantity, 2)
+
+        response = self.client.put(
+            f"/api/cart/{item_id}/",
+            data=json.dumps({"quantity": 3}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        items = self.client.get("/api/cart/").json()["items"]
+        self.assertEqual([item["quantity"] for item in items], [3])
+
+        self.assertEqual(self.client.delete(f"/api/cart/{item_id}/").status_code, 200)
+        self.assertEqual(self.client.delete(f"/api/cart/{item_id}/").status_code, 404)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_lines_of_another_cart_are_not_found(self):
+        item_id = carts.add(self.other, self.shoe, 1)
+        self.client.force_login(self.user)
+        response = self.client.put(
+            f"/api/cart/{item_id}/",
+            data=json.dumps({"quantity": 5}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.delete(f"/api/cart/{item_id}/").status_code, 404)
+        self.assertEqual(CartItem.objects.get(id=item_id).quantity, 1)
+
+    def test_graphql_cart_uses_the_service(self):
+        data = self._graphql(
+            "mutation { cartAdd(input: {productId: %d, quantity: 2, "
+            'selectedSize: "42", selectedColor: "red"}) { success } }' % self.shoe.id
+        )
+        self.assertTrue(data["data"]["cartAdd"]["success"])
+        [line] = carts.lines(self.user)
+        self.assertEqual((line.quantity, line.selected_color), (2, "red"))
+
+        self._graphql(
+            "mutation { cartUpdate(itemId: %d, quantity: 4) { success } }" % line.id
+        )
+        data = self._graphql("{ cart { items { id quantity product { name } } } }")
+        self.assertEqual(
+            data["data"]["cart"]["items"],
+            [{"id": str(line.id), "quantity": 4, "product": {"name": "Runner"}}],
+        )
+
+        data = self._graphql(
+            "mutation { cartUpdate(itemId: %d, quantity: 1) { success } }" % 999999
+        )
+        self.assertIn("errors", data)
+        self._graphql("mutation { cartRemove(itemId: %d) { success } }" % line.id)
+        self.assertEqual(carts.lines(self.user), [])
+
+    def test_persist_applies_snapshots_in_bulk(self):
+        kept = carts.add(self.user, self.shoe, 1, "42")
+        carts.add(self.user, self.boot, 1)
+        snapshots = {
+            self.user.pk: {
+                (self.shoe.pk, "42", ""): 3,
+                (self.shoe.pk, "43", ""): 1,
+                (999999, "", ""): 1,
+            },
+            self.other.pk: {(self.boot.pk, "", "black"): 2},
+            999999: {(self.boot.pk, "", ""): 1},
+        }
+        with self.assertNumQueries(12):
+            self.assertEqual(carts.persist(snapshots), 2)
+
+        lines = {
+            (line.product_id, line.selected_size, line.quantity)
+            for line in carts.lines(self.user)
+        }
+        self.assertEqual(lines, {(self.shoe.pk, "42", 3), (self.shoe.pk, "43", 1)})
+        # Lines that stay keep their id.
+        self.assertEqual(CartItem.objects.get(selected_size="42").id, kept)
+        [line] = carts.lines(self.other)
+        self.assertEqual((line.product_id, line.quantity), (self.boot.pk, 2))
+        self.assertTrue(Cart.objects.filter(user=self.other).exists())
+
+    def _batch(self, operations):
+        return self.client.post(
+            "/api/cart/batch/",
+            data=json.dumps({"operations": operations}),
+            content_type="application/json",
+        )
+
+    def test_batch_applies_operations_together(self):
+        kept = carts.add(self.user, self.shoe, 1, "42")
+        dropped = carts.add(self.user, self.shoe, 1, "43")
+        self.boot.on_sale, self.boot.sale_price = True, "60.00"
+        self.boot.save()
+        self.client.force_login(self.user)
+        response = self._batch(
+            [
+                {"action": "update", "item_id": kept, "quantity": 2},
+                {"action": "remove", "item_id": dropped},
+                {"action": "add", "product_id": self.boot.id, "quantity": 1},
+                {"action": "add", "product_id": self.boot.id, "quantity": 3},
+            ]
+        )
+        data = response.json()
+        self.assertEqual(
+            [(item["product"]["name"], item["quantity"]) for item in data["items"]],
+            [("Runner", 2), ("Boot", 3)],
+        )
+        self.assertEqual(data["items"][0]["id"], kept)
+        self.assertEqual(
+            data["totals"],
+            {"currency": "KES", "item_count": 5, "subtotal": 280.0, "discount": 60.0},
+        )
+
+        # The work does not grow with the number of operations.
+        def queries(count):
+            operations = [
+                {"action": "add", "product_id": self.boot.id, "quantity": n + 1}
+                for n in range(count)
+            ]
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self._batch(operations).status_code, 200)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(queries(2), queries(20))
+
+    def test_invalid_batch_applies_nothing(self):
+        item_id = carts.add(self.user, self.shoe, 1)
+        theirs = carts.add(self.other, self.boot, 1)
+        self.client.force_login(self.user)
+        for operations in (
+            [
+                {"action": "update", "item_id": item_id, "quantity": 5},
+                {"action": "remove", "item_id": theirs},
+            ],
+            [{"action": "add", "product_id": self.shoe.id, "selected_size": "99"}],
+            [{"action": "add", "product_id": 999999}, {"action": "clear"}],
+            [{"action": "update", "quantity": 2}],
+            [{"action": "empty"}],
+        ):
+            self.assertEqual(self._batch(operations).status_code, 400)
+        self.assertEqual(CartItem.objects.get(id=item_id).quantity, 1)
+        self.assertEqual(CartItem.objects.count(), 2)
+
+    def test_graphql_cart_apply(self):
+        carts.add(self.user, self.shoe, 1)
+        data = self._graphql(
+            'mutation { cartApply(operations: [{action: "clear"}, '
+            '{action: "add", productId: %d, quantity: 2}]) '
+            "{ items { quantity product { name } } itemCount subtotal } }"
+            % self.boot.id
+        )
+        self.assertEqual(
+            data["data"]["cartApply"],
+            {
+                "items": [{"quantity": 2, "product": {"name": "Boot"}}],
+                "itemCount": 2,
+                "subtotal": 160.0,
+            },
+        )
+        data = self._graphql(
+            'mutation { cartApply(operations: [{action: "remove"}]) { itemCount } }'
+        )
+        self.assertIn("item_id is required", data["errors"][0]["message"])
+
+    @override_settings(**LOCMEM_CACHE)
+    def test_priced_cart_is_cached_until_the_cart_or_a_price_changes(self):
+        cache.clear()
+        item_id = carts.add(self.user, self.shoe, 2, "42")
+        with self.captureOnCommitCallbacks(execute=True):
+            carts.add(self.user, self.boot, 1)
+        self.assertEqual(pricing.price_cart(self.user).subtotal, Decimal("180.00"))
+        with self.assertNumQueries(0):
+            pricing.price_cart(self.user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            carts.update(self.user, item_id, 1)
+        self.assertEqual(pricing.price_cart(self.user).subtotal, Decimal("130.00"))
+
+        self.boot.on_sale, self.boot.sale_price = True, "70.00"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.boot.save()
+        priced = pricing.price_cart(self.user)
+        self.assertEqual(
+            (priced.item_count, priced.subtotal, priced.discount),
+            (2, Decimal("120.00"), Decimal("10.00")),
+        )
+
+    def test_prices_are_converted_to_the_store_currency(self):
+        exchange_rates.store_rate_table("USD", {"USD": 1.0, "KES": 129.5}, time.time())
+        self.addCleanup(exchange_rates.clear_snapshots)
+        self.boot.currency = "USD"
+        self.boot.save()
+        carts.add(self.user, self.boot, 2)
+        [line] = pricing.price_cart(self.user).lines
+        self.assertEqual(line.unit_price, Decimal("10360.00"))
+        self.assertEqual(line.total, Decimal("20720.00"))
+
+        self.client.force_login(self.user)
+        totals = self.client.get("/api/cart/").json()["totals"]
+        self.assertEqual(totals["subtotal"], 20720.0)
+        data = self._graphql("{ cart { currency itemCount subtotal discount } }")
+        self.assertEqual(
+            data["data"]["cart"],
+            {"currency": "KES", "itemCount": 2, "subtotal": 20720.0, "discount": 0.0},
+        )
+
+    def test_flush_carts_command_without_redis(self):
+        out = StringIO()
+        call_command("flush_carts", stdout=out)
+        self.assertIn("Flushed 0 carts", out.getvalue())
@@ -1,25 +1,40 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from decimal import Decimal
-from unittest.mock import MagicMock, patch
+from io import StringIO
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import httpx
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import RequestFactory, TestCase
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
 
+from shop import carts, jobs, payment_views, pricing, ratelimit, reconciliation
+from shop.graphql.auth import create_access_token
 from shop.models import (
     Cart,
     Category,
+    DailyProductSales,
+    DailySales,
     MpesaPayment,
+    Notification,
     Order,
+    OrderItem,
     Payment,
     Product,
     UserProfile,
 )
 from shop.payment_views import (
-    check_mpesa_status,
+    create_order_and_payment,
     generate_mpesa_password,
     get_mpesa_access_token,
+    mpesa_status,
     process_payment,
     validate_card,
 )
@@ -56,12 +71,42 @@ def _make_post_request(user, body):
     return request
 
 
+def _pending_mpesa_payment(user, checkout_request_id, age=0):
+    """An order paid by an STK push that has been pending for ``age`` seconds."""
+    order = Order.objects.create(
+        user=user,
+        order_id=f"ARNOVA_{checkout_request_id}",
+        total_amount=Decimal("500.00"),
+        shipping_address="{}",
+    )
+    payment = Payment.objects.create(
+        order=order,
+        payment_method="mpesa",
+        amount=Decimal("500.00"),
+        currency="KES",
+        status="processing",
+    )
+    mpesa = MpesaPayment.objects.create(
+        payment=payment,
+        phone_number="254712345678",
+        checkout_request_id=checkout_request_id,
+        merchant_request_id=f"mr_{checkout_request_id}",
+    )
+    MpesaPayment.objects.filter(pk=mpesa.pk).update(
+        created_at=timezone.now() - timedelta(seconds=age)
+    )
+    return mpesa
+
+
 # ---------------------------------------------------------------------------
 # 1. OAuth token
 # ---------------------------------------------------------------------------
 @override_settings(**MPESA_SETTINGS)
 class MpesaAccessTokenTests(TestCase):
-    @patch("shop.payment_views.requests.get")
+    def setUp(self):
+        cache.clear()
+
+    @patch("shop.payment_views.outbound.aget", new_callable=AsyncMock)
     def test_returns_token_on_success(self, mock_get):
         mock_get.return_value = MagicMock(
             status_code=200,
@@ -69,19 +114,55 @@ class MpesaAccessTokenTests(TestCase):
         )
         mock_get.return_value.raise_for_status = MagicMock()
 
-        token = get_mpesa_access_token()
+        token = async_to_sync(get_mpesa_access_token)()
         self.assertEqual(token, "sandbox_token_abc")
         self.assertIn("sandbox.safaricom.co.ke", mock_get.call_args[0][0])
 
-    @patch("shop.payment_views.requests.get")
+    @patch("shop.payment_views.outbound.aget", new_callable=AsyncMock)
     def test_raises_on_http_error(self, mock_get):
-        from requests.exceptions import HTTPError
-
-        mock_get.return_value.raise_for_status.side_effect = HTTPError("401")
+        mock_get.return_value = MagicMock()
+        mock_get.return_value.raise_for_status.side_effect = httpx.HTTPError("401")
         with self.assertRaises(Exception) as ctx:
-            get_mpesa_access_token()
+            async_to_sync(get_mpesa_access_token)()
         self.assertIn("Failed to get M-Pesa access token", str(ctx.exception))
 
+    def _token_response(self, token, expires_in="3599"):
+        response = MagicMock(
+            json=lambda: {"access_token": token, "expires_in": expires_in}
+        )
+        response.raise_for_status = MagicMock()
+        return response
+
+    @patch("shop.payment_views.outbound.aget", new_callable=AsyncMock)
+    def test_token_is_cached_until_renewal_window(self, mock_get):
+        mock_get.side_effect = [
+            self._token_response("short", expires_in="200"),
+            self._token_response("renewed"),
+        ]
+        self.assertEqual(async_to_sync(get_mpesa_access_token)(), "short")
+        # Inside the renewal margin: one caller renews...
+        self.assertEqual(async_to_sync(get_mpesa_access_token)(), "renewed")
+        # ...and everyone else reads the cached token.
+        self.assertEqual(async_to_sync(get_mpesa_access_token)(), "renewed")
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("shop.payment_views.outbound.aget", new_callable=AsyncMock)
+    def test_other_workers_keep_current_token_while_renewing(self, mock_get):
+        mock_get.return_value = self._token_response("short", expires_in="200")
+        async_to_sync(get_mpesa_access_token)()
+        key = payment_views._token_cache_key()
+        cache.set(f"{key}:lock", "another-worker", 30)
+        self.assertEqual(async_to_sync(get_mpesa_access_token)(), "short")
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch("shop.payment_views.outbound.aget", new_callable=AsyncMock)
+    def test_failed_renewal_falls_back_to_current_token(self, mock_get):
+        mock_get.return_value = self._token_response("short", expires_in="200")
+        async_to_sync(get_mpesa_access_token)()
+        mock_get.side_effect = httpx.ConnectError("down")
+        with self.assertLogs("shop", level="WARNING"):
+            self.assertEqual(async_to_sync(get_mpesa_access_token)(), "short")
+
 
 # ---------------------------------------------------------------------------
 # 2. Password / timestamp generation
@@ -105,6 +186,7 @@ class MpesaPasswordTests(TestCase):
 class PhoneNumberFormattingTests(TestCase):
     def setUp(self):
         cache.clear()
+        ratelimit.reset()
         self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
 
     def _stk_payload(self, phone):
@@ -114,7 +196,7 @@ class PhoneNumberFormattingTests(TestCase):
             "phone_number": phone,
         }
 
-    @patch("shop.payment_views.requests.post")
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
     @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
     def _fire(self, phone, mock_token, mock_post):
         mock_post.return_value = MagicMock(
@@ -128,7 +210,7 @@ class PhoneNumberFormattingTests(TestCase):
         mock_post.return_value.raise_for_status = MagicMock()
 
         request = _make_post_request(self.user, self._stk_payload(phone))
-        process_payment(request)
+        async_to_sync(process_payment)(request)
         sent_payload = mock_post.call_args[1].get("json", {})
         return sent_payload.get("PhoneNumber")
 
@@ -152,6 +234,7 @@ class PhoneNumberFormattingTests(TestCase):
 class STKPushTests(TestCase):
     def setUp(self):
         cache.clear()
+        ratelimit.reset()
         self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
         self.category = Category.objects.create(name="Shoes", slug="shoes")
         self.product = Product.objects.create(
@@ -169,7 +252,7 @@ class STKPushTests(TestCase):
     def _payload(self, **overrides):
         base = {
             "payment_method": "mpesa",
-            "amount": 350,
+            "amount": 351,
             "phone_number": "0712345678",
             "order_data": {
                 "shippingAddress": {
@@ -183,7 +266,7 @@ class STKPushTests(TestCase):
         base.update(overrides)
         return base
 
-    @patch("shop.payment_views.requests.post")
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
     @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
     def test_stk_push_success_creates_records(self, _tok, mock_post):
         mock_post.return_value = MagicMock(
@@ -197,7 +280,7 @@ class STKPushTests(TestCase):
         mock_post.return_value.raise_for_status = MagicMock()
 
         request = _make_post_request(self.user, self._payload())
-        response = process_payment(request)
+        response = async_to_sync(process_payment)(request)
         data = json.loads(response.content)
 
         self.assertTrue(data["success"])
@@ -217,7 +300,37 @@ class STKPushTests(TestCase):
         self.assertEqual(mpesa.checkout_request_id, "ws_CO_123")
         self.assertEqual(mpesa.phone_number, "254712345678")
 
-    @patch("shop.payment_views.requests.post")
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_stk_push_charges_the_server_total(self, _tok, mock_post):
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
+                "ResponseCode": "0",
+                "CheckoutRequestID": "ws_CO_1",
+                "MerchantRequestID": "mr_1",
+            },
+        )
+        async_to_sync(process_payment)(
+            _make_post_request(self.user, self._payload(amount=5000))
+        )
+
+        self.assertEqual(mock_post.call_args[1]["json"]["Amount"], 351)
+        payment = Payment.objects.get()
+        self.assertEqual(payment.amount, Decimal("351.00"))
+        self.assertEqual(payment.order.total_amount, Decimal("351.00"))
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_stk_push_amount_below_server_total_returns_400(self, _tok, mock_post):
+        request = _make_post_request(self.user, self._payload(amount=1))
+        response = async_to_sync(process_payment)(request)
+
+        self.assertEqual(response.status_code, 400)
+        mock_post.assert_not_called()
+        self.assertEqual(Order.objects.count(), 0)
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
     @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
     def test_stk_push_api_error_returns_failure(self, _tok, mock_post):
         mock_post.return_value = MagicMock(
@@ -230,7 +343,7 @@ class STKPushTests(TestCase):
         mock_post.return_value.raise_for_status = MagicMock()
 
         request = _make_post_request(self.user, self._payload())
-        response = process_payment(request)
+        response = async_to_sync(process_payment)(request)
         data = json.loads(response.content)
 
         self.assertFalse(data["success"])
@@ -241,7 +354,7 @@ class STKPushTests(TestCase):
         payload = self._payload()
         payload.pop("phone_number")
         request = _make_post_request(self.user, payload)
-        response = process_payment(request)
+        response = async_to_sync(process_payment)(request)
         data = json.loads(response.content)
 
         self.assertFalse(data["success"])
@@ -251,7 +364,7 @@ class STKPushTests(TestCase):
         request = _make_post_request(
             self.user, {"payment_method": "bitcoin", "amount": 100}
         )
-        response = process_payment(request)
+        response = async_to_sync(process_payment)(request)
         data = json.loads(response.content)
 
         self.assertFalse(data["success"])
@@ -265,6 +378,8 @@ class STKPushTests(TestCase):
 class MpesaCallbackTests(TestCase):
     def setUp(self):
         cache.clear()
+        jobs.local_queue.clear()
+        ratelimit.reset()
         self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
         self.order = Order.objects.create(
             user=self.user,
@@ -288,11 +403,15 @@ class MpesaCallbackTests(TestCase):
         )
 
     def _post_callback(self, body):
-        return self.client.post(
-            "/webhooks/mpesa/",
-            data=json.dumps(body),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/webhooks/mpesa/",
+                data=json.dumps(body),
+                content_type="application/json",
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            jobs.work(burst=True)
+        return response
 
     def test_successful_callback_completes_payment(self):
         body = {
@@ -345,6 +464,72 @@ class MpesaCallbackTests(TestCase):
         self.assertEqual(self.mpesa.result_code, "1032")
         self.assertEqual(self.payment.status, "failed")
 
+    def test_callback_is_applied_before_acknowledging_without_durable_jobs(self):
+        body = {
+            "Body": {
+                "stkCallback": {
+                    "CheckoutRequestID": "ws_CO_cb_test",
+                    "ResultCode": 1032,
+                    "ResultDesc": "Request cancelled by user.",
+                }
+            }
+        }
+        response = self.client.post(
+            "/webhooks/mpesa/",
+            data=json.dumps(body),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["ResultCode"], 0)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "failed")
+        self.assertEqual(jobs.local_queue.pending(), 0)
+
+    @patch("shop.jobs.durable", return_value=True)
+    def test_callback_is_acknowledged_before_processing(self, _durable):
+        body = {
+            "Body": {
+                "stkCallback": {
+                    "CheckoutRequestID": "ws_CO_cb_test",
+                    "ResultCode": 1032,
+                    "ResultDesc": "Request cancelled by user.",
+                }
+            }
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post(
+                    "/webhooks/mpesa/",
+                    data=json.dumps(body),
+                    content_type="application/json",
+                )
+        self.assertEqual(response.json()["ResultCode"], 0)
+        self.assertFalse(
+            any("shop_mpesapayment" in q["sql"] for q in ctx.captured_queries)
+        )
+        self.assertEqual(jobs.local_queue.pending(), 1)
+
+    def test_redelivered_callback_is_applied_once(self):
+        body = {
+            "Body": {
+                "stkCallback": {
+                    "CheckoutRequestID": "ws_CO_cb_test",
+                    "ResultCode": 0,
+                    "ResultDesc": "Success",
+                    "CallbackMetadata": {
+                        "Item": [{"Name": "MpesaReceiptNumber", "Value": "QJK3ABC"}]
+                    },
+                }
+            }
+        }
+        self._post_callback(body)
+        self._post_callback(body)
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "processing")
+        notes = Notification.objects.filter(user=self.user)
+        self.assertEqual(notes.count(), 1)
+        self.assertEqual(notes.get().title, "Payment received")
+
     def test_callback_with_unknown_checkout_id_still_returns_200(self):
         body = {
             "Body": {
@@ -362,48 +547,141 @@ class MpesaCallbackTests(TestCase):
 
 
 # ---------------------------------------------------------------------------
-# 6. STK Push Query (status check)
+# 6. STK Push Query (status check) – answered from stored results
 # ---------------------------------------------------------------------------
-@override_settings(**MPESA_SETTINGS)
+@override_settings(**MPESA_SETTINGS, **LOCMEM_CACHE)
 class MpesaStatusQueryTests(TestCase):
     def setUp(self):
-        self.factory = RequestFactory()
+        cache.clear()
+        ratelimit.reset()
+        jobs.local_queue.clear()
+        self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
 
-    @patch("shop.payment_views.requests.post")
-    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
-    def test_status_success(self, _tok, mock_post):
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: {
-                "ResultCode": "0",
-                "ResultDesc": "The service request is processed successfully.",
-                "MpesaReceiptNumber": "QJK3ABCDEF",
-            },
+    def _status(self, checkout_request_id):
+        response = async_to_sync(mpesa_status)(checkout_request_id)
+        return response.status_code, json.loads(response.content)
+
+    def _query_response(self, body):
+        response = MagicMock(status_code=200, json=lambda: body)
+        response.raise_for_status = MagicMock()
+        return response
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    def test_recent_pending_payment_is_answered_locally(self, mock_post):
+        _pending_mpesa_payment(self.user, "ws_CO_new")
+        code, data = self._status("ws_CO_new")
+        self.assertEqual((code, data["status"]), (200, "pending"))
+        mock_post.assert_not_called()
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    def test_settled_payment_reads_stored_result(self, mock_post):
+        mpesa = _pending_mpesa_payment(self.user, "ws_CO_paid", age=600)
+        MpesaPayment.objects.filter(pk=mpesa.pk).update(
+            result_code="0", mpesa_receipt_number="QJK3ABCDEF"
         )
-        mock_post.return_value.raise_for_status = MagicMock()
-
-        request = self.factory.get("/")
-        response = check_mpesa_status(request, "ws_CO_123")
-        data = json.loads(response.content)
+        code, data = self._status("ws_CO_paid")
         self.assertEqual(data["status"], "success")
-        self.assertEqual(data["result_code"], "0")
+        self.assertEqual(data["transaction_id"], "QJK3ABCDEF")
+        mock_post.assert_not_called()
 
-    @patch("shop.payment_views.requests.post")
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_stale_pending_payment_is_queried_once_per_interval(self, _tok, mock_post):
+        mpesa = _pending_mpesa_payment(self.user, "ws_CO_456", age=60)
+        mock_post.return_value = self._query_response(
+            {"ResultCode": "1032", "ResultDesc": "Request cancelled by user"}
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            code, data = self._status("ws_CO_456")
+        self.assertEqual((data["status"], data["result_code"]), ("failed", "1032"))
+        self._status("ws_CO_456")
+        self.assertEqual(mock_post.call_count, 1)
+        mpesa.payment.refresh_from_db()
+        self.assertEqual(mpesa.payment.status, "failed")
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
     @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
-    def test_status_pending(self, _tok, mock_post):
+    def test_push_still_processing_stays_pending(self, _tok, mock_post):
+        _pending_mpesa_payment(self.user, "ws_CO_wait", age=60)
         mock_post.return_value = MagicMock(
-            status_code=200,
+            status_code=500,
             json=lambda: {
-                "ResultCode": "1032",
-                "ResultDesc": "Request cancelled by user",
+                "errorCode": "500.001.1001",
+                "errorMessage": "The transaction is being processed",
             },
         )
-        mock_post.return_value.raise_for_status = MagicMock()
+        code, data = self._status("ws_CO_wait")
+        self.assertEqual((code, data["status"]), (200, "pending"))
+        mock_post.return_value.raise_for_status.assert_not_called()
 
-        request = self.factory.get("/")
-        response = check_mpesa_status(request, "ws_CO_456")
-        data = json.loads(response.content)
-        self.assertEqual(data["status"], "pending")
+    def test_unknown_checkout_id_returns_404(self):
+        code, data = self._status("ws_CO_missing")
+        self.assertEqual((code, data["status"]), (404, "failed"))
+
+
+@override_settings(**MPESA_SETTINGS, **LOCMEM_CACHE)
+class MpesaReconciliationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        ratelimit.reset()
+        jobs.local_queue.clear()
+        self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
+
+    @patch("shop.reconciliation.reconcile")
+    def test_new_push_schedules_sweeps_until_settled(self, reconcile):
+        with self.captureOnCommitCallbacks(execute=True):
+            _pending_mpesa_payment(self.user, "ws_CO_a")
+            _pending_mpesa_payment(self.user, "ws_CO_b")
+        self.assertEqual(jobs.local_queue.pending(), 1)
+
+        jobs.local_queue.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            reconciliation.sweep()
+        self.assertEqual(jobs.local_queue.pending(), 1)
+
+        MpesaPayment.objects.update(result_code="0")
+        jobs.local_queue.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            reconciliation.sweep()
+        self.assertEqual(reconcile.call_count, 2)
+        self.assertEqual(jobs.local_queue.pending(), 0)
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_sweeps_stale_pending_payments_in_bulk(self, _tok, mock_post):
+        paid = _pending_mpesa_payment(self.user, "ws_CO_a", age=120)
+        cancelled = _pending_mpesa_payment(self.user, "ws_CO_b", age=120)
+        waiting = _pending_mpesa_payment(self.user, "ws_CO_c", age=120)
+        _pending_mpesa_payment(self.user, "ws_CO_recent", age=5)
+        answers = {
+            "ws_CO_a": {"ResultCode": "0", "ResultDesc": "Processed"},
+            "ws_CO_b": {"ResultCode": "1032", "ResultDesc": "Cancelled"},
+            "ws_CO_c": {"errorCode": "500.001.1001"},
+        }
+
+        async def answer(url, json, headers):
+            body = answers[json["CheckoutRequestID"]]
+            return MagicMock(status_code=200, json=lambda: body)
+
+        mock_post.side_effect = answer
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("reconcile_mpesa", stdout=out)
+        self.assertIn("Settled 2 of 3", out.getvalue())
+
+        statuses = dict(
+            Payment.objects.filter(
+                mpesa_details__in=[paid, cancelled, waiting]
+            ).values_list("mpesa_details__checkout_request_id", "status")
+        )
+        self.assertEqual(
+            statuses,
+            {"ws_CO_a": "completed", "ws_CO_b": "failed", "ws_CO_c": "processing"},
+        )
+        self.assertEqual(
+            Order.objects.get(payment__mpesa_details=paid).status, "processing"
+        )
+        self.assertEqual(jobs.local_queue.pending(), 2)
 
 
 # ---------------------------------------------------------------------------
@@ -448,6 +726,7 @@ class CardValidationTests(TestCase):
 class CardPaymentTests(TestCase):
     def setUp(self):
         cache.clear()
+        ratelimit.reset()
         self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
 
     def test_card_payment_success(self):
@@ -462,7 +741,7 @@ class CardPaymentTests(TestCase):
             },
         }
         request = _make_post_request(self.user, payload)
-        response = process_payment(request)
+        response = async_to_sync(process_payment)(request)
         data = json.loads(response.content)
 
         self.assertTrue(data["success"])
@@ -475,7 +754,7 @@ class CardPaymentTests(TestCase):
             "card_data": {"cardNumber": "4111111111111111"},
         }
         request = _make_post_request(self.user, payload)
-        response = process_payment(request)
+        response = async_to_sync(process_payment)(request)
         data = json.loads(response.content)
 
         self.assertFalse(data["success"])
@@ -489,6 +768,7 @@ class CardPaymentTests(TestCase):
 class GraphQLPaymentMutationTests(TestCase):
     def setUp(self):
         cache.clear()
+        ratelimit.reset()
         self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
         UserProfile.objects.create(user=self.user)
         Cart.objects.create(user=self.user)
@@ -534,7 +814,7 @@ class GraphQLPaymentMutationTests(TestCase):
         self.assertTrue(data["valid"])
         self.assertEqual(data["cardType"], "visa")
 
-    @patch("shop.payment_views.requests.post")
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
     @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
     def test_process_mpesa_payment_via_graphql(self, _tok, mock_post):
         mock_post.return_value = MagicMock(
@@ -569,6 +849,34 @@ class GraphQLPaymentMutationTests(TestCase):
         self.assertTrue(data["success"])
         self.assertEqual(data["checkoutRequestId"], "ws_CO_gql")
 
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_mpesa_status_via_graphql(self, _tok, mock_post):
+        _pending_mpesa_payment(self.user, "ws_CO_123", age=60)
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
+                "ResultCode": "0",
+                "ResultDesc": "The service request is processed successfully.",
+                "MpesaReceiptNumber": "QJK3ABCDEF",
+            },
+        )
+        mock_post.return_value.raise_for_status = MagicMock()
+
+        response = self._gql(
+            """
+            query Status($id: String!) {
+              mpesaStatus(checkoutRequestId: $id) { status transactionId }
+            }
+            """,
+            {"id": "ws_CO_123"},
+        )
+        data = response.json()["data"]["mpesaStatus"]
+        self.assertEqual(data["status"], "success")
+        self.assertEqual(data["transactionId"], "QJK3ABCDEF")
+        sent_payload = mock_post.call_args[1]["json"]
+        self.assertEqual(sent_payload["CheckoutRequestID"], "ws_CO_123")
+
     def test_process_card_payment_via_graphql(self):
         response = self._gql(
             """
@@ -596,3 +904,259 @@ class GraphQLPaymentMutationTests(TestCase):
         data = response.json()["data"]["processPayment"]
         self.assertTrue(data["success"])
         self.assertIn("1111", data["transactionId"])
+
+
+# ---------------------------------------------------------------------------
+# 10. Order creation – bulk lines priced on the server (from the cart snapshot)
+# ---------------------------------------------------------------------------
+class OrderCreationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
+        self.category = Category.objects.create(name="Shoes", slug="shoes")
+        self.products = [
+            Product.objects.create(
+                name=f"Shoe {n}",
+                description="A shoe",
+                price="350.00",
+                category=self.category,
+            )
+            for n in range(30)
+        ]
+
+    def _create(self, products, amount=100):
+        body = {
+            "order_data": {
+                "shippingAddress": {"city": "Nairobi"},
+                "items": [
+                    {"productId": p.id, "quantity": 2, "price": 1} for p in products
+                ],
+            }
+        }
+        request = _make_post_request(self.user, body)
+        with CaptureQueriesContext(connection) as ctx:
+            payment = create_order_and_payment(
+                body, request, Decimal(amount), payment_method="card"
+            )
+        return payment, len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_basket(self):
+        _, few = self._create(self.products[:2])
+        _, many = self._create(self.products)
+        self.assertEqual(few, many)
+        self.assertEqual(OrderItem.objects.count(), 32)
+
+    def test_lines_use_server_prices(self):
+        product = self.products[0]
+        product.on_sale = True
+        product.sale_price = Decimal("300.00")
+        product.save()
+        payment, _ = self._create([product, self.products[1]], amount=100)
+        prices = sorted(item.price for item in payment.order.items.all())
+        self.assertEqual(prices, [Decimal("300.00"), Decimal("350.00")])
+        self.assertEqual(payment.order.total_amount, Decimal("100"))
+
+    def test_string_product_ids_create_lines(self):
+        body = {
+            "order_data": {
+                "shippingAddress": {"city": "Nairobi"},
+                "items": [{"productId": str(self.products[0].id), "quantity": 1}],
+            }
+        }
+        request = _make_post_request(self.user, body)
+        payment = create_order_and_payment(
+            body, request, Decimal(350), payment_method="mpesa"
+        )
+        self.assertEqual(payment.order.items.get().product, self.products[0])
+
+    def test_invalid_lines_are_rejected(self):
+        product_id = self.products[0].id
+        for items in (
+            [],
+            [{"productId": product_id}, {"productId": "not-an-id"}],
+            [{"productId": 999999}],
+            [{"productId": product_id, "quantity": "two"}],
+            [{"productId": product_id, "quantity": 0}],
+        ):
+            body = {
+                "payment_method": "card",
+                "amount": 10000,
+                "order_data": {"shippingAddress": {"city": "Nairobi"}, "items": items},
+            }
+            with patch("shop.payment_views.process_card_payment") as card:
+                response = async_to_sync(process_payment)(
+                    _make_post_request(self.user, body)
+                )
+            card.assert_not_called()
+            self.assertEqual(response.status_code, 400, items)
+        self.assertFalse(Order.objects.exists())
+
+    def test_payment_below_order_total_is_rejected(self):
+        body = {
+            "payment_method": "card",
+            "amount": 349,
+            "card_data": {
+                "cardNumber": "4111111111111111",
+                "cardExpiry": "12/30",
+                "cardCvc": "123",
+                "cardName": "Test User",
+            },
+            "order_data": {
+                "shippingAddress": {"city": "Nairobi"},
+                "items": [{"productId": str(self.products[0].id), "quantity": 1}],
+            },
+        }
+        with patch("shop.payment_views.process_card_payment") as card:
+            response = async_to_sync(process_payment)(
+                _make_post_request(self.user, body)
+            )
+        card.assert_not_called()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("351.00", json.loads(response.content)["error"])
+
+    @override_settings(**LOCMEM_CACHE)
+    def test_cart_lines_reuse_the_priced_cart(self):
+        cache.clear()
+        product = self.products[0]
+        carts.add(self.user, product, 2)
+        self.assertEqual(
+            pricing.price_cart(self.user).line_for(product.pk).unit_price,
+            Decimal("350.00"),
+        )
+        # A change that bypasses signals shows the snapshot is not re-priced.
+        Product.objects.filter(pk=product.pk).update(price="999.00")
+        payment, _ = self._create([product])
+        self.assertEqual(payment.order.items.get().price, Decimal("350.00"))
+
+    def test_bulk_lines_reach_the_daily_rollups(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._create(self.products[:3])
+        self.assertEqual(DailySales.objects.get().units, 6)
+        self.assertEqual(DailyProductSales.objects.count(), 3)
+
+
+# ---------------------------------------------------------------------------
+# 11. Idempotency keys – retried payments replay the first response
+# ---------------------------------------------------------------------------
+@override_settings(**MPESA_SETTINGS, **LOCMEM_CACHE)
+class PaymentIdempotencyTests(TestCase):
+    CARD_PAYMENT = {
+        "payment_method": "card",
+        "amount": 100,
+        "card_data": {
+            "cardNumber": "4111111111111111",
+            "cardExpiry": "12/30",
+            "cardCvc": "123",
+            "cardName": "Test User",
+        },
+    }
+
+    def setUp(self):
+        cache.clear()
+        ratelimit.reset()
+        self.user = User.objects.create_user("buyer", "b@test.com", "pass1234")
+
+    def _pay(self, body, key="retry-1"):
+        request = _make_post_request(self.user, body)
+        request.META["HTTP_IDEMPOTENCY_KEY"] = key
+        return async_to_sync(process_payment)(request)
+
+    def test_duplicate_replays_stored_response(self):
+        first = self._pay(self.CARD_PAYMENT)
+        with patch("shop.payment_views.process_card_payment") as card:
+            second = self._pay(self.CARD_PAYMENT)
+        card.assert_not_called()
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+
+        with patch("shop.payment_views.process_card_payment") as card:
+            card.return_value = payment_views.JsonResponse({"success": True})
+            self._pay(self.CARD_PAYMENT, key="retry-2")
+        card.assert_called_once()
+
+    def test_key_reused_for_different_body_is_rejected(self):
+        self._pay(self.CARD_PAYMENT)
+        response = self._pay({**self.CARD_PAYMENT, "amount": 200})
+        self.assertEqual(response.status_code, 422)
+
+    def test_duplicate_while_in_flight_gets_409(self):
+        duplicates = []
+
+        def card_payment(data, amount):
+            # The view runs on the event loop; send the duplicate from a thread.
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                duplicates.append(pool.submit(self._pay, self.CARD_PAYMENT).result())
+            return payment_views.JsonResponse({"success": True})
+
+        with patch("shop.payment_views.process_card_payment", card_payment):
+            self._pay(self.CARD_PAYMENT)
+        self.assertEqual(duplicates[0].status_code, 409)
+
+    def test_server_error_releases_key(self):
+        with patch("shop.payment_views.process_card_payment", side_effect=RuntimeError):
+            with self.assertLogs("shop", level="ERROR"):
+                self.assertEqual(self._pay(self.CARD_PAYMENT).status_code, 500)
+        response = self._pay(self.CARD_PAYMENT)
+        self.assertTrue(json.loads(response.content)["success"])
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+
+    MPESA_PAYMENT = {
+        "payment_method": "mpesa",
+        "amount": 100,
+        "phone_number": "0712345678",
+    }
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_push_with_unknown_outcome_keeps_key(self, _tok, mock_post):
+        mock_post.side_effect = httpx.ReadTimeout("no answer")
+        with self.assertLogs("shop", level="ERROR"):
+            first = self._pay(self.MPESA_PAYMENT)
+        second = self._pay(self.MPESA_PAYMENT)
+
+        self.assertEqual(first.status_code, 502)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_push_that_never_connected_releases_key(self, _tok, mock_post):
+        mock_post.side_effect = httpx.ConnectError("refused")
+        with self.assertLogs("shop", level="ERROR"):
+            self.assertEqual(self._pay(self.MPESA_PAYMENT).status_code, 500)
+            self.assertEqual(self._pay(self.MPESA_PAYMENT).status_code, 500)
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("shop.payment_views.outbound.apost", new_callable=AsyncMock)
+    @patch("shop.payment_views.get_mpesa_access_token", return_value="tok")
+    def test_graphql_input_key_sends_one_stk_push(self, _tok, mock_post):
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {"ResponseCode": "0", "CheckoutRequestID": "ws_CO_once"},
+        )
+        token = create_access_token(self.user)
+        query = """
+            mutation Pay($input: PaymentInput!) {
+              processPayment(input: $input) { success checkoutRequestId }
+            }
+        """
+        variables = {
+            "input": {
+                "paymentMethod": "mpesa",
+                "amount": 100.0,
+                "phoneNumber": "0712345678",
+                "idempotencyKey": "checkout-42",
+            }
+        }
+        results = [
+            self.client.post(
+                "/graphql/",
+                data=json.dumps({"query": query, "variables": variables}),
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {token}",
+            ).json()["data"]["processPayment"]
+            for _ in range(2)
+        ]
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0]["checkoutRequestId"], "ws_CO_once")
+        self.assertEqual(mock_post.call_count, 1)